@@ -251,6 +251,7 @@ class AdvancedWizardForm(forms.ModelForm):
             "num_users_irr",
             "batch_size",
             "classifier",
+            "feature_backend",
         ]
 
     use_active_learning = forms.BooleanField(initial=False, required=False)
@@ -276,6 +277,12 @@ class AdvancedWizardForm(forms.ModelForm):
         initial="logistic regression",
         required=False,
     )
+    feature_backend = forms.ChoiceField(
+        widget=RadioSelect(),
+        choices=Project.FEATURE_BACKEND_CHOICES,
+        initial="tfidf",
+        required=False,
+    )
 
     allow_coders_view_labels = forms.BooleanField(initial=False, required=False)
 
@@ -294,6 +301,26 @@ class AdvancedWizardForm(forms.ModelForm):
             self.cleaned_data["classifier"] = None
             self.cleaned_data["learning_method"] = "random"
 
+        feature_backend = self.cleaned_data.get("feature_backend") or "tfidf"
+        self.cleaned_data["feature_backend"] = feature_backend
+        # Gaussian Naive Bayes needs dense features, which is not possible with the
+        # number of columns the hashing backends produce
+        hashing = feature_backend in ["hashing", "hashing idf"]
+        if self.cleaned_data.get("classifier") == "gnb" and hashing:
+            self.add_error(
+                "feature_backend",
+                "Gaussian Naive Bayes cannot be used with hashing features.",
+            )
+        # Multinomial Naive Bayes needs features that are never negative
+        if (
+            self.cleaned_data.get("classifier") == "multinomial nb"
+            and feature_backend == "embeddings"
+        ):
+            self.add_error(
+                "feature_backend",
+                "Multinomial Naive Bayes cannot be used with sentence embeddings.",
+            )
+
         if use_default_batch_size:
             self.cleaned_data["batch_size"] = 0
         if not use_irr:
@@ -0,0 +1,92 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Project
+from core.utils.utils_benchmark import (
+    BENCHMARK_CLASSIFIERS,
+    BENCHMARK_SIZES,
+    compare_benchmarks,
+    load_benchmarks,
+    run_benchmarks,
+    save_benchmarks,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the tf-idf, training, prediction and queue filling stages on synthetic "
+        "projects and optionally compares the results with a baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="10k,100k",
+            help="Comma separated project sizes: 10k, 100k, 1m or a number of rows",
+        )
+        parser.add_argument(
+            "--classifiers",
+            default=",".join(BENCHMARK_CLASSIFIERS),
+            help="Comma separated classifiers to benchmark",
+        )
+        parser.add_argument("--labels", type=int, default=3, help="Number of labels")
+        parser.add_argument(
+            "--text-length", type=int, default=50, help="Number of words in each text"
+        )
+        parser.add_argument(
+            "--labeled", type=int, default=1000, help="Number of labeled data"
+        )
+        parser.add_argument(
+            "--output", default="benchmark.json", help="Where to write the results"
+        )
+        parser.add_argument("--baseline", help="Results to compare against")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Fraction a stage may be slower or use more memory than the baseline",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the benchmark projects instead of deleting them",
+        )
+
+    def handle(self, *args, **options):
+        sizes = []
+        for size in options["sizes"].split(","):
+            size = size.strip().lower()
+            if size in BENCHMARK_SIZES:
+                sizes.append(BENCHMARK_SIZES[size])
+            elif size.isdigit():
+                sizes.append(int(size))
+            else:
+                raise CommandError("Unknown project size: " + size)
+        classifiers = [c.strip() for c in options["classifiers"].split(",")]
+        valid_classifiers = [choice for choice, _ in Project.CLASSIFIER_CHOICES]
+        for classifier in classifiers:
+            if classifier not in valid_classifiers:
+                raise CommandError("Unknown classifier: " + classifier)
+
+        results = run_benchmarks(
+            sizes,
+            classifiers,
+            options["labels"],
+            options["text_length"],
+            options["labeled"],
+            keep=options["keep"],
+            log=self.stdout.write,
+        )
+        save_benchmarks(results, options["output"])
+        self.stdout.write("Results written to " + options["output"])
+
+        if options["baseline"]:
+            regressions = compare_benchmarks(
+                results, load_benchmarks(options["baseline"]), options["tolerance"]
+            )
+            for regression in regressions:
+                self.stdout.write(regression)
+            if regressions:
+                raise CommandError(
+                    str(len(regressions)) + " stages regressed from the baseline"
+                )
+            self.stdout.write("No regressions from the baseline")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Project
+from core.utils.utils_status import rebuild_data_status
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the status of every datum from the labels, queues, assignments "
+        "and recycle bin, and reports how many were out of date."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--project", type=int, help="Only rebuild the data of this project"
+        )
+
+    def handle(self, *args, **options):
+        project = None
+        if options["project"] is not None:
+            project = Project.objects.filter(pk=options["project"]).first()
+            if project is None:
+                raise CommandError("Unknown project: " + str(options["project"]))
+
+        num_fixed = rebuild_data_status(project)
+        self.stdout.write("Fixed the status of " + str(num_fixed) + " data")
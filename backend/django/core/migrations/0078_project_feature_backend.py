@@ -0,0 +1,29 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0077_project_allow_coders_view_labels"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="feature_backend",
+            field=models.CharField(
+                choices=[
+                    ("tfidf", "TF-IDF (default)"),
+                    ("hashing", "Hashing (for very large projects)"),
+                    (
+                        "hashing idf",
+                        "Hashing with IDF reweighting (for very large projects)",
+                    ),
+                ],
+                default="tfidf",
+                max_length=11,
+            ),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0078_project_feature_backend"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="project",
+            name="feature_backend",
+            field=models.CharField(
+                choices=[
+                    ("tfidf", "TF-IDF (default)"),
+                    ("hashing", "Hashing (for very large projects)"),
+                    (
+                        "hashing idf",
+                        "Hashing with IDF reweighting (for very large projects)",
+                    ),
+                    ("embeddings", "Sentence embeddings"),
+                ],
+                default="tfidf",
+                max_length=11,
+            ),
+        ),
+    ]
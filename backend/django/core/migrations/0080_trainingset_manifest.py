@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0079_alter_project_feature_backend"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="trainingset",
+            name="manifest",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
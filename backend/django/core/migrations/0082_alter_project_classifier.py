@@ -0,0 +1,36 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0081_datapredictionsummary"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="project",
+            name="classifier",
+            field=models.CharField(
+                choices=[
+                    ("logistic regression", "Logistic Regression (default)"),
+                    (
+                        "svm",
+                        "Support Vector Machine (warning: slower for large datasets)",
+                    ),
+                    ("random forest", "Random Forest"),
+                    ("gnb", "Gaussian Naive Bayes"),
+                    (
+                        "sgd",
+                        "Incremental SGD Logistic Regression (faster for large projects)",
+                    ),
+                    ("multinomial nb", "Incremental Multinomial Naive Bayes"),
+                ],
+                default="logistic regression",
+                max_length=19,
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0082_alter_project_classifier"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="model",
+            name="cv_accuracy",
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="model",
+            name="cv_metrics",
+            field=models.JSONField(null=True),
+        ),
+    ]
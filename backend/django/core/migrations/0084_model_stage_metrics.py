@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0083_alter_model_cv_accuracy_alter_model_cv_metrics"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="model",
+            name="stage_metrics",
+            field=models.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:00
+
+import random
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0084_model_stage_metrics"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="data",
+            name="random_key",
+            field=models.FloatField(default=random.random),
+        ),
+        # AddField gives every existing row the same value
+        migrations.RunSQL(
+            "UPDATE core_data SET random_key = random();",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        # Data is also inserted with copy_from, which skips the python default
+        migrations.RunSQL(
+            "ALTER TABLE core_data ALTER COLUMN random_key SET DEFAULT random();",
+            reverse_sql="ALTER TABLE core_data ALTER COLUMN random_key DROP DEFAULT;",
+        ),
+        migrations.AddIndex(
+            model_name="data",
+            index=models.Index(
+                fields=["project", "random_key"], name="core_data_project_ebb27c_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0085_data_random_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="data",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("unlabeled", "Unlabeled"),
+                    ("queued", "Queued"),
+                    ("assigned", "Assigned"),
+                    ("irr", "IRR pending"),
+                    ("adjudication", "Adjudication"),
+                    ("labeled", "Labeled"),
+                    ("recycled", "Recycled"),
+                ],
+                default="unlabeled",
+                max_length=20,
+            ),
+        ),
+        # the same rules as generate_sql_for_data_status in core.utils.utils_status
+        migrations.RunSQL(
+            """
+            UPDATE core_data d SET status = CASE
+                WHEN EXISTS (
+                    SELECT 1 FROM core_recyclebin r WHERE r.data_id = d.id
+                ) THEN 'recycled'
+                WHEN NOT d.irr_ind AND EXISTS (
+                    SELECT 1 FROM core_datalabel l WHERE l.data_id = d.id
+                ) THEN 'labeled'
+                WHEN EXISTS (
+                    SELECT 1
+                    FROM core_dataqueue dq
+                    INNER JOIN core_queue q ON q.id = dq.queue_id
+                    WHERE dq.data_id = d.id AND q.type = 'admin'
+                ) THEN 'adjudication'
+                WHEN EXISTS (
+                    SELECT 1 FROM core_assigneddata a WHERE a.data_id = d.id
+                ) THEN 'assigned'
+                WHEN d.irr_ind THEN 'irr'
+                WHEN EXISTS (
+                    SELECT 1 FROM core_dataqueue dq WHERE dq.data_id = d.id
+                ) THEN 'queued'
+                ELSE 'unlabeled'
+            END;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        # Data is also inserted with copy_from, which skips the python default
+        migrations.RunSQL(
+            "ALTER TABLE core_data ALTER COLUMN status SET DEFAULT 'unlabeled';",
+            reverse_sql="ALTER TABLE core_data ALTER COLUMN status DROP DEFAULT;",
+        ),
+        migrations.AddIndex(
+            model_name="data",
+            index=models.Index(
+                fields=["project", "status"], name="core_data_project_c401fc_idx"
+            ),
+        ),
+    ]
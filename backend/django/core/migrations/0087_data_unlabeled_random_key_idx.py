@@ -0,0 +1,21 @@
+# Generated by Django 4.2.11 on 2026-10-18 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0086_data_status"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="data",
+            index=models.Index(
+                condition=models.Q(("status", "unlabeled")),
+                fields=["project", "random_key"],
+                name="data_unlabeled_random_key_idx",
+            ),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import random
+
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
 from django.core.validators import MaxValueValidator, MinValueValidator
@@ -60,6 +62,8 @@ class Project(models.Model):
         ("svm", "Support Vector Machine (warning: slower for large datasets)"),
         ("random forest", "Random Forest"),
         ("gnb", "Gaussian Naive Bayes"),
+        ("sgd", "Incremental SGD Logistic Regression (faster for large projects)"),
+        ("multinomial nb", "Incremental Multinomial Naive Bayes"),
     ]
 
     learning_method = models.CharField(
@@ -72,6 +76,16 @@ class Project(models.Model):
         null=True,
     )
 
+    FEATURE_BACKEND_CHOICES = [
+        ("tfidf", "TF-IDF (default)"),
+        ("hashing", "Hashing (for very large projects)"),
+        ("hashing idf", "Hashing with IDF reweighting (for very large projects)"),
+        ("embeddings", "Sentence embeddings"),
+    ]
+    feature_backend = models.CharField(
+        max_length=11, default="tfidf", choices=FEATURE_BACKEND_CHOICES
+    )
+
     DEDUP_CHOICES = (
         ("Text", "Text only"),
         ("Metadata_Text", "Text and all Metadata fields"),
@@ -181,8 +195,12 @@ class Model(models.Model):
     pickle_path = models.TextField()
     project = models.ForeignKey("Project", on_delete=models.CASCADE)
     training_set = models.ForeignKey("TrainingSet", on_delete=models.CASCADE)
-    cv_accuracy = models.FloatField()
-    cv_metrics = JSONField()
+    # filled in by send_cv_task after the model is published
+    cv_accuracy = models.FloatField(null=True)
+    cv_metrics = JSONField(null=True)
+    # wall time, CPU time, peak memory, rows and features of each stage of building
+    # the model, see utils_resources.measure_stage
+    stage_metrics = JSONField(null=True)
     predictions = models.ManyToManyField(
         "Data", related_name="models", through="DataPrediction"
     )
@@ -191,7 +209,28 @@ class Model(models.Model):
 class Data(models.Model):
     class Meta:
         unique_together = ("hash", "upload_id_hash", "project")
-        indexes = [models.Index(fields=["project"])]
+        indexes = [
+            models.Index(fields=["project"]),
+            models.Index(fields=["project", "random_key"]),
+            models.Index(fields=["project", "status"]),
+            # fill_queue probes random keys of the unlabeled data only, see
+            # generate_sql_for_random_sample
+            models.Index(
+                fields=["project", "random_key"],
+                condition=models.Q(status="unlabeled"),
+                name="data_unlabeled_random_key_idx",
+            ),
+        ]
+
+    STATUS_CHOICES = [
+        ("unlabeled", "Unlabeled"),
+        ("queued", "Queued"),
+        ("assigned", "Assigned"),
+        ("irr", "IRR pending"),
+        ("adjudication", "Adjudication"),
+        ("labeled", "Labeled"),
+        ("recycled", "Recycled"),
+    ]
 
     text = models.TextField()
     hash = models.CharField(max_length=128)
@@ -199,6 +238,16 @@ class Data(models.Model):
     irr_ind = models.BooleanField(default=False)
     upload_id = models.CharField(max_length=128)
     upload_id_hash = models.CharField(max_length=128)
+    # A uniform random number fixed when the datum is created. Random samples probe
+    # the index at random keys instead of sorting by random(), see
+    # generate_sql_for_random_sample. The database default covers copy_from.
+    random_key = models.FloatField(default=random.random)
+    # Where the datum is in the labeling process. It is derived from the labels,
+    # queues, assignments and recycle bin and updated in the same transaction as
+    # them, see core.utils.utils_status.
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default="unlabeled"
+    )
 
     def __str__(self):
         return self.text
@@ -332,6 +381,23 @@ class DataPrediction(models.Model):
     predicted_probability = models.FloatField()
 
 
+class DataPredictionSummary(models.Model):
+    """The top predicted labels of a datum from an older model.
+
+    Only the latest model of a project keeps a DataPrediction for every label, the
+    predictions of older models are compacted into these, see compact_predictions.
+    """
+
+    class Meta:
+        unique_together = ("data", "model")
+
+    data = models.ForeignKey("Data", on_delete=models.CASCADE)
+    model = models.ForeignKey("Model", on_delete=models.CASCADE)
+    # label pks and their predicted probabilities, most probable first
+    labels = ArrayField(models.IntegerField())
+    probabilities = ArrayField(models.FloatField())
+
+
 class DataUncertainty(models.Model):
     class Meta:
         unique_together = ("data", "model")
@@ -376,6 +442,9 @@ class TrainingSet(models.Model):
     project = models.ForeignKey("Project", on_delete=models.CASCADE)
     set_number = models.IntegerField()
     celery_task_id = models.TextField(blank=True)
+    # names of the stored feature matrix, vectorizer and classifier of the model
+    # trained on this set, see core.utils.utils_artifacts
+    manifest = JSONField(null=True, blank=True)
 
 
 class RecycleBin(models.Model):
@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 
-from celery import shared_task
+from celery import chord, shared_task
 
 
 @shared_task
@@ -9,38 +9,202 @@ def send_test_task():
 
 
 @shared_task
-def send_model_task(project_pk):
-    """Trains, Saves, Predicts, Fills Queue."""
-    from core.models import Project, TrainingSet
-    from core.utils.utils_model import predict_data, train_and_save_model
+def send_model_task(project_pk, full_retrain=False, lock_owner=None):
+    """Trains, Saves, Predicts, Fills Queue.
+
+    The unlabeled data are predicted in a chord of send_predict_shard_task, one per
+    range of data from prediction_shards, so any free worker can take a shard.
+    send_model_finalize_task runs once every shard is done, and releases the model
+    lock of the project held by lock_owner, see check_and_trigger_model. If training
+    or a shard fails the lock is released right away, see send_model_failure_task.
+
+    full_retrain trains incremental classifiers on all labels, see
+    train_and_save_model.
+    """
+    from core.models import Project
+    from core.utils.utils_model import prediction_shards, train_and_save_model
+    from core.utils.utils_redis import release_task_lock
 
     project = Project.objects.get(pk=project_pk)
     al_method = project.learning_method
 
-    model = train_and_save_model(project)
-    if al_method != "random":
-        predict_data(project, model)
+    try:
+        model = train_and_save_model(project, full_retrain=full_retrain)
+        if model.cv_accuracy is None:
+            send_cv_task.delay(model.pk)
+        if al_method != "random":
+            shards = [
+                send_predict_shard_task.si(project_pk, model.pk, first_hash, last_hash)
+                for first_hash, last_hash in prediction_shards(project)
+            ]
+            # if a shard fails the chord never calls finalize, so the lock is
+            # released by the error callback instead
+            predict_chord = chord(
+                shards, send_model_finalize_task.si(project_pk, lock_owner)
+            )
+            predict_chord.link_error(send_model_failure_task.si(project_pk, lock_owner))
+            predict_chord.delay()
+        else:
+            send_model_finalize_task(project_pk, lock_owner)
+    except Exception:
+        if lock_owner:
+            release_task_lock(project_pk, "model", lock_owner)
+        raise
+
+
+@shared_task
+def send_predict_shard_task(project_pk, model_pk, first_hash, last_hash):
+    """Predict the unlabeled data of one shard, see predict_data."""
+    from core.models import Model, Project
+    from core.utils.utils_model import predict_data
+
+    return predict_data(
+        Project.objects.get(pk=project_pk),
+        Model.objects.get(pk=model_pk),
+        first_hash=first_hash,
+        last_hash=last_hash,
+    )
+
+
+@shared_task
+def send_model_finalize_task(project_pk, lock_owner=None):
+    """Start the next training set once the model is trained and has predicted the
+    data, reorder the queues, then clean up after the earlier models."""
+    from core.models import Project, TrainingSet
+    from core.utils.utils_model import collect_artifact_garbage
+    from core.utils.utils_redis import release_task_lock, sync_redis_objects
+
+    project = Project.objects.get(pk=project_pk)
     TrainingSet.objects.create(
         project=project, set_number=project.get_current_training_set().set_number + 1
     )
+    # the data waiting in the queues are reordered by the scores of the new model
+    for queue in project.queue_set.filter(type="normal"):
+        sync_redis_objects(queue, project.learning_method)
+    if lock_owner:
+        release_task_lock(project_pk, "model", lock_owner)
+    collect_artifact_garbage(project)
+    send_prediction_compaction_task.delay(project_pk)
 
 
 @shared_task
-def send_tfidf_creation_task(project_pk):
-    """Create and Save tfidf."""
+def send_model_failure_task(project_pk, lock_owner=None):
+    """Release the model lock of a project held by lock_owner when a prediction shard
+    of send_model_task fails, so the next trigger can train the model again."""
+    from core.utils.utils_redis import release_task_lock
+
+    if lock_owner:
+        release_task_lock(project_pk, "model", lock_owner)
+
+
+@shared_task
+def send_cv_task(model_pk):
+    """Cross validate a model that is already published, see evaluate_model."""
+    from core.models import Model
+    from core.utils.utils_model import evaluate_model
+
+    model = evaluate_model(Model.objects.get(pk=model_pk))
+
+    return model.cv_accuracy
+
+
+@shared_task
+def send_prediction_compaction_task(project_pk):
+    """Compact the predictions of all but the latest model of a project."""
+    from core.models import Project
+    from core.utils.utils_model import compact_predictions
+
+    return compact_predictions(Project.objects.get(pk=project_pk))
+
+
+@shared_task
+def send_tfidf_creation_task(project_pk, force_refit=False, trigger_model=False):
+    """Create and Save tfidf.
+
+    New data is added to the existing matrix unless a refit is needed, see
+    update_tfidf_matrix. Triggers for a project whose features are already being
+    updated are coalesced, see run_coalesced.
+
+    With trigger_model the model is checked and triggered once the features include
+    the data of the project, by this task or by the one it was coalesced into.
+    """
+    from core.utils.utils_model import update_project_features, update_tfidf_matrix
+    from core.utils.utils_redis import run_coalesced
+
+    return run_coalesced(
+        project_pk,
+        "features",
+        lambda: publish_features(
+            project_pk,
+            update_project_features(
+                project_pk, update_tfidf_matrix, force_refit=force_refit
+            ),
+        ),
+        follow_up=lambda: send_check_and_trigger_model_task.delay(project_pk),
+        request_follow_up=trigger_model,
+    )
+
+
+@shared_task
+def send_embeddings_creation_task(project_pk, trigger_model=False):
+    """Embed the project data that has no document embedding yet.
+
+    trigger_model works as for send_tfidf_creation_task.
+    """
     from core.utils.utils_model import (
-        create_tfidf_matrix,
-        save_tfidf_matrix,
-        save_tfidf_vectorizer,
+        update_embeddings_matrix,
+        update_project_features,
+    )
+    from core.utils.utils_redis import run_coalesced
+
+    return run_coalesced(
+        project_pk,
+        "features",
+        lambda: publish_features(
+            project_pk, update_project_features(project_pk, update_embeddings_matrix)
+        ),
+        follow_up=lambda: send_check_and_trigger_model_task.delay(project_pk),
+        request_follow_up=trigger_model,
     )
 
-    tf_idf, vectorizer = create_tfidf_matrix(project_pk)
-    file = save_tfidf_matrix(tf_idf, project_pk)
-    save_tfidf_vectorizer(vectorizer, project_pk)
+
+def publish_features(project_pk, file):
+    """Drop the cached features of a project and store the new ones."""
+    from core.models import Project
+    from core.utils.utils_cache import artifact_cache
+    from core.utils.utils_model import current_project_features
+
+    artifact_cache.invalidate(project_pk, "features")
+    current_project_features(Project.objects.get(pk=project_pk))
 
     return file
 
 
+@shared_task
+def send_artifact_cache_stats_task():
+    """Return the hit, miss and eviction counts of the artifact cache of the worker
+    that runs the task."""
+    from core.utils.utils_cache import artifact_cache
+
+    return artifact_cache.stats()
+
+
+@shared_task
+def send_fill_queue_task(project_pk, orderby=None):
+    """Fill the queues of a project, see schedule_queue_refill. Refills of a project
+    whose queues are already being filled are coalesced, see run_coalesced. Each run
+    takes the orderby of the latest refill, see refill_project_queues."""
+    from core.models import Project
+    from core.utils.utils_queue import refill_project_queues
+    from core.utils.utils_redis import run_coalesced
+
+    project = Project.objects.get(pk=project_pk)
+
+    return run_coalesced(
+        project_pk, "fill_queue", lambda: refill_project_queues(project, orderby)
+    )
+
+
 @shared_task
 def send_label_embeddings_task(project_pk):
     from core.utils.util import generate_label_embeddings
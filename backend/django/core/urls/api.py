@@ -93,6 +93,10 @@ adminpage_patterns = [
         r"^unassign_coder/(?P<project_pk>\d+)/(?P<profile_id>\d+)/$",
         api_admin.unassign_coders,
     ),
+    re_path(r"^refit_tfidf/(?P<project_pk>\d+)/$", api_admin.refit_tfidf),
+    re_path(r"^retrain_model/(?P<project_pk>\d+)/$", api_admin.retrain_model),
+    re_path(r"^task_locks/(?P<project_pk>\d+)/$", api_admin.task_locks),
+    re_path(r"^artifact_cache/(?P<project_pk>\d+)/$", api_admin.artifact_cache_stats),
 ]
 
 urlpatterns = [
@@ -6,16 +6,15 @@ from itertools import combinations
 import numpy as np
 import pandas as pd
 import pytz
-from celery import chord
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import connection, transaction
+from django.db.models import Count
 from django.utils import timezone
 from sentence_transformers import SentenceTransformer
 
 from core import tasks
 from core.models import (
-    AssignedData,
     Data,
     DataLabel,
     DataQueue,
@@ -27,15 +26,19 @@ from core.models import (
     Profile,
     Project,
     ProjectPermissions,
-    RecycleBin,
     TrainingSet,
     VerifiedDataLabel,
 )
 from core.utils.utils_queue import fill_queue
+from core.utils.utils_status import update_data_status
 from smart.settings import TIME_ZONE_FRONTEND
 
 # from string_grouper import compute_pairwise_similarities
 
+# The statuses of data that nobody has labeled yet, and IRR data count as long as
+# none of their labels are in, see get_unlabelled_data_objs
+UNLABELED_STATUSES = ["unlabeled", "queued"]
+
 
 # https://stackoverflow.com/questions/20625582/how-to-deal-with-settingwithcopywarning-in-pandas
 # Disable warning for false positive warning that should only trigger on chained assignment
@@ -131,17 +134,18 @@ def upload_data(form_data, project, queue=None, irr_queue=None, batch_size=30):
 
     # Since User can upload Labeled Data and this data is added to current training_set
     # we need to check_and_trigger model.  However since training model requires
-    # tf_idf to be created we must create a chord which garuntees that tfidf
-    # creation task is completed before check and trigger model task
+    # tf_idf to be created the feature task triggers the model once the features
+    # include the new data, even if it is coalesced into a running one
 
     if len(new_df) > 0:
         save_data_file(new_df, project.pk)
         if project.classifier is not None:
+            if project.feature_backend == "embeddings":
+                feature_task = tasks.send_embeddings_creation_task
+            else:
+                feature_task = tasks.send_tfidf_creation_task
             transaction.on_commit(
-                lambda: chord(
-                    tasks.send_tfidf_creation_task.s(project.pk),
-                    tasks.send_check_and_trigger_model_task.si(project.pk),
-                ).apply_async()
+                lambda: feature_task.delay(project.pk, trigger_model=True)
             )
     return len(new_df)
 
@@ -386,7 +390,13 @@ def add_data(project, df):
     # Find the data that has labels
     labeled_df = df[~pd.isnull(df["Label"])]
     if len(labeled_df) > 0:
-        create_labels_from_csv(labeled_df, project)
+        with transaction.atomic():
+            create_labels_from_csv(labeled_df, project)
+            update_data_status(
+                Data.objects.filter(
+                    project=project, status="unlabeled", datalabel__isnull=False
+                )
+            )
 
     return df
 
@@ -665,8 +675,6 @@ def project_status(project):
         data__project=project, data__irr_ind=False
     ).count()
 
-    total_data_objs = project.data_set.all().count()
-
     final_verified = DataLabel.objects.filter(
         data__project=project, data__irr_ind=False, verified__isnull=False
     ).count()
@@ -675,36 +683,22 @@ def project_status(project):
         data__project=project, data__irr_ind=False, verified__isnull=True
     ).count()
 
-    stuff_in_queue = (
-        DataQueue.objects.filter(queue__project=project, queue__type="admin")
-        .values_list("data__pk", flat=True)
-        .count()
-    )
-
-    recycle_ids = (
-        RecycleBin.objects.filter(data__project=project)
-        .values_list("data__pk", flat=True)
-        .count()
+    status_counts = dict(
+        project.data_set.values_list("status").annotate(Count("pk")).order_by()
     )
-
-    assigned_ids = (
-        AssignedData.objects.filter(data__project=project)
-        .values_list("data__pk", flat=True)
-        .count()
-    )
-
-    unlabeled_data_objs = get_unlabelled_data_objs(project.id)
+    total_data_objs = sum(status_counts.values())
+    recycled = status_counts.get("recycled", 0)
 
     return {
-        "adjudication": stuff_in_queue,
-        "assigned": assigned_ids,
+        "adjudication": status_counts.get("adjudication", 0),
+        "assigned": status_counts.get("assigned", 0),
         "final": total_labels,
         "final_verified": final_verified,
         "final_unverified": final_unverified,
-        "recycled": recycle_ids,
+        "recycled": recycled,
         "total": total_data_objs,
-        "unlabeled": unlabeled_data_objs,
-        "badge": f"{total_labels}/{total_data_objs - recycle_ids}",
+        "unlabeled": get_unlabelled_data_objs(project.id),
+        "badge": f"{total_labels}/{total_data_objs - recycled}",
     }
 
 
@@ -751,12 +745,9 @@ def get_projects_umbrellas(self):
 def get_unlabelled_data_objs(project_id: int) -> int:
     """Function to retrieve the total count of unlabelled data objects for a project.
 
-    This SQL query is comprised of 5 subqueries, each of which retrieves the ids of
-    data objects that are in a particular table. The first sub-query is the total list
-    of unlabbeled data entries for a given project, while the remaining four are tables
-    that we will be comparing against the list of ids from the first sub-query. The
-    remaining four sets of ids are then joined on the `project_ids`. We then return
-    the count of the rows that have `null` values.
+    These are the data that are unlabeled or waiting in a queue, as given by the
+    status of each datum, leaving out the IRR data that some coders already labeled
+    or skipped.
 
     Args:
         project_id: The id of the project for which to retrieve the count of unlabelled
@@ -765,51 +756,10 @@ def get_unlabelled_data_objs(project_id: int) -> int:
     Returns:
         The count of unlabelled data objects for a project.
     """
-    query = """
-        WITH project_ids AS (
-            SELECT cd.id
-            FROM core_data cd
-            LEFT JOIN core_datalabel cdl ON cd.id = cdl.data_id
-            WHERE cd.project_id = %s AND cdl.label_id IS NULL
-        ),
-        queue_ids AS (
-            SELECT cdq.id, cdq.data_id
-            FROM core_dataqueue cdq
-            LEFT JOIN core_queue cq ON cdq.queue_id = cq.id
-            WHERE cq.project_id = %s AND cq.type = 'admin'
-        ),
-        irr_log_ids AS (
-            SELECT ci.id, ci.data_id
-            FROM core_irrlog ci
-            LEFT JOIN core_data cd ON ci.data_id = cd.id
-            WHERE cd.project_id = %s
-        ),
-        assigned_ids AS (
-            SELECT ca.id, ca.data_id
-            FROM core_assigneddata ca
-            LEFT JOIN core_data cd ON ca.data_id = cd.id
-            WHERE cd.project_id = %s
-        ),
-        recycle_ids AS (
-            SELECT cr.id, cr.data_id
-            FROM core_recyclebin cr
-            LEFT JOIN core_data cd ON cr.data_id = cd.id
-            WHERE cd.project_id = %s
-        )
-        SELECT COUNT(*)
-            FROM (
-                SELECT p.id
-                FROM project_ids p
-                LEFT JOIN queue_ids q ON p.id = q.data_id
-                LEFT JOIN irr_log_ids irr ON p.id = irr.data_id
-                LEFT JOIN assigned_ids a ON p.id = a.data_id
-                LEFT JOIN recycle_ids r ON p.id = r.data_id
-                WHERE q.id IS NULL
-                    AND irr.id IS NULL
-                    AND a.id IS NULL
-                        AND r.id IS NULL
-            ) AS filtered_ids;
-    """
-    with connection.cursor() as cursor:
-        cursor.execute(query, [project_id] * 5)
-        return cursor.fetchone()[0]
+    project_data = Data.objects.filter(project_id=project_id)
+    return (
+        project_data.filter(status__in=UNLABELED_STATUSES).count()
+        + project_data.filter(
+            status="irr", datalabel__isnull=True, irrlog__isnull=True
+        ).count()
+    )
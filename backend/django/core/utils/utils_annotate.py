@@ -13,18 +13,24 @@ from core.models import (
     DataLabel,
     DataQueue,
     IRRLog,
-    Project,
     Queue,
-    RecycleBin,
     VerifiedDataLabel,
 )
 from core.templatetags import project_extras
-from core.utils.utils_queue import pop_first_nonempty_queue
+from core.utils.utils_queue import (
+    get_irr_batch,
+    pop_first_nonempty_queue,
+    pop_queue_batch,
+)
 from core.utils.utils_redis import (
+    UNASSIGNED_SCORE,
+    add_irr_data,
     redis_serialize_data,
     redis_serialize_queue,
     redis_serialize_set,
+    remove_irr_data,
 )
+from core.utils.utils_status import update_data_status
 
 
 def leave_coding_page(profile, project):
@@ -51,6 +57,7 @@ def assign_datum(profile, project, type="normal"):
             num_labeled = DataLabel.objects.filter(data=datum, profile=profile).count()
             if num_labeled == 0:
                 AssignedData.objects.create(data=datum, profile=profile, queue=queue)
+                update_data_status(Data.objects.filter(pk=datum.pk))
                 return datum
             else:
                 return None
@@ -70,6 +77,7 @@ def move_skipped_to_admin_queue(datum, profile, project):
 
         # change the queue to the admin one
         DataQueue.objects.filter(data=datum, queue=queue).update(queue=new_queue)
+        update_data_status(Data.objects.filter(pk=datum.pk))
 
     # remove the data from redis
     settings.REDIS.srem(redis_serialize_set(queue), redis_serialize_data(datum))
@@ -80,7 +88,9 @@ def get_assignments(profile, project, num_assignments):
     """Check if a data is currently assigned to this profile/project; If so, return
     max(num_assignments, len(assigned) of it.
 
-    If not, try to get a num_assigments of new assignments and return them.
+    If not, try to get a num_assigments of new assignments and return them. The
+    normal data are popped from redis in one call and all of the assignments are
+    created in one insert.
     """
     existing_assignments = AssignedData.objects.filter(
         profile=profile, queue__project=project
@@ -91,27 +101,48 @@ def get_assignments(profile, project, num_assignments):
             assignment.data for assignment in existing_assignments[:num_assignments]
         ]
     else:
-        data = []
-
-        for i in range(num_assignments):
-            # if there is IRR, with some probability get an IRR item
-            rand_choice = randrange(0, 101)
-            if project.percentage_irr > 0 and rand_choice <= project.percentage_irr:
-                assigned_datum = assign_datum(profile, project, type="irr")
-                if assigned_datum is None:
-                    # no irr data found
-                    assigned_datum = assign_datum(profile, project)
-            else:
-                # get normal data
-                assigned_datum = assign_datum(profile, project)
-                if assigned_datum is None:
-                    # no non-irr data found so checking for irr
-                    assigned_datum = assign_datum(profile, project, type="irr")
-            if assigned_datum is None:
-                break
+        # if there is IRR, each assignment is an IRR item with some probability
+        num_irr = 0
+        if project.percentage_irr > 0:
+            num_irr = sum(
+                randrange(0, 101) <= project.percentage_irr
+                for i in range(num_assignments)
+            )
 
-            data.append(assigned_datum)
-        return data
+        with transaction.atomic():
+            irr_assignments = get_irr_batch(project, profile, num_irr)
+            # the rest are normal data, including IRR items that were not found
+            assignments = pop_queue_batch(
+                project, num_assignments - len(irr_assignments), profile=profile
+            )
+            num_missing = num_assignments - len(irr_assignments) - len(assignments)
+            if num_missing > 0:
+                # no more non-irr data found so checking for more irr
+                irr_assignments += get_irr_batch(project, profile, num_missing)
+            assignments = irr_assignments + assignments
+
+            # popped data the profile already labeled are not assigned again
+            labeled_data_ids = set(
+                DataLabel.objects.filter(
+                    profile=profile, data__in=[datum for _, datum in assignments]
+                ).values_list("data_id", flat=True)
+            )
+            assignments = [
+                (queue, datum)
+                for queue, datum in assignments
+                if datum.pk not in labeled_data_ids
+            ]
+
+            AssignedData.objects.bulk_create(
+                [
+                    AssignedData(data=datum, profile=profile, queue=queue)
+                    for queue, datum in assignments
+                ]
+            )
+            update_data_status(
+                Data.objects.filter(pk__in=[datum.pk for _, datum in assignments])
+            )
+        return [datum for _, datum in assignments]
 
 
 def unassign_datum(datum, profile):
@@ -119,12 +150,18 @@ def unassign_datum(datum, profile):
 
     Re-add the datum to its respective queue in Redis.
     """
-    assignment = AssignedData.objects.filter(profile=profile, data=datum).get()
-
-    queue = assignment.queue
-    assignment.delete()
+    with transaction.atomic():
+        assignment = AssignedData.objects.filter(profile=profile, data=datum).get()
+        queue = assignment.queue
+        assignment.delete()
+        update_data_status(Data.objects.filter(pk=datum.pk))
 
-    settings.REDIS.lpush(redis_serialize_queue(queue), redis_serialize_data(datum))
+    settings.REDIS.zadd(
+        redis_serialize_queue(queue), {redis_serialize_data(datum): UNASSIGNED_SCORE}
+    )
+    if queue.type == "irr":
+        # the profile can be assigned the IRR datum again
+        add_irr_data(queue, [datum.pk], profile)
 
 
 def batch_unassign(profile):
@@ -140,24 +177,27 @@ def skip_data(datum, profile):
     """Record that a given datum has been skipped."""
     project = datum.project
 
-    IRRLog.objects.create(
-        data=datum, profile=profile, label=None, timestamp=timezone.now()
-    )
-    num_history = IRRLog.objects.filter(data=datum).count()
-    # if the datum is irr or processed irr, dont add to admin queue yet
-    if datum.irr_ind or num_history > 0:
-        # if the IRR history has more than the needed number of labels , it is
-        # already processed so don't do anything else
-        if num_history <= project.num_users_irr:
-            process_irr_label(datum, None)
-
-        # unassign the skipped item
-        assignment = AssignedData.objects.get(data=datum, profile=profile)
-        assignment.delete()
-    else:
-        # Make sure coder still has permissions before labeling data
-        if project_extras.proj_permission_level(project, profile) > 0:
-            move_skipped_to_admin_queue(datum, profile, project)
+    with transaction.atomic():
+        IRRLog.objects.create(
+            data=datum, profile=profile, label=None, timestamp=timezone.now()
+        )
+        num_history = IRRLog.objects.filter(data=datum).count()
+        # if the datum is irr or processed irr, dont add to admin queue yet
+        if datum.irr_ind or num_history > 0:
+            # if the IRR history has more than the needed number of labels , it is
+            # already processed so don't do anything else
+            if num_history <= project.num_users_irr:
+                process_irr_label(datum, None)
+
+            # unassign the skipped item
+            assignment = AssignedData.objects.get(data=datum, profile=profile)
+            assignment.delete()
+            remove_irr_data(assignment.queue, datum, profile)
+        else:
+            # Make sure coder still has permissions before labeling data
+            if project_extras.proj_permission_level(project, profile) > 0:
+                move_skipped_to_admin_queue(datum, profile, project)
+        update_data_status(Data.objects.filter(pk=datum.pk))
 
 
 def label_data(label, datum, profile, time):
@@ -200,8 +240,11 @@ def label_data(label, datum, profile, time):
                 DataLabel.objects.get(data=datum, profile=profile).delete()
             else:
                 process_irr_label(datum, label)
+        update_data_status(Data.objects.filter(pk=datum.pk))
     if not irr_data:
         settings.REDIS.srem(redis_serialize_set(queue), redis_serialize_data(datum))
+    elif queue.type == "irr":
+        remove_irr_data(queue, datum, profile)
 
 
 def process_irr_label(data, label):
@@ -257,10 +300,12 @@ def process_irr_label(data, label):
                 agree = False
                 # if they don't, update the data into the admin queue
                 DataQueue.objects.filter(data=data).update(queue=admin_queue)
+            update_data_status(Data.objects.filter(pk=data.pk))
 
         # update redis to reflect the queue changes
         irr_queue = Queue.objects.get(project=project, type="irr")
         settings.REDIS.srem(redis_serialize_set(irr_queue), redis_serialize_data(data))
+        remove_irr_data(irr_queue, data)
 
         if not agree:
             settings.REDIS.sadd(
@@ -269,30 +314,11 @@ def process_irr_label(data, label):
 
 
 def get_unlabeled_data(project_pk):
-    project = Project.objects.get(pk=project_pk)
-
-    stuff_in_queue = DataQueue.objects.filter(
-        queue__project=project, queue__type="admin"
+    """The data of a project that are not labeled, assigned, recycled, IRR or in the
+    admin queue, though they may be in the normal queue."""
+    return Data.objects.filter(
+        project_id=project_pk, status__in=["unlabeled", "queued"]
     )
-    in_admin_queue_ids = [queued.data.id for queued in stuff_in_queue]
-
-    recycle_ids = RecycleBin.objects.filter(data__project=project).values_list(
-        "data__pk", flat=True
-    )
-
-    assigned_ids = AssignedData.objects.filter(data__project=project).values_list(
-        "data__pk", flat=True
-    )
-
-    unlabeled_data = (
-        project.data_set.filter(datalabel__isnull=True)
-        .exclude(id__in=in_admin_queue_ids)
-        .exclude(id__in=assigned_ids)
-        .exclude(id__in=recycle_ids)
-        .exclude(irr_ind=True)
-    )
-
-    return unlabeled_data
 
 
 def createUnresolvedAdjudicateMessage(project, data, message):
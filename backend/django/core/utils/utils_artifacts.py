@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+
+# Size of the blocks files are read in when they are hashed
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def artifact_store_path(project_pk):
+    """The directory holding the artifact store of a project."""
+    return os.path.join(settings.ARTIFACT_STORE_PATH, "project_" + str(project_pk))
+
+
+def object_path(project_pk, name):
+    """The path of a stored artifact. Artifacts are named by the hash of their
+    content, so the file or directory at this path never changes."""
+    return os.path.join(artifact_store_path(project_pk), "objects", name)
+
+
+def hash_file(path, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest
+
+
+def hash_path(path):
+    """The sha256 hexdigest of a file, or of a feature matrix directory.
+
+    The arrays of a feature matrix are too large to read on every publish. Every
+    write of a matrix gives its meta.json a new version, so the meta.json and the
+    names and sizes of the other files identify the matrix instead. The build
+    metrics are added to the meta.json after the write, so they are left out.
+    """
+    if not os.path.isdir(path):
+        return hash_file(path).hexdigest()
+
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        digest.update(name.encode() + b"\0")
+        if name == "meta.json":
+            with open(os.path.join(path, name)) as meta_file:
+                meta = json.load(meta_file)
+            meta.pop("build_metrics", None)
+            digest.update(json.dumps(meta, sort_keys=True).encode())
+        else:
+            digest.update(str(os.path.getsize(os.path.join(path, name))).encode())
+    return digest.hexdigest()
+
+
+def link_or_copy(source, destination):
+    """Hard link source to destination, or copy it where linking is not possible.
+
+    Artifacts are always written to a new file and moved into place, never changed
+    in place, so a hard link to one cannot change under the store.
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def store_artifact(project_pk, path):
+    """Add the file or directory at path to the artifact store of the project.
+
+    Nothing is written if an artifact with the same content is already stored.
+    Otherwise it is linked into a temporary path and renamed into place, so the
+    store never holds a partly written artifact.
+
+    Args:
+        project_pk: The pk of the project
+        path: the file or directory to store
+    Returns:
+        name: the name of the artifact in the store, see object_path
+    """
+    name = hash_path(path) + os.path.splitext(path)[1]
+    destination = object_path(project_pk, name)
+    if os.path.exists(destination):
+        return name
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temp_path = destination + ".tmp-" + uuid.uuid4().hex
+    if os.path.isdir(path):
+        os.makedirs(temp_path)
+        for file_name in os.listdir(path):
+            link_or_copy(
+                os.path.join(path, file_name), os.path.join(temp_path, file_name)
+            )
+    else:
+        link_or_copy(path, temp_path)
+
+    try:
+        os.rename(temp_path, destination)
+    except OSError:
+        # another process stored the same artifact first
+        if not os.path.exists(destination):
+            raise
+        remove_path(temp_path)
+    return name
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def write_json_atomically(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp-" + uuid.uuid4().hex
+    with open(temp_path, "w") as json_file:
+        json.dump(obj, json_file)
+    os.replace(temp_path, path)
+
+
+def current_features_path(project_pk):
+    return os.path.join(artifact_store_path(project_pk), "features.json")
+
+
+def load_current_features(project_pk):
+    """The stored feature matrix and vectorizer most recently published for the
+    project, or None if nothing was published yet."""
+    fpath = current_features_path(project_pk)
+    if not os.path.isfile(fpath):
+        return None
+    with open(fpath) as json_file:
+        return json.load(json_file)
+
+
+def publish_features(project_pk, feature_path, version, vectorizer_path=None):
+    """Store a feature matrix and its vectorizer and make them the current features
+    of the project.
+
+    Args:
+        project_pk: The pk of the project
+        feature_path: the directory of the feature matrix
+        version: the version of the feature matrix
+        vectorizer_path: optional path of the pickled vectorizer
+    Returns:
+        a dict with the stored names of the features and vectorizer
+    """
+    current = {
+        "features": store_artifact(project_pk, feature_path),
+        "vectorizer": (
+            store_artifact(project_pk, vectorizer_path) if vectorizer_path else None
+        ),
+        "version": version,
+    }
+    write_json_atomically(current_features_path(project_pk), current)
+    return current
+
+
+def collect_garbage(project_pk, keep):
+    """Delete the stored artifacts of a project that are not in keep.
+
+    Artifacts younger than ARTIFACT_GC_GRACE_SECONDS are kept as well, since a
+    running task may have stored them without recording them anywhere yet.
+
+    Args:
+        project_pk: The pk of the project
+        keep: names of the artifacts that are still referenced
+    Returns:
+        the names of the deleted artifacts
+    """
+    objects_path = os.path.join(artifact_store_path(project_pk), "objects")
+    if not os.path.isdir(objects_path):
+        return []
+
+    cutoff = time.time() - settings.ARTIFACT_GC_GRACE_SECONDS
+    removed = []
+    for name in os.listdir(objects_path):
+        path = os.path.join(objects_path, name)
+        if name in keep or ".tmp-" in name or os.stat(path).st_mtime > cutoff:
+            continue
+        remove_path(path)
+        removed.append(name)
+    return removed
@@ -0,0 +1,258 @@
+import datetime
+import gc
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from core.models import Label, Profile
+from core.utils.util import add_data, create_profile, create_project, md5_hash
+from core.utils.utils_artifacts import artifact_store_path, remove_path
+from core.utils.utils_cache import artifact_cache
+from core.utils.utils_model import (
+    predict_data,
+    refit_tfidf_matrix,
+    tfidf_matrix_path,
+    tfidf_vectorizer_path,
+    train_and_save_model,
+)
+from core.utils.utils_queue import add_queue, fill_queue, find_queue_length
+from core.utils.utils_redis import redis_serialize_queue, redis_serialize_set
+from core.utils.utils_resources import measure_stage
+
+BENCHMARK_USERNAME = "benchmark"
+BENCHMARK_PROJECT_PREFIX = "benchmark-"
+
+# Named project sizes that can be passed to the benchmark_pipeline command
+BENCHMARK_SIZES = {"10k": 10000, "100k": 100000, "1m": 1000000}
+
+BENCHMARK_CLASSIFIERS = ["logistic regression", "svm", "random forest", "gnb"]
+
+# The synthetic text is generated this many rows at a time
+SYNTHETIC_CHUNK_SIZE = 100000
+
+
+def synthetic_dataframe(
+    num_rows, num_labels, text_length, num_labeled, vocabulary_size=5000, seed=0
+):
+    """Generate the data of a synthetic project.
+
+    The words of each text are drawn from a Zipf distribution over a shared
+    vocabulary, with a third of them drawn from words that belong to the label of
+    the row instead, so the classifiers have something to learn.
+
+    Args:
+        num_rows: the number of data
+        num_labels: the number of labels
+        text_length: the number of words in each text
+        num_labeled: the number of data that are given their label
+        vocabulary_size: the number of distinct words
+        seed: seed of the random number generator
+    Returns:
+        a dataframe with the columns Text, Label, ID and id_hash, as used by add_data
+    """
+    rng = np.random.default_rng(seed)
+    words = np.array(["w" + str(i) for i in range(vocabulary_size)])
+    label_words = np.array_split(rng.permutation(vocabulary_size), num_labels)
+    row_labels = rng.integers(num_labels, size=num_rows)
+
+    texts = []
+    for start in range(0, num_rows, SYNTHETIC_CHUNK_SIZE):
+        chunk_labels = row_labels[start : start + SYNTHETIC_CHUNK_SIZE]
+        shape = (len(chunk_labels), text_length)
+        word_ids = (rng.zipf(1.3, size=shape) - 1) % vocabulary_size
+        from_label = rng.random(shape) < 1 / 3
+        for label in range(num_labels):
+            rows = from_label & (chunk_labels == label)[:, np.newaxis]
+            word_ids[rows] = rng.choice(label_words[label], size=rows.sum())
+        texts.extend(" ".join(row) for row in words[word_ids])
+
+    label_names = np.array(["label " + str(i) for i in range(num_labels)])
+    df = pd.DataFrame({"Text": texts, "ID": np.arange(num_rows).astype(str)})
+    df["Label"] = None
+    labeled = rng.choice(num_rows, size=min(num_labeled, num_rows), replace=False)
+    df.loc[labeled, "Label"] = label_names[row_labels[labeled]]
+    df["id_hash"] = df["ID"].apply(md5_hash)
+    return df
+
+
+def create_benchmark_project(df, num_labels, classifier):
+    """Create a project owned by the benchmark user and add the synthetic data.
+
+    Returns:
+        the Project object
+    """
+    profile = Profile.objects.filter(user__username=BENCHMARK_USERNAME).first()
+    if profile is None:
+        profile = create_profile(
+            BENCHMARK_USERNAME, "benchmark", BENCHMARK_USERNAME + "@smart.org"
+        )
+
+    project = create_project(
+        BENCHMARK_PROJECT_PREFIX + classifier + "-" + str(len(df)),
+        profile,
+        classifier=classifier,
+    )
+    for i in range(num_labels):
+        Label.objects.create(name="label " + str(i), project=project)
+    add_data(project, df.copy())
+    return project
+
+
+def run_pipeline_benchmark(project):
+    """Run the machine learning pipeline of a project one stage at a time and
+    measure each stage.
+
+    The stages are fitting the tf-idf matrix (create_tfidf_matrix), training the
+    model, predicting all of the unlabeled data in one shard and filling the
+    queues by least confident.
+
+    Returns:
+        a dict of stage name to the stats of measure_stage
+    """
+    stages = {}
+    with measure_stage() as stages["features"]:
+        refit_tfidf_matrix(project.pk)
+
+    with measure_stage() as stages["train"]:
+        model = train_and_save_model(project)
+    project.refresh_from_db()
+
+    with measure_stage() as stages["predict"]:
+        stages["predict"]["predictions"] = predict_data(project, model)
+
+    queue = add_queue(project, find_queue_length(project.batch_size, 1))
+    irr_queue = add_queue(project, 2000000, type="irr")
+    with measure_stage() as stages["fill_queue"]:
+        fill_queue(
+            queue,
+            orderby="least confident",
+            irr_queue=irr_queue,
+            irr_percent=project.percentage_irr,
+            batch_size=project.batch_size,
+        )
+    return stages
+
+
+def delete_benchmark_project(project):
+    """Delete a benchmark project with its files and redis queues."""
+    for queue in project.queue_set.all():
+        settings.REDIS.delete(redis_serialize_queue(queue), redis_serialize_set(queue))
+    for model in project.model_set.all():
+        remove_path(model.pickle_path)
+    remove_path(tfidf_matrix_path(project.pk))
+    remove_path(tfidf_vectorizer_path(project.pk))
+    remove_path(artifact_store_path(project.pk))
+    project.delete()
+
+
+def run_benchmarks(
+    sizes, classifiers, num_labels, text_length, num_labeled, keep=False, log=print
+):
+    """Benchmark the pipeline for every combination of project size and classifier.
+
+    The peak memory of a stage is measured from the start of the stage, see
+    measure_stage. The artifacts cached by earlier runs are dropped before each
+    run, so the memory a stage starts from does not depend on the runs before it.
+
+    Args:
+        sizes: numbers of data in the synthetic projects
+        classifiers: the classifiers to benchmark, see Project.classifier
+        num_labels: the number of labels of each project
+        text_length: the number of words in each text
+        num_labeled: the number of labeled data in each project
+        keep: keep the benchmark projects instead of deleting them
+        log: function that progress messages are passed to
+    Returns:
+        a dict of results that can be saved as json and compared with
+        compare_benchmarks
+    """
+    runs = []
+    for num_rows in sizes:
+        df = synthetic_dataframe(num_rows, num_labels, text_length, num_labeled)
+        for classifier in classifiers:
+            log("Benchmarking {} with {} rows".format(classifier, num_rows))
+            artifact_cache.clear()
+            gc.collect()
+            with measure_stage() as load_stats:
+                project = create_benchmark_project(df, num_labels, classifier)
+            try:
+                stages = {"load": load_stats}
+                stages.update(run_pipeline_benchmark(project))
+            finally:
+                if not keep:
+                    delete_benchmark_project(project)
+            for stage, stats in stages.items():
+                log(
+                    "  {}: {:.2f}s wall, {:.2f}s cpu, {:.0f} MB peak".format(
+                        stage,
+                        stats["wall_seconds"],
+                        stats["cpu_seconds"],
+                        stats["peak_rss_mb"],
+                    )
+                )
+            runs.append(
+                {
+                    "rows": num_rows,
+                    "classifier": classifier,
+                    "stages": stages,
+                }
+            )
+
+    return {
+        "created": datetime.datetime.now().isoformat(),
+        "num_labels": num_labels,
+        "text_length": text_length,
+        "num_labeled": num_labeled,
+        "runs": runs,
+    }
+
+
+def compare_benchmarks(results, baseline, tolerance):
+    """Find the stages that got slower or used more memory than in a baseline.
+
+    Runs are matched by their number of rows and classifier. Runs that are not in
+    the baseline are skipped.
+
+    Args:
+        results: the results of run_benchmarks
+        baseline: earlier results of run_benchmarks
+        tolerance: the fraction a value may grow by before it counts, ex: 0.2
+    Returns:
+        a list of messages, one for each regression
+    """
+    baseline_runs = {
+        (run["rows"], run["classifier"]): run["stages"] for run in baseline["runs"]
+    }
+    regressions = []
+    for run in results["runs"]:
+        baseline_stages = baseline_runs.get((run["rows"], run["classifier"]))
+        if baseline_stages is None:
+            continue
+        for stage, stats in run["stages"].items():
+            if stage not in baseline_stages:
+                continue
+            for metric in ["wall_seconds", "peak_rss_mb"]:
+                old = baseline_stages[stage][metric]
+                new = stats[metric]
+                if new > old * (1 + tolerance):
+                    regressions.append(
+                        "{} {} rows {} {}: {:.2f} -> {:.2f}".format(
+                            run["classifier"], run["rows"], stage, metric, old, new
+                        )
+                    )
+    return regressions
+
+
+def save_benchmarks(results, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+
+def load_benchmarks(path):
+    with open(path) as results_file:
+        return json.load(results_file)
@@ -0,0 +1,151 @@
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from core.utils.utils_redis import redis_serialize_artifact_cache
+
+# How often the statistics of a cache are written to redis while it only has hits,
+# and how long they are kept after the process stops writing them
+STATS_PUBLISH_SECONDS = 10
+STATS_TTL_SECONDS = 24 * 60 * 60
+
+
+class ArtifactCache:
+    """A least recently used cache of loaded model artifacts for one process.
+
+    Entries are keyed by (project_pk, kind, version). The version changes whenever
+    the artifact is rewritten, so a stale entry is never returned even if another
+    process wrote the new artifact; invalidate only frees the memory sooner. Several
+    versions of an artifact can be cached at once, ex: while the previous model is
+    cross validated and the new one predicts. The total size of the entries is kept
+    under settings.ARTIFACT_CACHE_BYTES by evicting the least recently used entries.
+
+    With publish_stats the statistics of the cache are written to redis, so they can
+    be read from any process, see get_artifact_cache_stats.
+    """
+
+    def __init__(self, publish_stats=False):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.publish_stats = publish_stats
+        self.published_at = None
+
+    def get_or_load(self, project_pk, kind, version, load, size_of):
+        """Return the cached artifact, or load it and add it to the cache.
+
+        Args:
+            project_pk: the project the artifact belongs to
+            kind: the type of artifact, ex: "features" or "classifier"
+            version: changes whenever the artifact is rewritten
+            load: function that loads the artifact
+            size_of: function that returns the memory the artifact holds in bytes
+        Returns:
+            the artifact
+        """
+        key = (project_pk, kind, version)
+        with self.lock:
+            hit = key in self.entries
+            if hit:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                artifact = self.entries[key][0]
+            else:
+                self.misses += 1
+        if hit:
+            self.publish(changed=False)
+            return artifact
+
+        artifact = load()
+        size = size_of(artifact)
+        budget = settings.ARTIFACT_CACHE_BYTES
+        if size <= budget:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = (artifact, size)
+                    self.size += size
+                while self.size > budget:
+                    _, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.size -= evicted_size
+                    self.evictions += 1
+        self.publish()
+        return artifact
+
+    def invalidate(self, project_pk, kind=None):
+        """Drop the artifacts of a project, or only those of the given kind."""
+        with self.lock:
+            self.remove(lambda k: k[0] == project_pk and (kind is None or k[1] == kind))
+        self.publish()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        self.publish()
+
+    def remove(self, matches):
+        """Remove every entry whose key matches. The lock must be held."""
+        for key in [key for key in self.entries if matches(key)]:
+            self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "size": self.size,
+                "budget": settings.ARTIFACT_CACHE_BYTES,
+            }
+
+    def publish(self, changed=True):
+        """Write the statistics to the redis hash of this process. Hits alone only
+        write them every STATS_PUBLISH_SECONDS."""
+        if not self.publish_stats:
+            return
+        now = time.monotonic()
+        if (
+            not changed
+            and self.published_at is not None
+            and now - self.published_at < STATS_PUBLISH_SECONDS
+        ):
+            return
+        self.published_at = now
+        key = redis_serialize_artifact_cache(
+            socket.gethostname() + ":" + str(os.getpid())
+        )
+        pipeline = settings.REDIS.pipeline(transaction=False)
+        pipeline.hset(key, mapping=self.stats())
+        pipeline.expire(key, STATS_TTL_SECONDS)
+        pipeline.execute()
+
+
+def get_artifact_cache_stats():
+    """The statistics of the artifact cache of every process that used it recently.
+
+    Returns:
+        a list of the stats of each cache, see ArtifactCache.stats, with the
+        "process" that holds it as host:pid
+    """
+    caches = []
+    pattern = redis_serialize_artifact_cache("*")
+    for key in sorted(settings.REDIS.scan_iter(pattern)):
+        stats = {
+            field.decode(): int(value)
+            for field, value in settings.REDIS.hgetall(key).items()
+        }
+        if stats:
+            caches.append({"process": key.decode().split(":", 1)[1], **stats})
+    return caches
+
+
+# Shared by everything that loads artifacts in this process
+artifact_cache = ArtifactCache(publish_stats=True)
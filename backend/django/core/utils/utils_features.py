@@ -0,0 +1,477 @@
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# The arrays that make up a CSR matrix, each stored in its own .npy file
+CSR_ARRAYS = ("data", "indices", "indptr")
+
+# Number of array elements copied at a time when appending to a stored matrix
+APPEND_CHUNK_SIZE = 10000000
+
+
+class FeatureMatrix:
+    """A CSR feature matrix stored on disk as raw numpy arrays.
+
+    The data, indices and indptr arrays are memory-mapped, so only the rows
+    requested through ``rows`` are read from disk. Each row is identified by the
+    upload_id_hash of the datum it was built from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        self.shape = tuple(self.meta["shape"])
+        self.version = self.meta["version"]
+        self.load_arrays()
+        self.row_key_array = np.load(os.path.join(path, "row_keys.npy"))
+        self.row_index = pd.Index(self.row_key_array)
+
+    def load_arrays(self):
+        self.data, self.indices, self.indptr = [
+            np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+            for name in CSR_ARRAYS
+        ]
+
+    def arrays(self):
+        return [self.data, self.indices, self.indptr]
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        """The size of the stored arrays."""
+        return sum(array.nbytes for array in self.arrays() + [self.row_key_array])
+
+    @property
+    def resident_nbytes(self):
+        """The memory the matrix holds itself. The memory-mapped arrays are left out,
+        their pages are in the page cache, which the kernel shares and frees."""
+        return self.row_key_array.nbytes + self.row_index.memory_usage(deep=True)
+
+    def row_keys(self):
+        """The upload_id_hash of every row, in row order."""
+        return [key.decode() for key in self.row_index]
+
+    def to_csr(self):
+        """A CSR matrix over the memory-mapped arrays; nothing is copied."""
+        return sparse.csr_matrix(
+            (self.data, self.indices, self.indptr), shape=self.shape, copy=False
+        )
+
+    def row_positions(self, keys):
+        """Return the row number of each upload_id_hash in keys."""
+        positions = self.row_index.get_indexer(encode_row_keys(keys))
+        if (positions < 0).any():
+            raise ValueError(
+                "Feature matrix at "
+                + self.path
+                + " is missing rows for "
+                + str(int((positions < 0).sum()))
+                + " data"
+            )
+        return positions
+
+    def has_rows(self, keys):
+        """Return whether there is a row for each upload_id_hash in keys."""
+        return self.row_index.get_indexer(encode_row_keys(keys)) >= 0
+
+    def rows(self, keys):
+        """Return the rows for the given upload_id_hashes as a CSR matrix, in the
+        order the keys were given."""
+        return slice_csr_rows(
+            self.data, self.indices, self.indptr, self.row_positions(keys), self.shape
+        )
+
+
+class DenseFeatureMatrix(FeatureMatrix):
+    """A dense feature matrix, such as document embeddings, stored on disk as one
+    memory-mapped float16 array with a row per datum."""
+
+    def load_arrays(self):
+        self.values = np.load(os.path.join(self.path, "values.npy"), mmap_mode="r")
+
+    def arrays(self):
+        return [self.values]
+
+    def to_csr(self):
+        return sparse.csr_matrix(np.asarray(self.values, dtype=np.float32))
+
+    def rows(self, keys):
+        """Return the rows for the given upload_id_hashes as a float32 array, in the
+        order the keys were given."""
+        return np.asarray(self.values[self.row_positions(keys)], dtype=np.float32)
+
+
+def encode_row_keys(keys):
+    """Row keys are md5 hexdigests, so they are stored as fixed-width bytes rather
+    than unicode to keep the row index small."""
+    return np.asarray(list(keys), dtype="S")
+
+
+def slice_csr_rows(data, indices, indptr, positions, shape):
+    """Gather the given rows out of (possibly memory-mapped) CSR arrays.
+
+    Only the stored values belonging to the requested rows are read, so the cost is
+    proportional to the size of the result rather than the whole matrix.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    starts = np.asarray(indptr[positions], dtype=np.int64)
+    lengths = np.asarray(indptr[positions + 1], dtype=np.int64) - starts
+
+    new_indptr = np.zeros(len(positions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_indptr[1:])
+    # position of every stored value of the requested rows in the full arrays
+    take = np.repeat(starts - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+
+    return sparse.csr_matrix(
+        (data[take], indices[take], new_indptr), shape=(len(positions), shape[1])
+    )
+
+
+def save_feature_matrix(matrix, row_keys, path, meta=None):
+    """Write a sparse matrix and its row keys to the directory at path.
+
+    Args:
+        matrix: scipy sparse matrix, one row per datum
+        row_keys: upload_id_hash of the datum behind each row, in row order
+        path: directory to write the arrays to
+        meta: optional dict of extra values to keep in meta.json
+    Returns:
+        path
+    """
+    matrix = sparse.csr_matrix(matrix)
+    row_keys = encode_row_keys(row_keys)
+    check_row_count(matrix, row_keys)
+
+    temp_path = temporary_directory(path)
+    for name in CSR_ARRAYS:
+        np.save(os.path.join(temp_path, name + ".npy"), getattr(matrix, name))
+    np.save(os.path.join(temp_path, "row_keys.npy"), row_keys)
+    write_meta(temp_path, matrix.shape, meta)
+
+    replace_directory(temp_path, path)
+    return path
+
+
+def append_feature_matrix(feature_matrix, matrix, row_keys, meta=None):
+    """Add rows to the end of a stored feature matrix.
+
+    The existing arrays are copied chunk by chunk into new files next to the new
+    rows, so the stored matrix is never loaded into memory as a whole.
+
+    Args:
+        feature_matrix: the FeatureMatrix to add rows to
+        matrix: scipy sparse matrix with the new rows
+        row_keys: upload_id_hash of the datum behind each new row
+        meta: optional dict of values to update in meta.json
+    Returns:
+        the path of the feature matrix
+    """
+    matrix = sparse.csr_matrix(matrix)
+    row_keys = encode_row_keys(row_keys)
+    check_row_count(matrix, row_keys)
+    if matrix.shape[1] != feature_matrix.shape[1]:
+        raise ValueError(
+            "Cannot append rows with "
+            + str(matrix.shape[1])
+            + " features to a feature matrix with "
+            + str(feature_matrix.shape[1])
+            + " features"
+        )
+
+    old_rows, old_nnz = feature_matrix.shape[0], feature_matrix.indptr[-1]
+    new_arrays = {
+        "data": (feature_matrix.data, matrix.data),
+        "indices": (feature_matrix.indices, matrix.indices),
+        # the new rows start after the last stored value of the existing ones
+        "indptr": (feature_matrix.indptr, matrix.indptr[1:] + old_nnz),
+        "row_keys": (feature_matrix.row_key_array, row_keys),
+    }
+
+    temp_path = temporary_directory(feature_matrix.path)
+    for name, (old, new) in new_arrays.items():
+        dtype = np.result_type(old.dtype, new.dtype)
+        out = np.lib.format.open_memmap(
+            os.path.join(temp_path, name + ".npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(len(old) + len(new),),
+        )
+        for start in range(0, len(old), APPEND_CHUNK_SIZE):
+            stop = min(start + APPEND_CHUNK_SIZE, len(old))
+            out[start:stop] = old[start:stop]
+        out[len(old) :] = new
+        out.flush()
+        del out
+
+    new_meta = {
+        key: value
+        for key, value in feature_matrix.meta.items()
+        if key not in ["shape", "version"]
+    }
+    new_meta.update(meta or {})
+    write_meta(temp_path, (old_rows + matrix.shape[0], matrix.shape[1]), new_meta)
+
+    replace_directory(temp_path, feature_matrix.path)
+    return feature_matrix.path
+
+
+class FeatureMatrixWriter:
+    """Build a feature matrix on disk from chunks of rows.
+
+    The data and indices of each chunk are written straight to disk, so memory use
+    depends on the chunk size and not on the size of the finished matrix. Call close
+    once every chunk has been written to put the matrix in place at path.
+    """
+
+    def __init__(self, path, n_features):
+        self.path = path
+        self.n_features = n_features
+        self.temp_path = temporary_directory(path)
+        self.files = {
+            name: open(os.path.join(self.temp_path, name + ".bin"), "wb")
+            for name in ["data", "indices"]
+        }
+        self.dtypes = {}
+        self.nnz = 0
+        self.row_lengths = []
+        self.row_keys = []
+
+    def write(self, matrix, row_keys):
+        """Add a chunk of rows to the end of the matrix."""
+        matrix = sparse.csr_matrix(matrix)
+        row_keys = encode_row_keys(row_keys)
+        check_row_count(matrix, row_keys)
+
+        for name, array in [("data", matrix.data), ("indices", matrix.indices)]:
+            dtype = self.dtypes.setdefault(name, array.dtype)
+            self.files[name].write(array.astype(dtype, copy=False).tobytes())
+        self.nnz += matrix.nnz
+        self.row_lengths.append(np.diff(matrix.indptr))
+        self.row_keys.append(row_keys)
+
+    def close(self, meta=None, column_weights=None, normalize=False):
+        """Write the arrays of the finished matrix and move it into place.
+
+        Args:
+            meta: optional dict of extra values to keep in meta.json
+            column_weights: optional array to multiply each column by
+            normalize: scale each row to unit l2 norm after weighting
+        Returns:
+            the path of the feature matrix
+        """
+        for data_file in self.files.values():
+            data_file.close()
+
+        row_lengths = np.concatenate(self.row_lengths or [np.zeros(0, np.int64)])
+        indptr = np.zeros(len(row_lengths) + 1, dtype=np.int64)
+        np.cumsum(row_lengths, out=indptr[1:])
+        row_keys = np.concatenate(self.row_keys or [encode_row_keys([])])
+        np.save(os.path.join(self.temp_path, "indptr.npy"), indptr)
+        np.save(os.path.join(self.temp_path, "row_keys.npy"), row_keys)
+
+        for name, default_dtype in [("data", np.float64), ("indices", np.int32)]:
+            bin_path = os.path.join(self.temp_path, name + ".bin")
+            out = np.lib.format.open_memmap(
+                os.path.join(self.temp_path, name + ".npy"),
+                mode="w+",
+                dtype=self.dtypes.get(name, default_dtype),
+                shape=(self.nnz,),
+            )
+            if self.nnz:
+                out[:] = np.memmap(bin_path, dtype=out.dtype, mode="r")
+            out.flush()
+            del out
+            os.remove(bin_path)
+
+        if column_weights is not None or normalize:
+            self.reweight(indptr, row_lengths, column_weights, normalize)
+
+        write_meta(self.temp_path, (len(row_keys), self.n_features), meta)
+        replace_directory(self.temp_path, self.path)
+        return self.path
+
+    def reweight(self, indptr, row_lengths, column_weights, normalize):
+        """Weight the columns and normalize the rows of the written data in place,
+        a block of whole rows at a time."""
+        data = np.load(os.path.join(self.temp_path, "data.npy"), mmap_mode="r+")
+        indices = np.load(os.path.join(self.temp_path, "indices.npy"), mmap_mode="r")
+
+        mean_row_length = max(1, self.nnz // max(1, len(row_lengths)))
+        row_block = max(1, APPEND_CHUNK_SIZE // mean_row_length)
+        for first in range(0, len(row_lengths), row_block):
+            last = min(first + row_block, len(row_lengths))
+            start, stop = indptr[first], indptr[last]
+            block = np.array(data[start:stop])
+            if column_weights is not None:
+                block *= column_weights[indices[start:stop]]
+            if normalize:
+                lengths = row_lengths[first:last]
+                rows = np.repeat(np.arange(last - first), lengths)
+                norms = np.sqrt(
+                    np.bincount(rows, weights=block**2, minlength=last - first)
+                )
+                norms[norms == 0] = 1
+                block /= norms[rows]
+            data[start:stop] = block
+
+        data.flush()
+        del data
+
+
+def iterate_in_chunks(iterable, size):
+    """Yield lists of up to size items from iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def check_row_count(matrix, row_keys):
+    if matrix.shape[0] != len(row_keys):
+        raise ValueError(
+            "Feature matrix has "
+            + str(matrix.shape[0])
+            + " rows but "
+            + str(len(row_keys))
+            + " row keys were given"
+        )
+
+
+def write_meta(path, shape, meta=None):
+    """Write meta.json, which marks the arrays in path as complete. Every write gets
+    a new version so anything cached from the old arrays can be told apart."""
+    meta = dict(meta or {})
+    meta.update({"shape": [int(n) for n in shape], "version": uuid.uuid4().hex})
+    with open(os.path.join(path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+
+
+def update_meta(path, **fields):
+    """Add fields to the meta.json of a written feature matrix, keeping its version.
+
+    The file is replaced rather than rewritten, since it may be hard linked into the
+    artifact store.
+    """
+    meta_path = os.path.join(path, "meta.json")
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    meta.update(fields)
+    temp_path = meta_path + ".tmp-" + uuid.uuid4().hex
+    with open(temp_path, "w") as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(temp_path, meta_path)
+
+
+def temporary_directory(path):
+    """A new empty directory next to path to write a feature matrix into."""
+    temp_path = path + ".tmp-" + uuid.uuid4().hex
+    os.makedirs(temp_path)
+    return temp_path
+
+
+def replace_directory(temp_path, path):
+    """Move a fully written feature matrix into place.
+
+    The old directory is renamed out of the way rather than overwritten, so
+    processes that still have its arrays memory-mapped keep reading the old files.
+    """
+    old_path = None
+    if os.path.isdir(path):
+        old_path = path + ".old-" + uuid.uuid4().hex
+        os.rename(path, old_path)
+    os.rename(temp_path, path)
+    if old_path:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def write_dense_feature_matrix(
+    path, row_keys, batches, n_columns, previous=None, meta=None
+):
+    """Write a dense float16 feature matrix to the directory at path.
+
+    The rows of previous, if given, are copied first and the rows from batches are
+    written after them one batch at a time, so neither has to fit in memory.
+
+    Args:
+        path: directory to write the matrix to
+        row_keys: upload_id_hash of the datum behind each new row
+        batches: iterable of 2d arrays, together holding one row per row key
+        n_columns: the number of columns of every row
+        previous: optional DenseFeatureMatrix whose rows are kept
+        meta: optional dict of extra values to keep in meta.json
+    Returns:
+        path
+    """
+    row_keys = encode_row_keys(row_keys)
+    old_rows = len(previous) if previous is not None else 0
+    shape = (old_rows + len(row_keys), n_columns)
+
+    temp_path = temporary_directory(path)
+    try:
+        values = np.lib.format.open_memmap(
+            os.path.join(temp_path, "values.npy"),
+            mode="w+",
+            dtype=np.float16,
+            shape=shape,
+        )
+        row_block = max(1, APPEND_CHUNK_SIZE // max(1, n_columns))
+        for start in range(0, old_rows, row_block):
+            stop = min(start + row_block, old_rows)
+            values[start:stop] = previous.values[start:stop]
+
+        position = old_rows
+        for batch in batches:
+            values[position : position + len(batch)] = batch
+            position += len(batch)
+        if position != shape[0]:
+            raise ValueError(
+                "Got "
+                + str(position - old_rows)
+                + " rows for "
+                + str(len(row_keys))
+                + " row keys"
+            )
+        values.flush()
+        del values
+    except Exception:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+
+    if previous is not None:
+        row_keys = np.concatenate([previous.row_key_array, row_keys])
+    np.save(os.path.join(temp_path, "row_keys.npy"), row_keys)
+    write_meta(temp_path, shape, dict(meta or {}, format="dense"))
+
+    replace_directory(temp_path, path)
+    return path
+
+
+def load_feature_matrix(path):
+    """Open the feature matrix at path without reading its arrays into memory."""
+    with open(os.path.join(path, "meta.json")) as meta_file:
+        matrix_format = json.load(meta_file).get("format", "csr")
+    if matrix_format == "dense":
+        return DenseFeatureMatrix(path)
+    return FeatureMatrix(path)
+
+
+def read_feature_matrix_version(path):
+    """The version of the feature matrix at path, without opening its arrays."""
+    with open(os.path.join(path, "meta.json")) as meta_file:
+        return json.load(meta_file)["version"]
+
+
+def feature_matrix_exists(path):
+    return os.path.isfile(os.path.join(path, "meta.json"))
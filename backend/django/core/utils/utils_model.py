@@ -1,19 +1,36 @@
+import hashlib
+import json
+import logging
 import math
 import os
 import pickle
+import time
+import uuid
+from io import StringIO
 
+import billiard
 import joblib
 import numpy as np
 import pandas as pd
 import statsmodels.stats.inter_rater as raters
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
 from scipy import sparse
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.linear_model import LogisticRegression
+from sklearn.feature_extraction.text import (
+    CountVectorizer,
+    HashingVectorizer,
+    TfidfTransformer,
+    TfidfVectorizer,
+)
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
-from sklearn.model_selection import cross_val_predict
-from sklearn.naive_bayes import GaussianNB
+from sklearn.model_selection import cross_val_predict, train_test_split
+from sklearn.naive_bayes import GaussianNB, MultinomialNB
+from sklearn.pipeline import Pipeline
 from sklearn.svm import SVC
 
 from core import tasks
@@ -21,13 +38,57 @@ from core.models import (
     Data,
     DataLabel,
     DataPrediction,
+    DataPredictionSummary,
     DataUncertainty,
     IRRLog,
     Label,
     Model,
+    Project,
     RecycleBin,
+    TrainingSet,
+)
+from core.utils.utils_artifacts import (
+    collect_garbage,
+    link_or_copy,
+    load_current_features,
+    object_path,
+    publish_features,
+    store_artifact,
+)
+from core.utils.utils_cache import artifact_cache
+from core.utils.utils_features import (
+    FeatureMatrixWriter,
+    append_feature_matrix,
+    encode_row_keys,
+    feature_matrix_exists,
+    iterate_in_chunks,
+    load_feature_matrix,
+    read_feature_matrix_version,
+    save_feature_matrix,
+    update_meta,
+    write_dense_feature_matrix,
 )
-from core.utils.utils_queue import fill_queue, handle_empty_queue
+from core.utils.utils_queue import (
+    generate_sql_for_random_sample,
+    handle_empty_queue,
+    schedule_queue_refill,
+)
+from core.utils.utils_redis import acquire_task_lock
+from core.utils.utils_resources import measure_stage
+
+logger = logging.getLogger(__name__)
+
+# Classifiers that can learn new labels with partial_fit instead of being trained on
+# all labels every round
+INCREMENTAL_CLASSIFIERS = ["sgd", "multinomial nb"]
+
+# How the data of the previous candidate pool are ranked for each learning method,
+# most uncertain first. Random sampling ranks them by their random_key
+POOL_ORDERBY = {
+    "least confident": "-least_confident",
+    "margin sampling": "margin_sampling",
+    "entropy": "-entropy",
+}
 
 
 def cohens_kappa(project):
@@ -159,8 +220,7 @@ def least_confident(probs):
     if not isinstance(probs, np.ndarray):
         raise ValueError("Probs should be a numpy array")
 
-    max_prob = max(probs)
-    return 1 - max_prob
+    return uncertainty_scores(probs[np.newaxis])[0][0]
 
 
 def margin_sampling(probs):
@@ -177,9 +237,7 @@ def margin_sampling(probs):
     if not isinstance(probs, np.ndarray):
         raise ValueError("Probs should be a numpy array")
 
-    # https://stackoverflow.com/questions/26984414/efficiently-sorting-a-numpy-array-in-descending-order#answer-26984520
-    probs[::-1].sort()
-    return probs[0] - probs[1]
+    return uncertainty_scores(probs[np.newaxis])[1][0]
 
 
 def entropy(probs):
@@ -194,13 +252,87 @@ def entropy(probs):
     if not isinstance(probs, np.ndarray):
         raise ValueError("Probs should be a numpy array")
 
-    non_zero_probs = (p for p in probs if p > 0)
+    return uncertainty_scores(probs[np.newaxis])[2][0]
+
+
+def uncertainty_scores(probs):
+    """The least confident, margin sampling and entropy scores of every row of a
+    matrix of predicted probabilities, see the functions of the same names.
+
+    Args:
+        probs: numpy array with a row of predicted probabilities for each datum
+    Returns:
+        least_confident, margin_sampling, entropy: numpy arrays with a score per row
+    """
+    if not isinstance(probs, np.ndarray):
+        raise ValueError("Probs should be a numpy array")
+
+    # each row sorted from the highest to the lowest probability
+    sorted_probs = -np.sort(-probs.astype(np.float64), axis=1)
+
+    least_confident = 1 - sorted_probs[:, 0]
+    margin_sampling = sorted_probs[:, 0] - sorted_probs[:, 1]
+    # zero probabilities add nothing to the entropy, log10(1) keeps them at zero
+    logs = np.log10(np.where(sorted_probs > 0, sorted_probs, 1))
+    entropy = -(sorted_probs * logs).sum(axis=1)
+
+    return least_confident, margin_sampling, entropy
+
 
-    total = 0
-    for p in non_zero_probs:
-        total += p * math.log10(p)
+def create_uncertainty_objects(data_ids, model, probs):
+    """Insert the DataUncertainty objects of a model into the database.
+
+    Args:
+        data_ids: the pks of the predicted data
+        model: Model object
+        probs: numpy array with the predicted probabilities of each datum
+    """
+    least_confident, margin_sampling, entropy = uncertainty_scores(probs)
+    df = pd.DataFrame(
+        {
+            "data_id": data_ids,
+            "model_id": model.pk,
+            "least_confident": least_confident,
+            "margin_sampling": margin_sampling,
+            "entropy": entropy,
+        }
+    )
+    copy_dataframe(df, DataUncertainty)
 
-    return -total
+
+def create_prediction_objects(data_ids, model, label_ids, probs):
+    """Insert a DataPrediction object for each datum and label into the database.
+
+    Args:
+        data_ids: the pks of the predicted data
+        model: Model object
+        label_ids: the pks of the labels, in the order of the columns of probs
+        probs: numpy array with the predicted probabilities of each datum
+    """
+    df = pd.DataFrame(
+        {
+            "data_id": np.repeat(data_ids, len(label_ids)),
+            "model_id": model.pk,
+            "label_id": np.tile(label_ids, len(data_ids)),
+            "predicted_probability": probs.ravel(),
+        }
+    )
+    copy_dataframe(df, DataPrediction)
+
+
+def copy_dataframe(df, model_class):
+    """Insert the rows of a dataframe into the table of model_class using
+    cursor.copy_from by creating an in-memory tsv representation of the rows. The
+    columns of the dataframe are the database columns."""
+    columns = df.columns.values.tolist()
+    stream = StringIO()
+    df.to_csv(stream, sep="\t", header=False, index=False, columns=columns)
+    stream.seek(0)
+
+    with connection.cursor() as c:
+        c.copy_from(
+            stream, model_class._meta.db_table, sep="\t", null="", columns=columns
+        )
 
 
 def check_and_trigger_model(datum, profile=None):
@@ -228,24 +360,21 @@ def check_and_trigger_model(datum, profile=None):
         if project.classifier is None:
             return_str = "no action"
         elif labels_count < project.labels.count():
-            if project.queue_set.filter(type="irr").exists():
-                irr_queue = project.queue_set.get(type="irr")
-            else:
-                irr_queue = None
-
-            fill_queue(
-                queue=project.queue_set.get(type="normal"),
-                irr_queue=irr_queue,
-                orderby="random",
-                batch_size=batch_size,
-                irr_percent=project.percentage_irr,
-            )
+            schedule_queue_refill(project, "random")
             return_str = "random"
         else:
-            task_num = tasks.send_model_task.delay(project.pk)
-            current_training_set.celery_task_id = task_num
-            current_training_set.save()
-            return_str = "model running"
+            # The lock coalesces the triggers of coders who label the last datum
+            # of a batch at the same time, only the first one starts the model
+            lock_owner = uuid.uuid4().hex
+            if acquire_task_lock(project.pk, "model", lock_owner):
+                task_num = tasks.send_model_task.apply_async(
+                    args=[project.pk], kwargs={"lock_owner": lock_owner}
+                )
+                current_training_set.celery_task_id = task_num
+                current_training_set.save()
+                return_str = "model running"
+            else:
+                return_str = "task already running"
     elif profile:
         # Model is not running, check if user needs more data
         handle_empty_queue(profile, project)
@@ -257,11 +386,17 @@ def check_and_trigger_model(datum, profile=None):
     return return_str
 
 
-def train_and_save_model(project):
+def train_and_save_model(project, full_retrain=False):
     """Given a project create a model, train it, and save the model pickle.
 
+    The incremental classifiers continue from the model of the previous training set
+    and are only fit on the labels added since, see incremental_base_model. They are
+    trained on all labels every INCREMENTAL_FULL_RETRAIN_ROUNDS rounds, or when
+    full_retrain is set.
+
     Args:
         project: The project to start training
+        full_retrain: train incremental classifiers on all labels
     Returns:
         model: A model object
     """
@@ -275,39 +410,29 @@ def train_and_save_model(project):
         clf = RandomForestClassifier()
     elif project.classifier == "gnb":
         clf = GaussianNB()
+    elif project.classifier == "sgd":
+        clf = SGDClassifier(loss="log_loss")
+    elif project.classifier == "multinomial nb":
+        clf = MultinomialNB()
     else:
         raise ValueError(
             "There was no valid classifier for project: " + str(project.pk)
         )
-    tf_idf = load_tfidf_matrix(project.pk)
+    features = current_project_features(project)
+    tf_idf = load_cached_feature_matrix(
+        project.pk, object_path(project.pk, features["features"])
+    )
 
     current_training_set = project.get_current_training_set()
 
-    # In order to train need X (tf-idf vector) and Y (label) for every labeled datum
-    # Order both X and Y by upload_id_hash to ensure the tf-idf vector corresponds to the correct
-    # label
+    # In order to train need X (tf-idf vector) and Y (label) for every labeled datum.
+    # The rows of the tf-idf matrix are looked up by upload_id_hash so X and Y line up
 
-    labeled_data = DataLabel.objects.filter(data__project=project)
-    unique_ids = list(
-        labeled_data.values_list("data__upload_id", flat=True).order_by(
-            "data__upload_id_hash"
-        )
+    labeled_data = DataLabel.objects.filter(data__project=project).order_by(
+        "data__upload_id_hash"
     )
-    labeled_values = list(
-        labeled_data.values_list("label", flat=True).order_by("data__upload_id_hash")
-    )
-
-    X = [tf_idf[id] for id in unique_ids]
-    Y = labeled_values
-    clf.fit(X, Y)
-
-    classes = [str(c) for c in clf.classes_]
-    keys = ("precision", "recall", "f1")
-    cv_predicts = cross_val_predict(clf, X, Y, cv=5)
-    cv_accuracy = accuracy_score(Y, cv_predicts)
-    metrics = precision_recall_fscore_support(Y, cv_predicts)
-    metric_map = map(lambda x: dict(zip(classes, x)), metrics[:3])
-    cv_metrics = dict(zip(keys, metric_map))
+    unique_ids = list(labeled_data.values_list("data__upload_id_hash", flat=True))
+    labeled_values = list(labeled_data.values_list("label", flat=True))
 
     fpath = os.path.join(
         settings.MODEL_PICKLE_PATH,
@@ -318,7 +443,98 @@ def train_and_save_model(project):
         + ".pkl",
     )
 
-    joblib.dump(clf, fpath)
+    # The same classifier, features and labels give the same model, so the model of
+    # an earlier training set is reused instead of being trained again
+    inputs = hashlib.sha256(
+        json.dumps(
+            [project.classifier, features["features"], unique_ids, labeled_values]
+        ).encode()
+    ).hexdigest()
+    same_inputs_model = (
+        Model.objects.filter(project=project, training_set__manifest__inputs=inputs)
+        .exclude(training_set=current_training_set)
+        .order_by("-training_set__set_number")
+        .first()
+    )
+    base_model = incremental_base_model(project, features, full_retrain)
+    base_clf = joblib.load(base_model.pickle_path) if base_model else None
+    if base_model is not None:
+        new_labeled_data = labeled_data.filter(
+            training_set__set_number__gt=base_model.training_set.set_number
+        )
+        new_ids = list(new_labeled_data.values_list("data__upload_id_hash", flat=True))
+        new_values = list(new_labeled_data.values_list("label", flat=True))
+        # partial_fit cannot add classes the previous model has not seen
+        if (
+            not new_values
+            or not isinstance(base_clf, type(clf))
+            or not set(new_values) <= set(base_clf.classes_)
+        ):
+            base_model = None
+
+    with measure_stage() as train_stats:
+        if same_inputs_model is not None and os.path.exists(
+            object_path(
+                project.pk, same_inputs_model.training_set.manifest["classifier"]
+            )
+        ):
+            manifest = same_inputs_model.training_set.manifest
+            classifier = manifest["classifier"]
+            replace_file(
+                lambda path: link_or_copy(object_path(project.pk, classifier), path),
+                fpath,
+            )
+            cv_accuracy = same_inputs_model.cv_accuracy
+            cv_metrics = same_inputs_model.cv_metrics
+            incremental_rounds = manifest.get("incremental_rounds")
+            train_stats.update(mode="reused", rows=len(unique_ids))
+        elif base_model is not None:
+            clf = base_clf
+            X = get_classifier_features(clf, tf_idf, new_ids)
+            Y = new_values
+            clf.partial_fit(X, Y)
+
+            # cross validated after the model is published like every other
+            # classifier, so the metrics of the models can be compared
+            cv_accuracy = None
+            cv_metrics = None
+
+            replace_file(lambda path: joblib.dump(clf, path), fpath)
+            classifier = store_artifact(project.pk, fpath)
+            incremental_rounds = (
+                base_model.training_set.manifest["incremental_rounds"] + 1
+            )
+            train_stats.update(mode="incremental", rows=len(new_ids))
+        else:
+            X = get_classifier_features(clf, tf_idf, unique_ids)
+            Y = labeled_values
+            clf.fit(X, Y)
+
+            # cross validation runs after the model is published, see evaluate_model
+            cv_accuracy = None
+            cv_metrics = None
+
+            replace_file(lambda path: joblib.dump(clf, path), fpath)
+            classifier = store_artifact(project.pk, fpath)
+            incremental_rounds = (
+                0 if project.classifier in INCREMENTAL_CLASSIFIERS else None
+            )
+            train_stats.update(mode="full", rows=len(unique_ids))
+
+    train_stats["features"] = int(tf_idf.shape[1])
+    stage_metrics = {"train": train_stats}
+    if "build_metrics" in tf_idf.meta:
+        stage_metrics["features"] = tf_idf.meta["build_metrics"]
+    artifact_cache.invalidate(project.pk, "classifier")
+
+    current_training_set.manifest = {
+        "features": features["features"],
+        "vectorizer": features["vectorizer"],
+        "classifier": classifier,
+        "inputs": inputs,
+        "incremental_rounds": incremental_rounds,
+    }
+    current_training_set.save()
 
     model = Model.objects.create(
         pickle_path=fpath,
@@ -326,154 +542,1067 @@ def train_and_save_model(project):
         training_set=current_training_set,
         cv_accuracy=cv_accuracy,
         cv_metrics=cv_metrics,
+        stage_metrics=stage_metrics,
     )
 
     return model
 
 
-def predict_data(project, model):
+def evaluate_model(model):
+    """Fill in the cross validation metrics of a model.
+
+    An unfitted copy of the classifier is cross validated with CV_FOLDS folds, which
+    are fit in CV_JOBS threads. The default joblib backend fits them one at a time
+    inside the daemonic processes of the celery prefork pool. Training sets with at
+    least CV_HOLDOUT_MIN_ROWS labels are only scored on a holdout of CV_HOLDOUT_SIZE
+    of the labels.
+
+    Args:
+        model: Model object
+    Returns:
+        model: the Model object with cv_accuracy and cv_metrics set
+    """
+    clf = load_classifier(model)
+    tf_idf = load_model_features(model)
+
+    # the labels the model was trained on, see train_and_save_model
+    labeled_data = DataLabel.objects.filter(
+        data__project=model.project,
+        training_set__set_number__lte=model.training_set.set_number,
+    ).order_by("data__upload_id_hash")
+    unique_ids = list(labeled_data.values_list("data__upload_id_hash", flat=True))
+    labeled_values = list(labeled_data.values_list("label", flat=True))
+
+    X = get_classifier_features(clf, tf_idf, unique_ids)
+    Y = labeled_values
+    estimator = clone(clf)
+    if len(Y) >= settings.CV_HOLDOUT_MIN_ROWS:
+        X_train, X_test, Y_train, Y = train_test_split(
+            X, Y, test_size=settings.CV_HOLDOUT_SIZE, random_state=0
+        )
+        cv_predicts = estimator.fit(X_train, Y_train).predict(X_test)
+    else:
+        with joblib.parallel_backend("threading"):
+            cv_predicts = cross_val_predict(
+                estimator, X, Y, cv=settings.CV_FOLDS, n_jobs=settings.CV_JOBS
+            )
+    model.cv_accuracy, model.cv_metrics = score_predictions(
+        clf.classes_, Y, cv_predicts
+    )
+    model.save(update_fields=["cv_accuracy", "cv_metrics"])
+
+    return model
+
+
+def score_predictions(classes, Y, predicts):
+    """The accuracy and the per class precision, recall and f1 of predictions.
+
+    Args:
+        classes: the classes of the classifier
+        Y: the true labels
+        predicts: the predicted labels
+    Returns:
+        accuracy, metrics: metrics maps each score name to a dict of class scores
+    """
+    keys = ("precision", "recall", "f1")
+    accuracy = accuracy_score(Y, predicts)
+    metrics = precision_recall_fscore_support(Y, predicts, labels=classes)
+    metric_map = map(lambda x: dict(zip([str(c) for c in classes], x)), metrics[:3])
+    return accuracy, dict(zip(keys, metric_map))
+
+
+def incremental_base_model(project, features, full_retrain=False):
+    """The model an incremental classifier continues training from.
+
+    That is the model of the previous training set, as long as it was trained on the
+    same feature columns, and fewer than
+    INCREMENTAL_FULL_RETRAIN_ROUNDS rounds have passed since the last full retrain.
+
+    Args:
+        project: Project object
+        features: the stored features the new model is trained on
+        full_retrain: if set there is no base model
+    Returns:
+        a Model object, or None if the classifier has to be trained on all labels
+    """
+    if full_retrain or project.classifier not in INCREMENTAL_CLASSIFIERS:
+        return None
+
+    previous_model = (
+        Model.objects.filter(project=project)
+        .exclude(training_set=project.get_current_training_set())
+        .order_by("-training_set__set_number")
+        .first()
+    )
+    if previous_model is None or previous_model.training_set.manifest is None:
+        return None
+
+    manifest = previous_model.training_set.manifest
+    rounds = manifest.get("incremental_rounds")
+    if (
+        rounds is None
+        or rounds + 1 >= settings.INCREMENTAL_FULL_RETRAIN_ROUNDS
+        # a new vectorizer means new feature columns
+        or manifest["vectorizer"] != features["vectorizer"]
+        or not os.path.isfile(previous_model.pickle_path)
+    ):
+        return None
+    return previous_model
+
+
+def replace_file(write, fpath):
+    """Call write with a temporary path next to fpath and then move the result to
+    fpath, so readers never see a partly written file."""
+    temp_path = fpath + ".tmp-" + uuid.uuid4().hex
+    try:
+        write(temp_path)
+        os.replace(temp_path, fpath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def predict_data(project, model, first_hash=None, last_hash=None):
     """Given a project and its model, predict any unlabeled data and create.
 
         Prediction objects for each.  There will be #label * #unlabeled_data
         predictions.  This is because we are saving the probability of each label
         for every data.
 
+        The data are read from a server-side cursor and predicted PREDICT_CHUNK_SIZE
+        at a time, so memory use does not grow with the number of unlabeled data.
+        If PREDICTION_POOL_SIZE is set only a candidate pool of the unlabeled data
+        is predicted, see candidate_pool. Data that are not in the features yet are
+        skipped until the next model.
+
     Args:
         project: Project object
         model: Model object
+        first_hash: only predict data with an upload_id_hash from this one on
+        last_hash: only predict data with an upload_id_hash before this one
     Returns:
-        predictions: List of DataPrediction objects
+        the number of DataPrediction objects created
     """
-    clf = joblib.load(model.pickle_path)
-    tf_idf = load_tfidf_matrix(project.pk)
+    with measure_stage() as predict_stats:
+        clf = load_classifier(model)
+        tf_idf = load_model_features(model)
+
+        # In order to predict need X (tf-idf vector) for every unlabeled datum. The rows
+        # of the tf-idf matrix are looked up by upload_id_hash in the same order as the data
+        unlabeled_data = get_unlabeled_data(project)
+        if first_hash is not None:
+            unlabeled_data = unlabeled_data.filter(upload_id_hash__gte=first_hash)
+        if last_hash is not None:
+            unlabeled_data = unlabeled_data.filter(upload_id_hash__lt=last_hash)
+        chunk_size = settings.PREDICT_CHUNK_SIZE
+        if settings.PREDICTION_POOL_SIZE > 0:
+            rows = candidate_pool(project, model, unlabeled_data)
+        else:
+            rows = (
+                unlabeled_data.order_by("upload_id_hash")
+                .values_list("pk", "upload_id_hash")
+                .iterator(chunk_size)
+            )
+
+        # each prediction is an array of probabilities.  Each index in that array
+        # corresponds to the label of the same index in clf.classes_. The labels are
+        # looked up in one query before the chunks are predicted
+        labels = Label.objects.in_bulk(clf.classes_.tolist())
+        label_ids = [labels[label].pk for label in clf.classes_.tolist()]
+
+        num_predictions = 0
+        num_rows = 0
+        for chunk in iterate_in_chunks(rows, chunk_size):
+            start = time.perf_counter()
+            in_features = tf_idf.has_rows(
+                [upload_id_hash for _, upload_id_hash in chunk]
+            )
+            if not in_features.all():
+                logger.info(
+                    "Project %s model %s: %d data are not in the features yet",
+                    project.pk,
+                    model.pk,
+                    int((~in_features).sum()),
+                )
+                chunk = [row for row, found in zip(chunk, in_features) if found]
+                if not chunk:
+                    continue
+            data_ids = [data_id for data_id, _ in chunk]
+            unique_ids = [upload_id_hash for _, upload_id_hash in chunk]
+
+            X = get_classifier_features(clf, tf_idf, unique_ids)
+            predictions = clf.predict_proba(X)
+
+            create_prediction_objects(data_ids, model, label_ids, predictions)
+            # Need to crate uncertainty objects so fill_queue can sort by one of the metrics
+            create_uncertainty_objects(data_ids, model, predictions)
+            num_predictions += predictions.size
+            num_rows += len(chunk)
+
+            seconds = time.perf_counter() - start
+            logger.info(
+                "Project %s model %s: predicted %d data in %.2fs (%.0f data/s)",
+                project.pk,
+                model.pk,
+                len(chunk),
+                seconds,
+                len(chunk) / max(seconds, 1e-9),
+            )
+        predict_stats["rows"] = num_rows
+
+    shard = "{}-{}".format(first_hash or "", last_hash or "")
+    record_predict_metrics(model, shard, predict_stats)
 
-    # In order to predict need X (tf-idf vector) for every unlabeled datum. Order
-    # X by upload_id_hash to ensure the tf-idf vector corresponds to the correct datum
+    return num_predictions
+
+
+def record_predict_metrics(model, shard, stats):
+    """Add the resource use of predicting one shard to model.stage_metrics.
+
+    The shards of a model are predicted in parallel, so the stats are merged into
+    the stored JSON in the database rather than written from a loaded Model.
+
+    Args:
+        model: Model object
+        shard: the upload_id_hash range of the shard, ex: "-" for all data
+        stats: the dict filled in by measure_stage
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """UPDATE {table} SET stage_metrics = jsonb_set(
+                COALESCE(stage_metrics, '{{}}'::jsonb),
+                '{{predict}}',
+                COALESCE(stage_metrics -> 'predict', '{{}}'::jsonb) || %s::jsonb
+            ) WHERE id = %s""".format(table=Model._meta.db_table),
+            [json.dumps({shard: stats}), model.pk],
+        )
+
+
+def get_unlabeled_data(project):
+    """The data of a project that are neither labeled nor in the recycle bin."""
     recycle_data = RecycleBin.objects.filter(data__project=project).values_list(
         "pk", flat=True
     )
-    unlabeled_data = (
-        project.data_set.filter(datalabel__isnull=True)
-        .exclude(pk__in=recycle_data)
+    return project.data_set.filter(datalabel__isnull=True).exclude(pk__in=recycle_data)
+
+
+def prediction_shards(project):
+    """Split the unlabeled data of a project into PREDICT_SHARDS ranges of
+    upload_id_hash of about the same size, to be predicted in parallel.
+
+    Projects with fewer than PREDICT_SHARD_MIN_ROWS unlabeled data, and candidate
+    pools, which are chosen from all unlabeled data, are a single shard.
+
+    Returns:
+        a list of (first_hash, last_hash) ranges, see predict_data. None is an open
+        end of a range
+    """
+    unlabeled_data = get_unlabeled_data(project)
+    num_unlabeled = unlabeled_data.count()
+    if (
+        settings.PREDICTION_POOL_SIZE > 0
+        or settings.PREDICT_SHARDS < 2
+        or num_unlabeled < settings.PREDICT_SHARD_MIN_ROWS
+    ):
+        return [(None, None)]
+
+    # the first hash of every shard but the first, numbered in one scan of the data
+    shard_size = math.ceil(num_unlabeled / settings.PREDICT_SHARDS)
+    boundaries = list(
+        unlabeled_data.annotate(
+            position=Window(RowNumber(), order_by=F("upload_id_hash").asc())
+        )
+        .filter(position__in=range(shard_size + 1, num_unlabeled + 1, shard_size))
         .order_by("upload_id_hash")
+        .values_list("upload_id_hash", flat=True)
+    )
+    return list(zip([None] + boundaries, boundaries + [None]))
+
+
+def candidate_pool(project, model, unlabeled_data):
+    """Choose the unlabeled data a model scores for uncertainty sampling.
+
+    The pool is a fresh random sample of PREDICTION_POOL_SIZE unlabeled data, see
+    generate_sql_for_random_sample, plus up to PREDICTION_POOL_SIZE data of the
+    previous pool that are still unlabeled, the most uncertain first. fill_queue
+    only takes data scored by the latest model, so it picks from this pool, and
+    each round predicts and samples at most twice the pool size however large the
+    project is.
+
+    Args:
+        project: Project object
+        model: the Model that will score the pool
+        unlabeled_data: queryset of the data that can be in the pool
+    Returns:
+        a list of (pk, upload_id_hash) of the data in the pool, by upload_id_hash
+    """
+    pool_size = settings.PREDICTION_POOL_SIZE
+    previous_model = (
+        Model.objects.filter(
+            project=project,
+            training_set__set_number__lt=model.training_set.set_number,
+        )
+        .order_by("-training_set__set_number")
+        .first()
     )
-    unique_ids = list(
-        unlabeled_data.values_list("upload_id", flat=True).order_by("upload_id_hash")
+    carried_over = []
+    sample_from = unlabeled_data
+    if previous_model is not None:
+        # ordered without ties, so the subquery the sample leaves out and the list
+        # of carried over data are the same data
+        previous_pool = DataUncertainty.objects.filter(
+            model=previous_model, data__in=unlabeled_data
+        ).order_by(
+            POOL_ORDERBY.get(project.learning_method, "data__random_key"), "data"
+        )
+        carried_over = list(
+            previous_pool.values_list("data__pk", "data__upload_id_hash")[:pool_size]
+        )
+        sample_from = unlabeled_data.exclude(
+            pk__in=previous_pool.values("data")[:pool_size]
+        )
+
+    cte_sql, cte_params = sample_from.query.sql_with_params()
+    with connection.cursor() as c:
+        c.execute(
+            generate_sql_for_random_sample(cte_sql, "%s"),
+            (*cte_params, *([pool_size] * 4)),
+        )
+        sample_ids = [row[0] for row in c.fetchall()]
+    sample = list(
+        Data.objects.filter(pk__in=sample_ids).values_list("pk", "upload_id_hash")
     )
+    return sorted(carried_over + sample, key=lambda row: row[1])
 
-    # get the list of all data sorted by identifier
-    X = [tf_idf[id] for id in unique_ids]
-    predictions = clf.predict_proba(X)
 
-    label_obj = [Label.objects.get(pk=label) for label in clf.classes_]
+def compact_predictions(project):
+    """Keep the full predictions of only the latest model of a project.
 
-    bulk_predictions = []
-    for datum, prediction in zip(unlabeled_data, predictions):
-        # each prediction is an array of probabilities.  Each index in that array
-        # corresponds to the label of the same index in clf.classes_
-        for p, label in zip(prediction, label_obj):
-            bulk_predictions.append(
-                DataPrediction(
-                    data=datum, model=model, label=label, predicted_probability=p
-                )
-            )
+    The DataPrediction objects of older models are replaced by a
+    DataPredictionSummary of the PREDICTION_SUMMARY_TOP_K most probable labels of
+    each datum. Summaries are kept for the PREDICTION_SUMMARY_RETENTION models
+    before the latest one and deleted after that, so the stored predictions do not
+    grow with the number of training rounds.
 
-        # Need to crate uncertainty object so fill_queue can sort by one of the metrics
-        lc = least_confident(prediction)
-        ms = margin_sampling(prediction)
-        e = entropy(prediction)
+    Args:
+        project: Project object
+    Returns:
+        a dict with the number of predictions compacted and summaries deleted
+    """
+    models = list(
+        Model.objects.filter(project=project).order_by("-training_set__set_number")
+    )
+    older_models = models[1:]
+    summarized_models = older_models[: settings.PREDICTION_SUMMARY_RETENTION]
+    top_k = settings.PREDICTION_SUMMARY_TOP_K
+
+    sql = """
+    INSERT INTO {summary_table}
+        ({summary_data_id_col}, {summary_model_id_col}, {summary_labels_col},
+        {summary_probabilities_col})
+    SELECT {pred_data_id_col}, {pred_model_id_col},
+        (ARRAY_AGG({pred_label_id_col} ORDER BY {pred_prob_col} DESC))[1:%s],
+        (ARRAY_AGG({pred_prob_col} ORDER BY {pred_prob_col} DESC))[1:%s]
+    FROM {pred_table}
+    WHERE {pred_model_id_col} = %s
+    GROUP BY {pred_data_id_col}, {pred_model_id_col}
+    ON CONFLICT DO NOTHING
+    """.format(
+        summary_table=DataPredictionSummary._meta.db_table,
+        summary_data_id_col=DataPredictionSummary._meta.get_field("data").column,
+        summary_model_id_col=DataPredictionSummary._meta.get_field("model").column,
+        summary_labels_col=DataPredictionSummary._meta.get_field("labels").column,
+        summary_probabilities_col=DataPredictionSummary._meta.get_field(
+            "probabilities"
+        ).column,
+        pred_table=DataPrediction._meta.db_table,
+        pred_data_id_col=DataPrediction._meta.get_field("data").column,
+        pred_model_id_col=DataPrediction._meta.get_field("model").column,
+        pred_label_id_col=DataPrediction._meta.get_field("label").column,
+        pred_prob_col=DataPrediction._meta.get_field("predicted_probability").column,
+    )
 
-        DataUncertainty.objects.create(
-            data=datum, model=model, least_confident=lc, margin_sampling=ms, entropy=e
+    with transaction.atomic():
+        if top_k > 0:
+            with connection.cursor() as c:
+                for model in summarized_models:
+                    c.execute(sql, [top_k, top_k, model.pk])
+        compacted, _ = DataPrediction.objects.filter(model__in=older_models).delete()
+        deleted, _ = (
+            DataPredictionSummary.objects.filter(model__project=project)
+            .exclude(model__in=summarized_models)
+            .delete()
         )
 
-    prediction_objs = DataPrediction.objects.bulk_create(bulk_predictions)
+    return {"compacted": compacted, "summaries_deleted": deleted}
+
+
+def load_classifier(model):
+    """Load the fitted classifier of a model, from the artifact cache if it is there.
+
+    The pickle path is reused within a training set, so the modification time of the
+    file is part of the cache key.
+    """
+    version = model.pickle_path + ":" + str(os.stat(model.pickle_path).st_mtime_ns)
+    return artifact_cache.get_or_load(
+        model.project_id,
+        "classifier",
+        version,
+        lambda: joblib.load(model.pickle_path),
+        lambda clf: os.path.getsize(model.pickle_path),
+    )
+
+
+def get_classifier_features(clf, feature_matrix, upload_id_hashes):
+    """Slice the rows for the given data out of the feature matrix.
 
-    return prediction_objs
+    GaussianNB cannot be fit on sparse input, so only for that classifier the
+    selected rows of a sparse feature matrix are densified.
+    """
+    X = feature_matrix.rows(upload_id_hashes)
+    if isinstance(clf, GaussianNB) and sparse.issparse(X):
+        return X.toarray()
+    return X
 
 
 def create_tfidf_matrix(project_pk, max_df=0.995, min_df=0.005):
-    """Create a TF-IDF matrix. Make sure to order the data by upload_id_hash so that we
-    can sync the data up again when training the model.
+    """Create a TF-IDF matrix. The rows are ordered by upload_id_hash and returned
+    with the list of hashes so they can be looked up again when training the model.
+
+    Projects with at least TFIDF_PARALLEL_MIN_ROWS data are split into shards that
+    are counted and weighted in TFIDF_WORKERS processes, see
+    create_sharded_tfidf_matrix.
 
     Args:
         project_pk: The pk of the project
     Returns:
         tf_idf_matrix: CSR-format tf-idf matrix
+        row_keys: upload_id_hash of the datum in each row of the matrix
+        fitted_vectorizer: The TfidfVectorizer fit on the project data
+    """
+    project_data = Data.objects.filter(project__pk=project_pk).order_by(
+        "upload_id_hash"
+    )
+    id_list = list(project_data.values_list("upload_id_hash", flat=True))
+    data_list = list(project_data.values_list("text", flat=True))
+
+    if (
+        settings.TFIDF_WORKERS > 1
+        and len(data_list) >= settings.TFIDF_PARALLEL_MIN_ROWS
+    ):
+        tf_idf_matrix, vectorizer = create_sharded_tfidf_matrix(
+            data_list, settings.TFIDF_WORKERS, max_df=max_df, min_df=min_df
+        )
+    else:
+        vectorizer = TfidfVectorizer(max_df=max_df, min_df=min_df, stop_words="english")
+        tf_idf_matrix = vectorizer.fit_transform(data_list)
+
+    return tf_idf_matrix, id_list, vectorizer
+
+
+def count_shard_terms(texts):
+    """Count the terms of one shard of text. Runs in a worker process.
+
+    Returns:
+        terms: the vocabulary of the shard, in the order the terms first occur
+        counts: CSR matrix of term counts, columns in the order of terms and sorted
+            within each row, as CountVectorizer counts them before it sorts the
+            vocabulary
     """
-    project_data = Data.objects.filter(project__pk=project_pk)
-    id_list = list(
-        project_data.values_list("upload_id", flat=True).order_by("upload_id_hash")
+    vocabulary, counts = CountVectorizer(stop_words="english")._count_vocab(
+        texts, fixed_vocab=False
     )
-    data_list = list(
-        project_data.values_list("text", flat=True).order_by("upload_id_hash")
+    terms = np.empty(len(vocabulary), dtype=object)
+    terms[list(vocabulary.values())] = list(vocabulary)
+    return terms, counts
+
+
+def transform_shard_counts(counts, column_map, first_occurrence, keep, transformer):
+    """Weight the term counts of one shard by the merged vocabulary. Runs in a
+    worker process.
+
+    TfidfVectorizer keeps the values of each row in the order the terms first
+    occur in all of the text, and sums the squares for the row norm in that
+    order, so the values of the shard are put in that order too. They are cast to
+    float here, as casting a CSR matrix with scipy sorts its indices.
+
+    Args:
+        counts: CSR matrix of term counts from count_shard_terms
+        column_map: the column in the merged vocabulary of each shard column
+        first_occurrence: the rank of each merged column by where the term first
+            occurs in all of the text
+        keep: the column in the pruned vocabulary of each merged column, or -1 if
+            it is pruned
+        transformer: the TfidfTransformer fit on the whole project
+    Returns:
+        CSR-format tf-idf matrix of the shard
+    """
+    columns = column_map[counts.indices]
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    order = np.lexsort((first_occurrence[columns], rows))
+    kept = order[keep[columns[order]] >= 0]
+    row_lengths = np.bincount(rows[kept], minlength=counts.shape[0])
+    indptr = np.zeros(counts.shape[0] + 1, dtype=counts.indptr.dtype)
+    np.cumsum(row_lengths, out=indptr[1:])
+    pruned = sparse.csr_matrix(
+        (
+            counts.data[kept].astype(np.float64),
+            keep[columns[kept]].astype(counts.indices.dtype),
+            indptr,
+        ),
+        shape=(counts.shape[0], transformer.n_features_in_),
     )
+    return transformer.transform(pruned, copy=False)
+
+
+def create_sharded_tfidf_matrix(texts, workers, max_df=0.995, min_df=0.005):
+    """Fit a TfidfVectorizer on shards of the text in a process pool.
+
+    Tokenizing and counting is the expensive part of fitting, so each worker counts
+    one shard with its own vocabulary. The shard vocabularies are merged into one
+    sorted vocabulary, the document frequencies summed and the terms pruned by
+    max_df and min_df the same way TfidfVectorizer does. Each worker then remaps
+    the columns of its shard, puts the values of each row in the order
+    TfidfVectorizer keeps them and weights them, and the shards are stacked. The
+    result is identical to TfidfVectorizer.fit_transform on all of the text, down
+    to the bits of the row norms.
+
+    The pool is a billiard pool, as the processes of the celery prefork pool are
+    daemonic and multiprocessing does not let them start children.
+
+    Args:
+        texts: list of the text of every datum
+        workers: number of processes to count in
+    Returns:
+        tf_idf_matrix: CSR-format tf-idf matrix
+        fitted_vectorizer: a TfidfVectorizer that transforms new text the same way
+    """
+    shard_size = math.ceil(len(texts) / workers)
+    shards = [texts[i : i + shard_size] for i in range(0, len(texts), shard_size)]
+    with billiard.Pool(processes=len(shards)) as pool:
+        shard_counts = pool.map(count_shard_terms, shards)
+
+        vocabulary = np.unique(np.concatenate([terms for terms, _ in shard_counts]))
+        column_maps = [
+            np.searchsorted(vocabulary, terms).astype(counts.indices.dtype)
+            for terms, counts in shard_counts
+        ]
+        # the terms of the first shard come first, then the terms new to the second
+        # shard and so on, each in the order they occur in their shard
+        first_occurrence = np.full(len(vocabulary), -1, dtype=np.int64)
+        num_seen = 0
+        for column_map in column_maps:
+            new_terms = column_map[first_occurrence[column_map] < 0]
+            first_occurrence[new_terms] = np.arange(num_seen, num_seen + len(new_terms))
+            num_seen += len(new_terms)
+        # each term is counted at most once per row of a CSR matrix
+        document_frequency = np.zeros(len(vocabulary), dtype=np.int64)
+        for column_map, (_, counts) in zip(column_maps, shard_counts):
+            document_frequency += np.bincount(
+                column_map[counts.indices], minlength=len(vocabulary)
+            )
+
+        max_doc_count = max_df if isinstance(max_df, int) else max_df * len(texts)
+        min_doc_count = min_df if isinstance(min_df, int) else min_df * len(texts)
+        keep = (document_frequency <= max_doc_count) & (
+            document_frequency >= min_doc_count
+        )
+        if not keep.any():
+            raise ValueError(
+                "After pruning, no terms remain. Try a lower min_df or a higher max_df."
+            )
+        new_columns = np.where(keep, np.cumsum(keep) - 1, -1)
+
+        # the smoothed idf of TfidfTransformer.fit
+        transformer = TfidfTransformer(norm="l2", use_idf=True, smooth_idf=True)
+        transformer.idf_ = np.full(
+            int(keep.sum()), len(texts) + 1, dtype=np.float64
+        ) / (document_frequency[keep].astype(np.float64) + 1)
+        np.log(transformer.idf_, out=transformer.idf_)
+        transformer.idf_ += 1.0
+        transformer.n_features_in_ = int(keep.sum())
+
+        tf_idf_shards = pool.starmap(
+            transform_shard_counts,
+            [
+                (counts, column_map, first_occurrence, new_columns, transformer)
+                for column_map, (_, counts) in zip(column_maps, shard_counts)
+            ],
+        )
 
     vectorizer = TfidfVectorizer(max_df=max_df, min_df=min_df, stop_words="english")
-    fitted_vectorizer = vectorizer.fit(data_list)
+    vectorizer.vocabulary_ = {
+        term: column for column, term in enumerate(vocabulary[keep].tolist())
+    }
+    vectorizer.fixed_vocabulary_ = False
+    vectorizer.stop_words_ = set(vocabulary[~keep].tolist())
+    vectorizer._tfidf = transformer
+
+    return sparse.vstack(tf_idf_shards, format="csr"), vectorizer
 
-    tf_idf_matrix = fitted_vectorizer.transform(data_list)
 
-    new_dict = dict(
-        zip(id_list, np.matrix.tolist(sparse.csr_matrix.todense(tf_idf_matrix)))
+def tfidf_matrix_path(project_pk):
+    """The directory holding the tf-idf feature matrix arrays of a project."""
+    return os.path.join(
+        settings.TF_IDF_PATH, "project_" + str(project_pk) + "_tfidf_matrix"
     )
 
-    return new_dict, fitted_vectorizer
+
+def tfidf_vectorizer_path(project_pk):
+    return os.path.join(
+        settings.TF_IDF_PATH, "project_" + str(project_pk) + "_vectorizer.pkl"
+    )
 
 
-def save_tfidf_matrix(matrix, project_pk):
+def save_tfidf_matrix(matrix, row_keys, project_pk, meta=None):
     """Save tf-idf matrix to persistent volume storage defined in settings as
-    TF_IDF_PATH.
+    TF_IDF_PATH. The matrix stays in CSR form so it can be memory-mapped later.
 
     Args:
         matrix: CSR-format tf-idf matrix
+        row_keys: upload_id_hash of the datum in each row of the matrix
         project_pk: The project pk the data comes from
+        meta: optional dict of values to store with the matrix
     Returns:
-        file: The filepath to the saved matrix
+        file: The path to the directory holding the saved matrix
     """
-    fpath = os.path.join(
-        settings.TF_IDF_PATH, "project_" + str(project_pk) + "_tfidf_matrix.pkl"
+    return save_feature_matrix(
+        matrix, row_keys, tfidf_matrix_path(project_pk), meta=meta
     )
-    with open(fpath, "wb") as tfidf_file:
-        pickle.dump(matrix, tfidf_file)
-
-    return fpath
 
 
 def save_tfidf_vectorizer(vectorizer, project_pk):
-    """Save tf-idf matrix to persistent volume storage defined in settings as
+    """Save tf-idf vectorizer to persistent volume storage defined in settings as
     TF_IDF_PATH.
 
     Args:
-        matrix: CSR-format tf-idf matrix
+        vectorizer: fitted TfidfVectorizer
         project_pk: The project pk the data comes from
     Returns:
-        file: The filepath to the saved matrix
+        file: The filepath to the saved vectorizer
     """
-    fpath = os.path.join(
-        settings.TF_IDF_PATH, "project_" + str(project_pk) + "_vectorizer.pkl"
-    )
+    fpath = tfidf_vectorizer_path(project_pk)
     with open(fpath, "wb") as tfidf_file:
         pickle.dump(vectorizer, tfidf_file)
     return fpath
 
 
+def load_cached_feature_matrix(project_pk, fpath):
+    return artifact_cache.get_or_load(
+        project_pk,
+        "features",
+        read_feature_matrix_version(fpath),
+        lambda: load_feature_matrix(fpath),
+        lambda feature_matrix: feature_matrix.resident_nbytes,
+    )
+
+
 def load_tfidf_matrix(project_pk):
-    """Load tf-idf matrix from persistent volume, otherwise None.
+    """Load tf-idf matrix from persistent volume, otherwise raise a ValueError.
+
+    The matrix arrays are memory-mapped, use the rows method of the returned
+    FeatureMatrix to read the rows that are needed. The FeatureMatrix is kept in the
+    artifact cache of the process until a new version of the matrix is written.
 
     Args:
         project_pk: The project pk the data comes from
     Returns:
-        matrix or None
+        FeatureMatrix
     """
-    fpath = os.path.join(
-        settings.TF_IDF_PATH, "project_" + str(project_pk) + "_tfidf_matrix.pkl"
-    )
+    fpath = tfidf_matrix_path(project_pk)
 
-    if os.path.isfile(fpath):
-        with open(fpath, "rb") as file:
-            return pickle.load(file)
+    if feature_matrix_exists(fpath):
+        return load_cached_feature_matrix(project_pk, fpath)
     else:
         raise ValueError(
             "There was no tfidf matrix found for project: " + str(project_pk)
         )
+
+
+def load_tfidf_vectorizer(project_pk):
+    """Load the fitted tf-idf vectorizer from persistent volume, otherwise raise a
+    ValueError."""
+    fpath = tfidf_vectorizer_path(project_pk)
+
+    if os.path.isfile(fpath):
+        with open(fpath, "rb") as tfidf_file:
+            return pickle.load(tfidf_file)
+    else:
+        raise ValueError(
+            "There was no tfidf vectorizer found for project: " + str(project_pk)
+        )
+
+
+def tfidf_oov_rate(vectorizer, texts):
+    """The share of tokens in texts that are not in the vocabulary of the fitted
+    vectorizer. Stop words are dropped by the analyzer and are not counted."""
+    analyzer = vectorizer.build_analyzer()
+    vocabulary = vectorizer.vocabulary_
+
+    num_tokens = 0
+    num_oov = 0
+    for text in texts:
+        tokens = analyzer(text)
+        num_tokens += len(tokens)
+        num_oov += sum(1 for token in tokens if token not in vocabulary)
+
+    if num_tokens == 0:
+        return 0.0
+    return num_oov / num_tokens
+
+
+def create_hashing_matrix(project_pk, use_idf=False, meta=None):
+    """Create the feature matrix of a project with a HashingVectorizer and write it to
+    the tf-idf matrix path.
+
+    The vectorizer is stateless, so the text is read through a server-side cursor
+    and each chunk of FEATURE_CHUNK_SIZE rows is hashed and written to disk before
+    the next one is read. Memory use does not depend on the number of rows or the
+    size of the vocabulary. With use_idf the document frequencies are counted while
+    hashing and the stored rows are reweighted and normalized afterwards.
+
+    Args:
+        project_pk: The pk of the project
+        use_idf: reweight the hashed counts by inverse document frequency
+        meta: optional dict of values to store with the matrix
+    Returns:
+        vectorizer: transforms new text the same way as the stored rows
+    """
+    n_features = settings.HASHING_N_FEATURES
+    hasher = HashingVectorizer(
+        n_features=n_features,
+        stop_words="english",
+        alternate_sign=False,
+        norm=None if use_idf else "l2",
+    )
+    document_frequency = np.zeros(n_features, dtype=np.int64)
+    writer = FeatureMatrixWriter(tfidf_matrix_path(project_pk), n_features)
+
+    project_data = (
+        Data.objects.filter(project__pk=project_pk)
+        .order_by("upload_id_hash")
+        .values_list("upload_id_hash", "text")
+        .iterator(chunk_size=settings.FEATURE_CHUNK_SIZE)
+    )
+    num_rows = 0
+    for chunk in iterate_in_chunks(project_data, settings.FEATURE_CHUNK_SIZE):
+        row_keys, texts = zip(*chunk)
+        matrix = hasher.transform(texts)
+        # a column appears at most once in each row of a CSR matrix
+        document_frequency += np.bincount(matrix.indices, minlength=n_features)
+        writer.write(matrix, row_keys)
+        num_rows += len(chunk)
+
+    meta = dict(meta or {}, fit_rows=num_rows)
+    if not use_idf:
+        writer.close(meta=meta)
+        return hasher
+
+    # the same smoothed idf that TfidfVectorizer uses
+    transformer = TfidfTransformer()
+    transformer.idf_ = np.log((1 + num_rows) / (1 + document_frequency)) + 1
+    writer.close(meta=meta, column_weights=transformer.idf_, normalize=True)
+    return Pipeline([("hashing", hasher), ("tfidf", transformer)])
+
+
+def refit_tfidf_matrix(project_pk):
+    """Fit a new vectorizer on all of the project data and save it with the matrix.
+
+    Which vectorizer is used depends on the feature_backend of the project. For the
+    tfidf backend the out of vocabulary rate of the fit data is stored with the
+    matrix as the baseline that later appended data is compared against.
+
+    Args:
+        project_pk: The pk of the project
+    Returns:
+        file: The path to the directory holding the saved matrix
+    """
+    project = Project.objects.get(pk=project_pk)
+    if project.feature_backend in ["hashing", "hashing idf"]:
+        vectorizer = create_hashing_matrix(
+            project_pk,
+            use_idf=project.feature_backend == "hashing idf",
+            meta={"feature_backend": project.feature_backend, "oov_rate": None},
+        )
+        save_tfidf_vectorizer(vectorizer, project_pk)
+        return tfidf_matrix_path(project_pk)
+
+    tf_idf, row_keys, vectorizer = create_tfidf_matrix(project_pk)
+
+    # upload_id_hash is an md5 hash, so ordering by it gives an unbiased sample
+    sample = Data.objects.filter(project__pk=project_pk).order_by("upload_id_hash")[
+        : settings.TFIDF_OOV_SAMPLE_SIZE
+    ]
+    meta = {
+        "feature_backend": project.feature_backend,
+        "fit_rows": len(row_keys),
+        "oov_rate": tfidf_oov_rate(vectorizer, sample.values_list("text", flat=True)),
+    }
+
+    file = save_tfidf_matrix(tf_idf, row_keys, project_pk, meta=meta)
+    save_tfidf_vectorizer(vectorizer, project_pk)
+    return file
+
+
+def update_tfidf_matrix(project_pk, force_refit=False):
+    """Bring the stored tf-idf matrix up to date with the project data.
+
+    Data that is not in the matrix yet is transformed with the saved vectorizer and
+    added to the end of the matrix. The vectorizer is only refit on all of the data
+    when there is no matrix yet, when force_refit is set, when the feature_backend of
+    the project changed, when the project has grown by more than TFIDF_REFIT_GROWTH
+    of the data the vectorizer was fit on (not for plain hashing, which has nothing
+    to refit), or when the out of vocabulary rate of the new data is more than
+    TFIDF_REFIT_OOV_DRIFT above that of the fit data (tfidf only).
+
+    Args:
+        project_pk: The pk of the project
+        force_refit: always fit a new vectorizer
+    Returns:
+        file: The path to the directory holding the saved matrix
+    """
+    fpath = tfidf_matrix_path(project_pk)
+    if (
+        force_refit
+        or not feature_matrix_exists(fpath)
+        or not os.path.isfile(tfidf_vectorizer_path(project_pk))
+    ):
+        return refit_tfidf_matrix(project_pk)
+
+    feature_backend = Project.objects.get(pk=project_pk).feature_backend
+    feature_matrix = load_tfidf_matrix(project_pk)
+    if feature_matrix.meta.get("feature_backend") != feature_backend:
+        return refit_tfidf_matrix(project_pk)
+
+    project_hashes = Data.objects.filter(project__pk=project_pk).values_list(
+        "upload_id_hash", flat=True
+    )
+    new_hashes = pd.Index(encode_row_keys(project_hashes)).difference(
+        feature_matrix.row_index
+    )
+    if len(new_hashes) == 0:
+        return fpath
+
+    # plain hashing is stateless, there is nothing to go out of date
+    fit_rows = feature_matrix.meta["fit_rows"]
+    growth = (len(feature_matrix) + len(new_hashes) - fit_rows) / max(fit_rows, 1)
+    if feature_backend != "hashing" and growth > settings.TFIDF_REFIT_GROWTH:
+        return refit_tfidf_matrix(project_pk)
+
+    new_data = Data.objects.filter(
+        project__pk=project_pk,
+        upload_id_hash__in=[key.decode() for key in new_hashes],
+    ).order_by("upload_id_hash")
+    row_keys = list(new_data.values_list("upload_id_hash", flat=True))
+    texts = list(new_data.values_list("text", flat=True))
+
+    vectorizer = load_tfidf_vectorizer(project_pk)
+    if feature_backend == "tfidf":
+        drift = tfidf_oov_rate(vectorizer, texts) - feature_matrix.meta["oov_rate"]
+        if drift > settings.TFIDF_REFIT_OOV_DRIFT:
+            return refit_tfidf_matrix(project_pk)
+
+    return append_feature_matrix(feature_matrix, vectorizer.transform(texts), row_keys)
+
+
+def embeddings_matrix_path(project_pk):
+    """The directory holding the document embeddings of a project."""
+    return os.path.join(
+        settings.TF_IDF_PATH, "project_" + str(project_pk) + "_embeddings"
+    )
+
+
+def update_embeddings_matrix(project_pk):
+    """Embed the project data that has no embedding yet with the SBERT model and add
+    the rows to the stored float16 matrix.
+
+    The text is read through a server-side cursor and encoded EMBEDDINGS_BATCH_SIZE
+    rows at a time, and each batch is written to disk before the next is encoded.
+
+    Args:
+        project_pk: The pk of the project
+    Returns:
+        file: The path to the directory holding the saved embeddings
+    """
+    from core.utils.util import embeddings_model
+
+    fpath = embeddings_matrix_path(project_pk)
+    project_data = Data.objects.filter(project__pk=project_pk).order_by(
+        "upload_id_hash"
+    )
+    previous = None
+    if feature_matrix_exists(fpath):
+        previous = load_feature_matrix(fpath)
+        project_hashes = project_data.values_list("upload_id_hash", flat=True)
+        new_hashes = pd.Index(encode_row_keys(project_hashes)).difference(
+            previous.row_index
+        )
+        if len(new_hashes) == 0:
+            return fpath
+        project_data = project_data.filter(
+            upload_id_hash__in=[key.decode() for key in new_hashes]
+        )
+
+    row_keys = list(project_data.values_list("upload_id_hash", flat=True))
+    texts = project_data.values_list("text", flat=True).iterator(
+        chunk_size=settings.EMBEDDINGS_BATCH_SIZE
+    )
+    batches = (
+        embeddings_model.encode(chunk, batch_size=settings.EMBEDDINGS_BATCH_SIZE)
+        for chunk in iterate_in_chunks(texts, settings.EMBEDDINGS_BATCH_SIZE)
+    )
+
+    return write_dense_feature_matrix(
+        fpath,
+        row_keys,
+        batches,
+        embeddings_model.get_sentence_embedding_dimension(),
+        previous=previous,
+    )
+
+
+def load_project_features(project):
+    """Load the feature matrix used as X for the classifier of a project, the
+    document embeddings or the tf-idf (or hashing) matrix depending on its
+    feature_backend."""
+    if project.feature_backend == "embeddings":
+        fpath = embeddings_matrix_path(project.pk)
+        if not feature_matrix_exists(fpath):
+            raise ValueError(
+                "There were no embeddings found for project: " + str(project.pk)
+            )
+        return load_cached_feature_matrix(project.pk, fpath)
+    return load_tfidf_matrix(project.pk)
+
+
+def update_project_features(project_pk, update, **kwargs):
+    """Run a feature update and record its resource use in the meta.json of the
+    matrix, from where train_and_save_model copies it to the next model.
+
+    Args:
+        project_pk: The pk of the project
+        update: update_tfidf_matrix or update_embeddings_matrix
+        kwargs: passed on to update
+    Returns:
+        file: The path to the directory holding the saved matrix
+    """
+    with measure_stage() as stats:
+        file = update(project_pk, **kwargs)
+
+    feature_matrix = load_feature_matrix(file)
+    previous = feature_matrix.meta.get("build_metrics") or {}
+    # an update with nothing new to add leaves the matrix and its metrics alone
+    if previous.get("version") != feature_matrix.version:
+        stats.update(
+            version=feature_matrix.version,
+            rows=int(feature_matrix.shape[0]),
+            features=int(feature_matrix.shape[1]),
+        )
+        update_meta(file, build_metrics=stats)
+    return file
+
+
+def project_feature_paths(project):
+    """The working feature matrix and vectorizer paths of a project. The vectorizer
+    path is None for document embeddings."""
+    if project.feature_backend == "embeddings":
+        return embeddings_matrix_path(project.pk), None
+    return tfidf_matrix_path(project.pk), tfidf_vectorizer_path(project.pk)
+
+
+def current_project_features(project):
+    """The stored copy of the current feature matrix and vectorizer of a project.
+
+    The feature tasks publish the features to the artifact store as soon as they
+    are written. If the working matrix changed since then it is published here.
+
+    Returns:
+        a dict with the stored names of the "features" and "vectorizer"
+    """
+    feature_path, vectorizer_path = project_feature_paths(project)
+    if not feature_matrix_exists(feature_path):
+        raise ValueError(
+            "There was no feature matrix found for project: " + str(project.pk)
+        )
+    version = read_feature_matrix_version(feature_path)
+
+    current = load_current_features(project.pk)
+    if current is not None and current["version"] == version:
+        return current
+    return publish_features(project.pk, feature_path, version, vectorizer_path)
+
+
+def load_model_features(model):
+    """Load the exact feature matrix a model was trained with."""
+    manifest = model.training_set.manifest
+    if manifest is None:
+        return load_project_features(model.project)
+    return load_cached_feature_matrix(
+        model.project_id, object_path(model.project_id, manifest["features"])
+    )
+
+
+def get_model_artifacts(project, training_set):
+    """The paths of the feature matrix, vectorizer and classifier of the model
+    trained on a training set.
+
+    They come from the manifest of the training set, so they always belong
+    together. Training sets from before manifests fall back to the working files.
+
+    Returns:
+        feature_path, vectorizer_path (None for embeddings), classifier_path
+    """
+    manifest = training_set.manifest
+    if manifest is None:
+        feature_path, vectorizer_path = project_feature_paths(project)
+        classifier_path = os.path.join(
+            settings.MODEL_PICKLE_PATH,
+            "project_"
+            + str(project.pk)
+            + "_training_"
+            + str(training_set.set_number)
+            + ".pkl",
+        )
+        return feature_path, vectorizer_path, classifier_path
+
+    vectorizer = manifest["vectorizer"]
+    return (
+        object_path(project.pk, manifest["features"]),
+        object_path(project.pk, vectorizer) if vectorizer else None,
+        object_path(project.pk, manifest["classifier"]),
+    )
+
+
+def collect_artifact_garbage(project):
+    """Delete the artifacts of all but the last ARTIFACT_RETENTION trained training
+    sets of a project, along with their model pickles. The pickle_path of those
+    models is cleared.
+
+    Returns:
+        the names of the deleted artifacts
+    """
+    trained_sets = TrainingSet.objects.filter(
+        project=project, manifest__isnull=False
+    ).order_by("-set_number")
+    keep = set()
+    for training_set in trained_sets[: settings.ARTIFACT_RETENTION]:
+        manifest = training_set.manifest
+        keep.update(
+            manifest[kind]
+            for kind in ["features", "vectorizer", "classifier"]
+            if manifest[kind]
+        )
+
+    for training_set in trained_sets[settings.ARTIFACT_RETENTION :]:
+        for model in Model.objects.filter(training_set=training_set):
+            if os.path.isfile(model.pickle_path):
+                os.remove(model.pickle_path)
+        Model.objects.filter(training_set=training_set).update(pickle_path="")
+        training_set.manifest = None
+        training_set.save()
+
+    current = load_current_features(project.pk)
+    if current is not None:
+        keep.update([current["features"], current["vectorizer"]])
+
+    return collect_garbage(project.pk, keep)
@@ -4,6 +4,7 @@ from django.conf import settings
 from django.db import connection, transaction
 from django.db.models import Count, F, IntegerField, Value
 
+from core import tasks
 from core.models import (
     AssignedData,
     Data,
@@ -13,14 +14,21 @@ from core.models import (
     IRRLog,
     Model,
     Queue,
-    RecycleBin,
 )
 from core.utils.utils_redis import (
+    add_irr_data,
+    add_redis_objects,
     redis_parse_data,
+    redis_parse_list_dataids,
     redis_parse_queue,
+    redis_serialize_data,
+    redis_serialize_irr_profiles,
+    redis_serialize_irr_set,
     redis_serialize_queue,
-    sync_redis_objects,
+    redis_serialize_refill,
+    warm_project_redis,
 )
+from core.utils.utils_status import update_data_status
 
 
 def find_queue_length(batch_size, num_coders):
@@ -80,17 +88,8 @@ def fill_queue(queue, orderby, irr_queue=None, irr_percent=10, batch_size=30):
             "orderby parameter must be one of the following: " + " ".join(ORDERBY_VALUE)
         )
 
-    recycled_data = RecycleBin.objects.filter(data__project=queue.project).values_list(
-        "data__pk", flat=True
-    )
-    data_filters = {
-        "project": queue.project,
-        "labelers": None,
-        "queues": None,
-        "irr_ind": False,
-    }
-
-    eligible_data = Data.objects.filter(**data_filters).exclude(pk__in=recycled_data)
+    # unlabeled data are not in any queue or the recycle bin, see utils_status
+    eligible_data = Data.objects.filter(project=queue.project, status="unlabeled")
 
     cte_sql, cte_params = eligible_data.query.sql_with_params()
 
@@ -109,16 +108,24 @@ def fill_queue(queue, orderby, irr_queue=None, irr_percent=10, batch_size=30):
             queue, queue_size, num_in_queue, non_irr_batch_size, irr_queue
         )
 
-        sql = generate_sql_for_fill_queue(
-            queue, ORDERBY_VALUE[orderby], join_clause, cte_sql, sample_size_sql
-        )
+        if orderby == "random":
+            sql = generate_sql_for_random_fill_queue(queue, cte_sql, sample_size_sql)
+            params = (*cte_params, *(sample_size_params * 4))
+        else:
+            sql = generate_sql_for_fill_queue(
+                queue, ORDERBY_VALUE[orderby], join_clause, cte_sql, sample_size_sql
+            )
+            params = (*cte_params, *sample_size_params)
 
-        with connection.cursor() as c:
-            c.execute(sql, (*cte_params, *sample_size_params))
+        with transaction.atomic():
+            with connection.cursor() as c:
+                c.execute(sql, params)
+                new_data_ids = [row[0] for row in c.fetchall()]
+            update_data_status(Data.objects.filter(pk__in=new_data_ids))
 
-        sync_redis_objects(queue, orderby)
+        add_redis_objects(queue, new_data_ids, orderby)
 
-        num_added_normal = DataQueue.objects.filter(queue=queue).count() - num_in_queue
+        num_added_normal = len(new_data_ids)
     else:
         num_added_normal = 0
 
@@ -150,25 +157,32 @@ def fill_queue(queue, orderby, irr_queue=None, irr_percent=10, batch_size=30):
                 irr_queue, queue_size, num_elements, num_irr, irr_queue
             )
             # get the sql for adding the elements
-            irr_sql = generate_sql_for_fill_queue(
-                irr_queue,
-                ORDERBY_VALUE[orderby],
-                join_clause,
-                cte_sql,
-                irr_sample_size_sql,
-            )
-
-            with connection.cursor() as c:
-                c.execute(irr_sql, (*cte_params, *irr_sample_size_params))
+            if orderby == "random":
+                irr_sql = generate_sql_for_random_fill_queue(
+                    irr_queue, cte_sql, irr_sample_size_sql
+                )
+                irr_params = (*cte_params, *(irr_sample_size_params * 4))
+            else:
+                irr_sql = generate_sql_for_fill_queue(
+                    irr_queue,
+                    ORDERBY_VALUE[orderby],
+                    join_clause,
+                    cte_sql,
+                    irr_sample_size_sql,
+                )
+                irr_params = (*cte_params, *irr_sample_size_params)
 
-            data_ids = []
             with transaction.atomic():
-                irr_data = DataQueue.objects.filter(queue=irr_queue.pk)
-                for d in irr_data:
-                    data_ids.append(d.data.pk)
+                with connection.cursor() as c:
+                    c.execute(irr_sql, irr_params)
+                    data_ids = [row[0] for row in c.fetchall()]
+
+                # the data already in the irr queue were marked when they were added
                 Data.objects.filter(pk__in=data_ids).update(irr_ind=True)
+                update_data_status(Data.objects.filter(pk__in=data_ids))
 
-            sync_redis_objects(irr_queue, orderby)
+            add_redis_objects(irr_queue, data_ids, orderby)
+            add_irr_data(irr_queue, data_ids)
 
             # get new eligible data by filtering out what was just chosen
             eligible_data = eligible_data.exclude(pk__in=data_ids)
@@ -177,7 +191,11 @@ def fill_queue(queue, orderby, irr_queue=None, irr_percent=10, batch_size=30):
 
 def generate_sql_for_fill_queue(queue, orderby_value, join_clause, cte_sql, size_sql):
     """This function merely takes the given paramters and returns an sql query to
-    execute for filling the queue."""
+    execute for filling the queue.
+
+    The query returns the ids of the data it added to the queue, so only those need
+    to be added to redis.
+    """
     sql = """
     WITH eligible_data AS (
         {cte_sql}
@@ -192,7 +210,8 @@ def generate_sql_for_fill_queue(queue, orderby_value, join_clause, cte_sql, size
     {join_clause}
     ORDER BY
         {orderby_value}
-    LIMIT ({sample_size_sql});
+    LIMIT ({sample_size_sql})
+    RETURNING {dataqueue_data_id_col};
     """.format(
         cte_sql=cte_sql,
         dataqueue_table=DataQueue._meta.db_table,
@@ -207,6 +226,132 @@ def generate_sql_for_fill_queue(queue, orderby_value, join_clause, cte_sql, size
     return sql
 
 
+def generate_sql_for_random_fill_queue(queue, cte_sql, size_sql):
+    """Return the sql query that fills a queue with randomly selected data.
+
+    Instead of sorting all of the eligible data by random(), the data are drawn by
+    independent probes of the random_key index of the unlabeled data of the
+    project, see generate_sql_for_random_sample. That index only holds the data
+    cte_sql can return, so the query reads about as many rows as it adds however
+    much of the project is labeled.
+
+    The size_sql is used four times, so its parameters must be passed four times
+    after the parameters of cte_sql. Like generate_sql_for_fill_queue the query
+    returns the ids of the data it added.
+    """
+    sql = """
+    INSERT INTO {dataqueue_table}
+       ({dataqueue_data_id_col}, {dataqueue_queue_id_col})
+    SELECT
+        sample.data_id,
+        {queue_id}
+    FROM (
+        {sample_sql}
+    ) AS sample
+    RETURNING {dataqueue_data_id_col};
+    """.format(
+        dataqueue_table=DataQueue._meta.db_table,
+        dataqueue_data_id_col=DataQueue._meta.get_field("data").column,
+        dataqueue_queue_id_col=DataQueue._meta.get_field("queue").column,
+        queue_id=queue.pk,
+        sample_sql=generate_sql_for_random_sample(cte_sql, size_sql),
+    )
+    return sql
+
+
+def generate_sql_for_random_sample(cte_sql, size_sql):
+    """Return the sql query that selects the ids of size_sql randomly selected data
+    of cte_sql, without sorting all of them by random().
+
+    Each of twice size_sql draws is a random number that probes a random_key index
+    that covers cte_sql for the first datum with a key from that number on,
+    wrapping around to the smallest key. The draws are independent, so data that are
+    next to each other in the index are not picked together. A datum is picked with
+    the probability of the gap in the keys before it, which is the same for every
+    datum in expectation as the keys are uniform random numbers.
+
+    Draws that hit the same datum count once. If too few distinct data are hit, the
+    sample is topped up with the data that follow the first draw in the index. The
+    query reads about as many rows as it selects, however many data there are.
+
+    The size_sql is used four times, so its parameters must be passed four times
+    after the parameters of cte_sql.
+    """
+    sql = """
+    WITH eligible_data AS NOT MATERIALIZED (
+        {cte_sql}
+    ), draws AS MATERIALIZED (
+        SELECT draw, random() AS start_key
+        FROM generate_series(1, 2 * ({sample_size_sql})) AS draw
+    ), probes AS (
+        SELECT probe.{data_pk_col} AS data_id, 0 AS source, draws.draw AS priority
+        FROM draws
+        CROSS JOIN LATERAL (
+            (
+                SELECT eligible_data.{data_pk_col}
+                FROM eligible_data
+                WHERE eligible_data.{random_key_col} >= draws.start_key
+                ORDER BY eligible_data.{random_key_col}
+                LIMIT 1
+            )
+            UNION ALL
+            (
+                SELECT eligible_data.{data_pk_col}
+                FROM eligible_data
+                ORDER BY eligible_data.{random_key_col}
+                LIMIT 1
+            )
+            LIMIT 1
+        ) AS probe
+    ), top_up AS (
+        (
+            SELECT
+                eligible_data.{data_pk_col} AS data_id,
+                1 AS source,
+                eligible_data.{random_key_col} AS priority
+            FROM eligible_data
+            WHERE eligible_data.{random_key_col} >= (
+                SELECT start_key FROM draws WHERE draw = 1
+            )
+            ORDER BY eligible_data.{random_key_col}
+            LIMIT ({sample_size_sql})
+        )
+        UNION ALL
+        (
+            SELECT
+                eligible_data.{data_pk_col} AS data_id,
+                1 AS source,
+                eligible_data.{random_key_col} + 1 AS priority
+            FROM eligible_data
+            WHERE eligible_data.{random_key_col} < (
+                SELECT start_key FROM draws WHERE draw = 1
+            )
+            ORDER BY eligible_data.{random_key_col}
+            LIMIT ({sample_size_sql})
+        )
+    )
+    SELECT sample.data_id
+    FROM (
+        SELECT DISTINCT ON (candidates.data_id)
+            candidates.data_id, candidates.source, candidates.priority
+        FROM (
+            SELECT data_id, source, priority::float FROM probes
+            UNION ALL
+            SELECT data_id, source, priority FROM top_up
+        ) AS candidates
+        ORDER BY candidates.data_id, candidates.source, candidates.priority
+    ) AS sample
+    ORDER BY sample.source, sample.priority
+    LIMIT ({sample_size_sql})
+    """.format(
+        cte_sql=cte_sql,
+        data_pk_col=Data._meta.pk.name,
+        random_key_col=Data._meta.get_field("random_key").column,
+        sample_size_sql=size_sql,
+    )
+    return sql
+
+
 def get_join_clause(orderby, queue):
     """This function generates the join clause used to fill queues."""
     if orderby == "random":
@@ -261,12 +406,12 @@ def get_queue_size_params(queue, queue_size, num_in_queue, batch_size, irr_queue
     return sample_size_sql, sample_size_params
 
 
-def pop_first_nonempty_queue(project, profile=None, type="normal"):
-    """Determine which queues are eligible to be popped (and in what order) and pass
-    them into redis to have the first nonempty one popped.
+def get_eligible_queues(project, profile=None, type="normal"):
+    """The queues of a project of the given type that a profile pops from, in the
+    order they are popped.
 
-    Return a (queue, data item) tuple if one was found; return a (None, None) tuple if
-    not.
+    Queues of the profile come before the queues of the whole project, and ties are
+    broken by pk.
     """
     if profile is not None:
         # Use priority to ensure we set profile queues above project queues
@@ -280,50 +425,180 @@ def pop_first_nonempty_queue(project, profile=None, type="normal"):
         priority=Value(2, IntegerField())
     )
 
-    eligible_queue_ids = [
-        redis_serialize_queue(queue)
-        for queue in (profile_queues.union(project_queues).order_by("priority", "pk"))
+    return list(profile_queues.union(project_queues).order_by("priority", "pk"))
+
+
+def get_irr_data(queue, profile, num=None):
+    """Up to num data of an IRR queue that the profile has not labeled, skipped or
+    been assigned yet, or all of them if num is None.
+
+    IRR data stay in the queue until enough coders labeled them, so each profile
+    pops them from its own redis set instead, see pop_irr_data. This query builds
+    the set.
+    """
+    return list(get_unseen_irr_data(queue, profile).order_by("pk")[:num])
+
+
+def get_unseen_irr_data(queue, profile):
+    """The queryset of the data of an IRR queue that the profile has not labeled,
+    skipped or been assigned yet, see get_irr_data."""
+    # first get the assigned data that was already labeled, or data already assigned
+    labeled_irr_data = DataLabel.objects.filter(profile=profile).values_list(
+        "data", flat=True
+    )
+    assigned_data = AssignedData.objects.filter(
+        profile=profile, queue=queue
+    ).values_list("data", flat=True)
+    skipped_data = IRRLog.objects.filter(
+        profile=profile, label__isnull=True
+    ).values_list("data", flat=True)
+    return (
+        Data.objects.filter(dataqueue__queue=queue)
+        .exclude(pk__in=labeled_irr_data)
+        .exclude(pk__in=assigned_data)
+        .exclude(pk__in=skipped_data)
+    )
+
+
+def get_irr_batch(project, profile, num):
+    """Up to num IRR data for a profile from the first eligible IRR queue.
+
+    Returns:
+        a list of (queue, data item) tuples
+    """
+    if num <= 0:
+        return []
+    irr_queues = get_eligible_queues(project, profile=profile, type="irr")
+    if len(irr_queues) == 0:
+        return []
+    return [
+        (irr_queues[0], datum) for datum in pop_irr_data(irr_queues[0], profile, num)
     ]
 
-    if type == "irr":
-        for queue_id in eligible_queue_ids:
-            queue = redis_parse_queue(queue_id.encode())
 
-            # first get the assigned data that was already labeled, or data already assigned
-            labeled_irr_data = DataLabel.objects.filter(profile=profile).values_list(
-                "data", flat=True
-            )
-            assigned_data = AssignedData.objects.filter(
-                profile=profile, queue=queue
-            ).values_list("data", flat=True)
-            skipped_data = IRRLog.objects.filter(
-                profile=profile, label__isnull=True
-            ).values_list("data", flat=True)
-            assigned_unlabeled = (
-                DataQueue.objects.filter(queue=queue)
-                .exclude(data__in=labeled_irr_data)
-                .exclude(data__in=assigned_data)
-                .exclude(data__in=skipped_data)
+def pop_irr_data(queue, profile, num):
+    """Pop up to num data of an IRR queue that the profile has not seen yet.
+
+    Each profile has a redis sorted set of the data of the queue it was not assigned
+    yet, which is built from get_irr_data on its first pop. After that, data are added
+    to it as the queue is filled or the profile gives them back, and removed as
+    they leave the queue, see add_irr_data and remove_irr_data.
+
+    The profile is registered before the set is built, so data added to the queue
+    meanwhile are added to the set as well, and only the pop that registered it
+    builds the set. A datum that left the queue or was seen by the profile between
+    the query and writing the set stays in the set, so popped data are checked
+    against the database and those are dropped.
+
+    Returns:
+        a list of Data objects
+    """
+    profiles_key = redis_serialize_irr_profiles(queue)
+    irr_key = redis_serialize_irr_set(queue, profile.pk)
+    if settings.REDIS.sadd(profiles_key, profile.pk):
+        unseen_data = get_irr_data(queue, profile)
+        if len(unseen_data) > 0:
+            settings.REDIS.zadd(
+                irr_key,
+                {redis_serialize_data(datum): datum.pk for datum in unseen_data},
             )
 
+    data = []
+    while len(data) < num:
+        popped = settings.REDIS.zpopmin(irr_key, num - len(data))
+        if len(popped) == 0:
+            break
+        data_ids = [int(pk) for pk in redis_parse_list_dataids(k for k, _ in popped)]
+        unseen_data = get_unseen_irr_data(queue, profile).in_bulk(data_ids)
+        data += [unseen_data[pk] for pk in data_ids if pk in unseen_data]
+    return data
+
+
+# Pops up to ARGV[1] data with the lowest scores from the queues, taking from each
+# queue in order until enough are popped. Returns a flat list of queue, data pairs
+POP_BATCH_SCRIPT = """
+local num = tonumber(ARGV[1])
+local result = {}
+for _, k in ipairs(KEYS) do
+    if num <= 0 then
+        break
+    end
+    local popped = redis.call('ZPOPMIN', k, num)
+    for i = 1, #popped, 2 do
+        table.insert(result, k)
+        table.insert(result, popped[i])
+    end
+    num = num - #popped / 2
+end
+return result
+"""
+
+
+def pop_queue_batch(project, num, profile=None):
+    """Pop up to num data from the normal queues of a project that a profile is
+    eligible for, atomically and in a single call to redis.
+
+    The data are read from the database in one query.
+
+    Returns:
+        a list of (queue, data item) tuples, in the order they were popped
+    """
+    queues = get_eligible_queues(project, profile=profile)
+    if num <= 0 or len(queues) == 0:
+        return []
+
+    warm_project_redis(project)
+
+    queues_by_key = {redis_serialize_queue(queue): queue for queue in queues}
+    result = settings.REDIS.eval(
+        POP_BATCH_SCRIPT, len(queues_by_key), *queues_by_key, num
+    )
+    queue_keys = [key.decode() for key in result[0::2]]
+    data_ids = [int(pk) for pk in redis_parse_list_dataids(result[1::2])]
+    data = Data.objects.in_bulk(data_ids)
+    return [
+        (queues_by_key[queue_key], data[data_id])
+        for queue_key, data_id in zip(queue_keys, data_ids)
+        if data_id in data
+    ]
+
+
+def pop_first_nonempty_queue(project, profile=None, type="normal"):
+    """Determine which queues are eligible to be popped (and in what order) and pass
+    them into redis to have the first nonempty one popped.
+
+    Return a (queue, data item) tuple if one was found; return a (None, None) tuple if
+    not.
+    """
+    eligible_queues = get_eligible_queues(project, profile=profile, type=type)
+    eligible_queue_ids = [redis_serialize_queue(queue) for queue in eligible_queues]
+
+    if type == "irr":
+        for queue in eligible_queues:
+            if profile is None:
+                irr_data = get_irr_data(queue, profile, 1)
+            else:
+                irr_data = pop_irr_data(queue, profile, 1)
+
             # if there are no elements, return none
-            if len(assigned_unlabeled) == 0:
+            if len(irr_data) == 0:
                 return (None, None)
             else:
                 # else, get the first element off the group and return it
-                datum = Data.objects.get(pk=assigned_unlabeled[0].data.pk)
-                return (queue, datum)
+                return (queue, irr_data[0])
     if len(eligible_queue_ids) == 0:
         return (None, None)
 
+    warm_project_redis(project)
+
     # Use a custom Lua script here to find the first nonempty queue atomically
-    # and pop its first item.  If all queues are empty, return nil.
+    # and pop its item with the lowest score.  If all queues are empty, return nil.
     script = settings.REDIS.register_script(
         """
     for _, k in pairs(KEYS) do
-      local m = redis.call('LPOP', k)
-      if m then
-        return {k, m}
+      local m = redis.call('ZPOPMIN', k)
+      if m[1] then
+        return {k, m[1]}
       end
     end
     return nil
@@ -348,13 +623,15 @@ def pop_queue(queue):
     intent is to pop the first nonempty queue, as it avoids
     concurrency issues.
     """
+    warm_project_redis(queue.project)
+
     # Redis first, since this op is guaranteed to be atomic
-    data_id = settings.REDIS.rpop(redis_serialize_queue(queue))
+    popped = settings.REDIS.zpopmin(redis_serialize_queue(queue))
 
-    if data_id is None:
+    if len(popped) == 0:
         return None
     else:
-        data_id = data_id.decode().split(":")[1]
+        data_id = popped[0][0].decode().split(":")[1]
 
     data_obj = Data.objects.filter(pk=data_id).get()
 
@@ -396,7 +673,7 @@ def get_nonempty_queue(project, profile=None):
 
 def handle_empty_queue(profile, project):
     """Given a profile and project, check if there is any data left for the user to
-    code, if not then refill the queue.
+    code, if not then schedule a refill of the queue, see schedule_queue_refill.
 
     Args:
         profile: user profile object
@@ -418,20 +695,94 @@ def handle_empty_queue(profile, project):
     )
 
     if queue_count - assigned_toOthers_count == 0 and irr_count == irr_labeled_count:
-        # if there is a model, use the orderby of the project, otherwise random
-        if len(Model.objects.filter(project=project)) > 0:
-            fill_queue(
-                queue=queue,
-                orderby=project.learning_method,
-                irr_queue=irr_queue,
-                irr_percent=project.percentage_irr,
-                batch_size=project.batch_size,
-            )
+        schedule_queue_refill(project)
+
+
+def fill_project_queues(project, orderby=None):
+    """Fill the normal queue of a project and its IRR queue, if it has one.
+
+    Args:
+        project: project object
+        orderby: see fill_queue. Defaults to the learning method of the project if
+            it has a model, otherwise random
+    """
+    if orderby is None:
+        if project.model_set.exists():
+            orderby = project.learning_method
         else:
-            fill_queue(
-                queue=queue,
-                orderby="random",
-                irr_queue=irr_queue,
-                irr_percent=project.percentage_irr,
-                batch_size=project.batch_size,
-            )
+            orderby = "random"
+
+    fill_queue(
+        queue=project.queue_set.get(type="normal"),
+        orderby=orderby,
+        irr_queue=project.queue_set.filter(type="irr").first(),
+        irr_percent=project.percentage_irr,
+        batch_size=project.batch_size,
+    )
+
+
+def schedule_queue_refill(project, orderby=None):
+    """Fill the queues of a project in a celery task instead of the request.
+
+    Nothing is sent if a refill of the project is already waiting for a worker,
+    and refills that arrive while one runs are coalesced into one more run, see
+    send_fill_queue_task. The orderby of the latest refill is kept in the refill
+    flag, so the run that covers it fills the queues that way, see
+    refill_project_queues.
+
+    Args:
+        project: project object
+        orderby: see fill_project_queues
+    Returns:
+        True if a refill task was sent
+    """
+    refill_key = redis_serialize_refill(project.pk)
+    pipeline = settings.REDIS.pipeline()
+    pipeline.getset(refill_key, orderby or "")
+    pipeline.expire(refill_key, settings.TASK_LOCK_TIMEOUT)
+    if pipeline.execute()[0] is not None:
+        return False
+    tasks.send_fill_queue_task.delay(project.pk, orderby)
+    return True
+
+
+def refill_project_queues(project, orderby=None):
+    """Fill the queues of a project with the orderby of the latest refill that was
+    scheduled, see schedule_queue_refill, and clear the refill flag so later refills
+    are sent again.
+
+    Args:
+        project: project object
+        orderby: used if no refill is waiting, see fill_project_queues
+    """
+    refill_key = redis_serialize_refill(project.pk)
+    pipeline = settings.REDIS.pipeline()
+    pipeline.get(refill_key)
+    pipeline.delete(refill_key)
+    requested = pipeline.execute()[0]
+    if requested is not None:
+        orderby = requested.decode() or None
+
+    fill_project_queues(project, orderby)
+
+
+def check_queue_watermark(project):
+    """Schedule a refill of the queues of a project once fewer than
+    QUEUE_LOW_WATERMARK of the normal queue's length are left in it, so the next
+    coders find data ready without waiting for fill_queue.
+
+    The data assigned to coders stay in the queue until they are labeled, and
+    fill_queue only tops the queue up to its length, so they are counted here as
+    well. Otherwise a queue whose data are mostly assigned would keep sending
+    refills that add nothing.
+
+    Returns:
+        True if a refill task was sent
+    """
+    queue = project.queue_set.filter(type="normal").first()
+    if queue is None:
+        return False
+    num_in_queue = DataQueue.objects.filter(queue=queue).count()
+    if num_in_queue >= settings.QUEUE_LOW_WATERMARK * queue.length:
+        return False
+    return schedule_queue_refill(project)
@@ -1,12 +1,21 @@
+import math
+import random
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 from django.conf import settings
-from django.db.models import Max, Min
+from django.db import connection
+from django.db.models import Exists, Max, Min, OuterRef, Q, Subquery
 from django.db.utils import ProgrammingError
 
-from core.models import AssignedData, Data, Queue
+from core.models import AssignedData, Data, DataQueue, Model, Project, Queue
 
 
 def redis_serialize_queue(queue):
-    """Serialize a queue object for redis queues.
+    """Serialize a queue object for redis queues. A redis queue is a sorted set of
+    data, which are popped lowest score first, see get_data_scores.
 
     The format is 'queue:<pk>'
     """
@@ -29,6 +38,62 @@ def redis_serialize_data(datum):
     return "data:" + str(datum.pk)
 
 
+def redis_serialize_irr_set(queue, profile_pk):
+    """Serialize the set of data of an IRR queue that a profile has not been assigned
+    yet for redis. It is a sorted set scored by the pk of the data, so every profile
+    is given the IRR data in the same order and they are finished sooner.
+
+    The format is 'irr:<queue_pk>:<profile_pk>'
+    """
+    return "irr:" + str(queue.pk) + ":" + str(profile_pk)
+
+
+def redis_serialize_irr_profiles(queue):
+    """Serialize the set of profiles whose IRR set of an IRR queue is kept up to date
+    for redis. Only those profiles' sets are changed as data enter and leave the
+    queue; the others are built when they are first popped, see pop_irr_data.
+
+    The format is 'irrprofiles:<queue_pk>'
+    """
+    return "irrprofiles:" + str(queue.pk)
+
+
+def redis_serialize_warm(project_pk):
+    """Serialize the marker that the redis queues of a project were rebuilt.
+
+    The format is 'warm:<project_pk>'
+    """
+    return "warm:" + str(project_pk)
+
+
+def redis_serialize_rebuild(rebuild_id):
+    """Serialize the prefix of the temporary keys a rebuild of the redis queues of a
+    project is written to, see rebuild_project_redis.
+
+    The format is 'rebuild:<rebuild_id>:'
+    """
+    return "rebuild:" + rebuild_id + ":"
+
+
+def redis_serialize_refill(project_pk):
+    """Serialize the flag that a refill of the queues of a project was sent. Its
+    value is the orderby of the latest refill, or empty for the default one, see
+    schedule_queue_refill.
+
+    The format is 'refill:<project_pk>'
+    """
+    return "refill:" + str(project_pk)
+
+
+def redis_serialize_artifact_cache(process):
+    """Serialize the statistics of the artifact cache of a process for redis, see
+    utils_cache.
+
+    The format is 'artifactcache:<hostname>:<pid>'
+    """
+    return "artifactcache:" + process
+
+
 def redis_parse_queue(queue_key):
     """Parse a queue key from redis and return the Queue object."""
     queue_pk = queue_key.decode().split(":")[1]
@@ -74,28 +139,136 @@ def get_ordered_data(data_ids, orderby):
         return data_objs.order_by("?")
     elif orderby == "least confident":
         return data_objs.annotate(
-            max_least_confident=Max("datauncertainty__least_confident")
+            max_least_confident=Max(
+                "datauncertainty__least_confident", filter=latest_uncertainty_filter()
+            )
         ).order_by("-max_least_confident")
     elif orderby == "margin sampling":
         return data_objs.annotate(
-            min_margin_sampling=Min("datauncertainty__margin_sampling")
+            min_margin_sampling=Min(
+                "datauncertainty__margin_sampling", filter=latest_uncertainty_filter()
+            )
         ).order_by("min_margin_sampling")
     elif orderby == "entropy":
-        return data_objs.annotate(max_entropy=Max("datauncertainty__entropy")).order_by(
-            "-max_entropy"
+        return data_objs.annotate(
+            max_entropy=Max(
+                "datauncertainty__entropy", filter=latest_uncertainty_filter()
+            )
+        ).order_by("-max_entropy")
+
+
+# The aggregate of the uncertainty scores a datum is ordered by for each orderby
+# option, and the sign that makes the datum to label first have the lowest score
+ORDERBY_SCORES = {
+    "least confident": (Max, "datauncertainty__least_confident", -1),
+    "margin sampling": (Min, "datauncertainty__margin_sampling", 1),
+    "entropy": (Max, "datauncertainty__entropy", -1),
+}
+
+
+def latest_uncertainty_filter(prefix="", project=None):
+    """Filter the uncertainty scores of a datum to those of the latest model of its
+    project, like get_join_clause does for fill_queue, so the scores of older models
+    do not decide the order.
+
+    Args:
+        prefix: the lookup from the aggregated model to the datum, ex: "data__"
+        project: the project of every datum, if known, so the query is not grouped
+            by the project of each datum
+    Returns:
+        a Q object to pass as the filter of the aggregate in ORDERBY_SCORES
+    """
+    if project is None:
+        models = Model.objects.filter(project=OuterRef(prefix + "project"))
+    else:
+        models = Model.objects.filter(project=project)
+    latest_model = models.order_by("-pk").values("pk")[:1]
+    return Q(**{prefix + "datauncertainty__model": Subquery(latest_model)})
+
+
+# The score of a datum put back in its queue, so it is the next one popped
+UNASSIGNED_SCORE = -math.inf
+
+# How long to wait between checks that another process finished warming a project
+REDIS_WARM_WAIT_SECONDS = 0.1
+
+# Replaces live redis queues and sets with the temporary keys of a rebuild, given as
+# (temporary queue, queue, temporary set, set) keys for each queue. Anything written
+# to a live key during the rebuild is merged in first, keeping the lowest score
+REPLACE_QUEUE_KEYS_SCRIPT = """
+for i = 1, #KEYS, 4 do
+    if redis.call("exists", KEYS[i + 1]) == 1 then
+        redis.call("zunionstore", KEYS[i], 2, KEYS[i], KEYS[i + 1], "aggregate", "min")
+    end
+    if redis.call("exists", KEYS[i + 3]) == 1 then
+        redis.call("sunionstore", KEYS[i + 2], KEYS[i + 2], KEYS[i + 3])
+    end
+    for j = i, i + 2, 2 do
+        if redis.call("exists", KEYS[j]) == 1 then
+            redis.call("rename", KEYS[j], KEYS[j + 1])
+            redis.call("persist", KEYS[j + 1])
+        end
+    end
+end
+return 0
+"""
+
+
+def get_data_scores(data_ids, orderby):
+    """Score a list of data ids for the redis sorted set queues, which pop the lowest
+    score first. The scores give the same order as get_ordered_data.
+
+    Data without an uncertainty score come first when ordering by least confident
+    or entropy and last when ordering by margin sampling, as they do in the
+    database order.
+
+    Args:
+        data_ids: List of data_ids
+        orderby: String of order by options. ["random", "least confident",
+            "margin sampling", "entropy"]
+    Returns:
+        a dict of serialized data to score, which can be passed to zadd
+    """
+    ORDERBY_OPTIONS = ["random", "least confident", "margin sampling", "entropy"]
+    if orderby not in ORDERBY_OPTIONS:
+        raise ValueError(
+            "orderby parameter must be one of the following: "
+            + " ".join(ORDERBY_OPTIONS)
         )
 
+    data_objs = Data.objects.filter(pk__in=data_ids).only("pk")
+
+    if orderby == "random":
+        return {redis_serialize_data(d): random.random() for d in data_objs}
 
-def init_redis():
+    aggregate, field, sign = ORDERBY_SCORES[orderby]
+    return {
+        redis_serialize_data(d): sign * (math.inf if d.score is None else d.score)
+        for d in data_objs.annotate(
+            score=aggregate(field, filter=latest_uncertainty_filter())
+        )
+    }
+
+
+def init_redis(lazy=None, workers=None):
     """Create a redis queue and set for each queue in the database and fill it with the
     data linked to the queue.
 
     This will remove any existing queue keys from redis and re-populate the redis db to
-    be in sync with the postgres state
+    be in sync with the postgres state. Each project is rebuilt with one streaming
+    query, see rebuild_project_redis.
+
+    Args:
+        lazy: only remove the keys, and rebuild each project the first time its
+            queues are popped, see warm_project_redis. Defaults to
+            settings.REDIS_LAZY_INIT
+        workers: the number of projects rebuilt at a time. Defaults to
+            settings.REDIS_INIT_WORKERS
     """
-    # Use a pipeline to reduce back-and-forth with the server
+    lazy = settings.REDIS_LAZY_INIT if lazy is None else lazy
+    workers = settings.REDIS_INIT_WORKERS if workers is None else workers
     try:
-        assigned_data_ids = set((d.data_id for d in AssignedData.objects.all()))
+        projects = list(Project.objects.filter(queue__isnull=False).distinct())
     except ProgrammingError:
         raise ValueError(
             "There are unrun migrations.  Please migrate the database."
@@ -103,35 +276,201 @@ def init_redis():
             " Then restart the django server."
         )
 
+    # Use a pipeline to reduce back-and-forth with the server
+    pipeline = settings.REDIS.pipeline(transaction=False)
+    for pattern in ["queue:*", "set:*", "irr:*", "irrprofiles:*", "warm:*"]:
+        for key in settings.REDIS.scan_iter(pattern, count=settings.REDIS_CHUNK_SIZE):
+            pipeline.delete(key)
+    pipeline.execute()
+
+    if lazy:
+        return
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(rebuild_project_redis_in_thread, projects))
+    else:
+        for project in projects:
+            rebuild_project_redis(project)
+
+
+def rebuild_project_redis(project):
+    """Rebuild the redis queues and sets of a project from the unassigned data of its
+    queues in the database, and mark the project as warm.
+
+    The data of all of the queues are read in one query, ordered by the learning
+    method of the project, and streamed REDIS_CHUNK_SIZE data at a time into
+    temporary keys, which then replace the live keys in one step, see
+    REPLACE_QUEUE_KEYS_SCRIPT. Data written to the live keys while the query ran are
+    kept, so the rebuild never loses a concurrent fill_queue. The live keys are
+    cleared beforehand by init_redis.
+    """
+    orderby = project.learning_method
+    queue_data = (
+        DataQueue.objects.filter(queue__project=project)
+        .filter(~Exists(AssignedData.objects.filter(data_id=OuterRef("data_id"))))
+        .values_list("queue_id", "data_id")
+        .order_by()
+    )
+    if orderby != "random":
+        aggregate, field, sign = ORDERBY_SCORES[orderby]
+        queue_data = queue_data.annotate(
+            score=aggregate(
+                "data__" + field, filter=latest_uncertainty_filter("data__", project)
+            )
+        )
+
+    prefix = redis_serialize_rebuild(uuid.uuid4().hex)
     pipeline = settings.REDIS.pipeline(transaction=False)
+    queue_scores = defaultdict(dict)
+    num_read = 0
+    for row in queue_data.iterator(chunk_size=settings.REDIS_CHUNK_SIZE):
+        if orderby == "random":
+            score = random.random()
+        else:
+            score = sign * (math.inf if row[2] is None else row[2])
+        queue_scores[row[0]]["data:" + str(row[1])] = score
+        num_read += 1
+        if num_read % settings.REDIS_CHUNK_SIZE == 0:
+            add_queue_scores(pipeline, queue_scores, prefix)
+            pipeline.execute()
+            queue_scores.clear()
+    add_queue_scores(pipeline, queue_scores, prefix)
+    pipeline.execute()
+
+    keys = []
+    for queue in project.queue_set.all():
+        queue_key = redis_serialize_queue(queue)
+        set_key = redis_serialize_set(queue)
+        keys += [prefix + queue_key, queue_key, prefix + set_key, set_key]
+    if len(keys) > 0:
+        settings.REDIS.eval(REPLACE_QUEUE_KEYS_SCRIPT, len(keys), *keys)
+    settings.REDIS.set(redis_serialize_warm(project.pk), 1)
+
+
+def rebuild_project_redis_in_thread(project):
+    """Run rebuild_project_redis in a worker thread, which has its own database
+    connection that has to be closed when it is done."""
+    try:
+        rebuild_project_redis(project)
+    finally:
+        connection.close()
+
+
+def add_queue_scores(pipeline, queue_scores, prefix=""):
+    """Queue the commands adding a dict of queue pk to data scores to the redis
+    queues and sets on a pipeline.
+
+    With a prefix the data are added to the temporary keys of a rebuild, which
+    expire after TASK_LOCK_TIMEOUT seconds in case the rebuild dies.
+    """
+    for queue_pk, data_scores in queue_scores.items():
+        set_key = prefix + "set:" + str(queue_pk)
+        queue_key = prefix + "queue:" + str(queue_pk)
+        pipeline.sadd(set_key, *data_scores)
+        pipeline.zadd(queue_key, data_scores)
+        if prefix:
+            pipeline.expire(set_key, settings.TASK_LOCK_TIMEOUT)
+            pipeline.expire(queue_key, settings.TASK_LOCK_TIMEOUT)
+
+
+def warm_project_redis(project):
+    """Rebuild the redis queues of a project if they were left cold by a lazy
+    init_redis. Does nothing unless settings.REDIS_LAZY_INIT is set.
+
+    Only one process rebuilds a project while the others wait until it is warm. The
+    lock is a lease of REDIS_WARM_LOCK_TIMEOUT seconds, and a process that has waited
+    that long rebuilds the project from the database itself, so a rebuild that hangs
+    or dies does not block the project's queues.
+    """
+    if not settings.REDIS_LAZY_INIT:
+        return
+
+    warm_key = redis_serialize_warm(project.pk)
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.REDIS_WARM_LOCK_TIMEOUT
+    while not settings.REDIS.exists(warm_key):
+        if acquire_task_lock(
+            project.pk, "redis", owner, timeout=settings.REDIS_WARM_LOCK_TIMEOUT
+        ):
+            try:
+                if not settings.REDIS.exists(warm_key):
+                    rebuild_project_redis(project)
+            finally:
+                release_task_lock(project.pk, "redis", owner)
+        elif time.monotonic() >= deadline:
+            rebuild_project_redis(project)
+        else:
+            time.sleep(REDIS_WARM_WAIT_SECONDS)
+
+
+def add_redis_objects(queue, data_ids, orderby):
+    """Add data that were just added to a DataQueue to the redis set and queue.
+
+    Only the given data are scored and written, in one pipeline, so the cost does not
+    grow with the size of the queue. See sync_redis_objects to resync a whole queue.
+
+    Args:
+        queue: Queue object
+        data_ids: the ids of the data added to the queue
+        orderby: String of order by options, see get_data_scores
+    """
+    data_scores = get_data_scores(data_ids, orderby)
+    if len(data_scores) > 0:
+        pipeline = settings.REDIS.pipeline(transaction=False)
+        pipeline.sadd(redis_serialize_set(queue), *data_scores)
+        pipeline.zadd(redis_serialize_queue(queue), data_scores)
+        pipeline.execute()
+
 
-    existing_queue_keys = [key for key in settings.REDIS.scan_iter("queue:*")]
-    existing_set_keys = [key for key in settings.REDIS.scan_iter("set:*")]
-    if len(existing_queue_keys) > 0:
-        # We'll get an error if we try to del without any keys
-        pipeline.delete(*existing_queue_keys)
-    if len(existing_set_keys) > 0:
-        pipeline.delete(*existing_set_keys)
+def get_irr_profile_pks(queue, profile=None):
+    """The pks of the profiles whose IRR set of the queue is kept up to date, or
+    only the given profile if its set is."""
+    profiles_key = redis_serialize_irr_profiles(queue)
+    if profile is None:
+        return [pk.decode() for pk in settings.REDIS.smembers(profiles_key)]
+    if settings.REDIS.sismember(profiles_key, profile.pk):
+        return [profile.pk]
+    return []
 
+
+def add_irr_data(queue, data_ids, profile=None):
+    """Add data that are new to an IRR queue to the IRR sets of every profile, or data
+    given back by a profile to the IRR set of that profile.
+
+    Args:
+        queue: the IRR Queue object
+        data_ids: the ids of the data
+        profile: the profile the data were unassigned from, if any
+    """
+    if len(data_ids) == 0:
+        return
+    data_scores = {"data:" + str(pk): int(pk) for pk in data_ids}
+    pipeline = settings.REDIS.pipeline(transaction=False)
+    for profile_pk in get_irr_profile_pks(queue, profile):
+        pipeline.zadd(redis_serialize_irr_set(queue, profile_pk), data_scores)
     pipeline.execute()
 
-    for queue in Queue.objects.all():
-        data_ids = [d.pk for d in queue.data.all() if d.pk not in assigned_data_ids]
-        data_ids = [
-            redis_serialize_data(d)
-            for d in get_ordered_data(data_ids, "least confident")
-        ]
-        if len(data_ids) > 0:
-            # We'll get an error if we try to lpush without any data
-            pipeline.sadd(redis_serialize_set(queue), *data_ids)
-            pipeline.lpush(redis_serialize_queue(queue), *data_ids)
 
+def remove_irr_data(queue, datum, profile=None):
+    """Remove a datum from the IRR set of a profile that labeled or skipped it, or from
+    the sets of every profile when it leaves the IRR queue."""
+    pipeline = settings.REDIS.pipeline(transaction=False)
+    for profile_pk in get_irr_profile_pks(queue, profile):
+        pipeline.zrem(
+            redis_serialize_irr_set(queue, profile_pk), redis_serialize_data(datum)
+        )
     pipeline.execute()
 
 
 def sync_redis_objects(queue, orderby):
     """Given a DataQueue sync the redis set with the DataQueue and then update the redis
-    queue with the appropriate new ordered data."""
+    queue with the appropriate new ordered data.
+
+    Every unassigned datum of the queue is scored again, so data already in the redis
+    queue are reordered by the latest uncertainty scores as well. This reads the
+    whole queue; fill_queue only adds the new data, see add_redis_objects.
+    """
     ORDERBY_OPTIONS = ["random", "least confident", "margin sampling", "entropy"]
     if orderby not in ORDERBY_OPTIONS:
         raise ValueError(
@@ -144,21 +483,161 @@ def sync_redis_objects(queue, orderby):
         settings.REDIS.sadd(redis_serialize_set(queue), *data_ids)
 
         redis_set_data = settings.REDIS.smembers(redis_serialize_set(queue))
-        redis_queue_data = settings.REDIS.lrange(redis_serialize_queue(queue), 0, -1)
-
-        # IDs not already in redis queue
-        new_data_ids = redis_parse_list_dataids(
-            redis_set_data.difference(set(redis_queue_data))
-        )
 
         # IDs not already assigned
-        new_data_ids = set(new_data_ids).difference(
+        unassigned_data_ids = set(redis_parse_list_dataids(redis_set_data)).difference(
             [str(a.data.pk) for a in AssignedData.objects.filter(queue=queue)]
         )
 
-        ordered_data_ids = [
-            redis_serialize_data(d) for d in get_ordered_data(new_data_ids, orderby)
-        ]
+        data_scores = get_data_scores(unassigned_data_ids, orderby)
+        if len(data_scores) > 0:
+            settings.REDIS.zadd(redis_serialize_queue(queue), data_scores)
+
 
-        if len(ordered_data_ids) > 0:
-            settings.REDIS.rpush(redis_serialize_queue(queue), *ordered_data_ids)
+# Deletes a lock only if it is still held by the given owner, so a task whose lease
+# expired cannot release the lock of the task that took it over
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def redis_serialize_lock(project_pk, task_type):
+    """Serialize the lock of a type of task of a project for redis.
+
+    The format is 'lock:<project_pk>:<task_type>'
+    """
+    return "lock:" + str(project_pk) + ":" + task_type
+
+
+def redis_serialize_lock_pending(project_pk, task_type):
+    """Serialize the flag that a locked task was triggered again for redis.
+
+    The format is 'pending:<project_pk>:<task_type>'
+    """
+    return "pending:" + str(project_pk) + ":" + task_type
+
+
+def redis_serialize_lock_follow_up(project_pk, task_type):
+    """Serialize the flag that a trigger of a locked task asked for its follow up
+    for redis, see run_coalesced.
+
+    The format is 'followup:<project_pk>:<task_type>'
+    """
+    return "followup:" + str(project_pk) + ":" + task_type
+
+
+def acquire_task_lock(project_pk, task_type, owner, timeout=None):
+    """Take the lock of a type of task of a project, if no one holds it.
+
+    The lock is a lease that expires after TASK_LOCK_TIMEOUT seconds, so a task that
+    dies without releasing it does not block the project forever.
+
+    Args:
+        project_pk: The pk of the project
+        task_type: the type of task, ex: "model" or "features"
+        owner: a string that identifies the holder of the lock
+        timeout: seconds until the lease expires, defaults to TASK_LOCK_TIMEOUT
+    Returns:
+        True if the lock was taken
+    """
+    return bool(
+        settings.REDIS.set(
+            redis_serialize_lock(project_pk, task_type),
+            owner,
+            nx=True,
+            ex=settings.TASK_LOCK_TIMEOUT if timeout is None else timeout,
+        )
+    )
+
+
+def release_task_lock(project_pk, task_type, owner):
+    """Release the lock of a type of task of a project if owner still holds it."""
+    return bool(
+        settings.REDIS.eval(
+            RELEASE_LOCK_SCRIPT, 1, redis_serialize_lock(project_pk, task_type), owner
+        )
+    )
+
+
+def run_coalesced(project_pk, task_type, run, follow_up=None, request_follow_up=False):
+    """Call run unless the same type of task is already running for the project.
+
+    Triggers that arrive while it runs are coalesced: the running task calls run once
+    more when it is done, however many triggers there were. The pending flag is set
+    before the lock is tried, so a trigger is never lost between the running task
+    finishing and releasing the lock.
+
+    A trigger left to another task cannot chain anything after its own run, so it
+    can ask for the follow up instead. The request is set before the pending flag
+    and taken at the start of a run, so the task whose run takes it calls follow_up
+    after a run that started after the trigger.
+
+    Args:
+        project_pk: The pk of the project
+        task_type: the type of task, ex: "features"
+        run: function that does the work
+        follow_up: function called after a run that took a follow up request, every
+            task of the type should pass the same one
+        request_follow_up: ask for follow_up after a run that covers this trigger
+    Returns:
+        the result of the last call of run, or None if it was left to another task
+    """
+    pending_key = redis_serialize_lock_pending(project_pk, task_type)
+    follow_up_key = redis_serialize_lock_follow_up(project_pk, task_type)
+    owner = uuid.uuid4().hex
+    if request_follow_up:
+        settings.REDIS.set(follow_up_key, owner, ex=settings.TASK_LOCK_TIMEOUT)
+    settings.REDIS.set(pending_key, owner, ex=settings.TASK_LOCK_TIMEOUT)
+
+    result = None
+    while settings.REDIS.exists(pending_key) and acquire_task_lock(
+        project_pk, task_type, owner
+    ):
+        follow_up_requested = False
+        try:
+            settings.REDIS.delete(pending_key)
+            if follow_up is not None:
+                pipeline = settings.REDIS.pipeline()
+                pipeline.get(follow_up_key)
+                pipeline.delete(follow_up_key)
+                follow_up_requested = pipeline.execute()[0] is not None
+            result = run()
+        finally:
+            release_task_lock(project_pk, task_type, owner)
+        if follow_up_requested:
+            follow_up()
+    return result
+
+
+def get_task_locks(project_pk):
+    """The task locks of a project that are held or have a pending trigger.
+
+    Returns:
+        a list of dicts with the task type, the owner of the lock, the seconds until
+        the lease expires and whether the task was triggered again while it ran
+    """
+    task_types = set()
+    for pattern in ["lock:{}:*", "pending:{}:*"]:
+        for key in settings.REDIS.scan_iter(pattern.format(project_pk)):
+            task_types.add(key.decode().split(":", 2)[2])
+
+    locks = []
+    for task_type in sorted(task_types):
+        lock_key = redis_serialize_lock(project_pk, task_type)
+        owner = settings.REDIS.get(lock_key)
+        locks.append(
+            {
+                "task": task_type,
+                "owner": owner.decode() if owner else None,
+                "expires_in": max(settings.REDIS.ttl(lock_key), 0),
+                "pending": bool(
+                    settings.REDIS.exists(
+                        redis_serialize_lock_pending(project_pk, task_type)
+                    )
+                ),
+            }
+        )
+    return locks
@@ -0,0 +1,117 @@
+import re
+import resource
+import time
+from contextlib import contextmanager
+
+# The peak memory of each measure_stage block that has not ended yet, in kB
+_open_stage_peaks = []
+
+
+def current_peak_rss_kb():
+    """The peak resident memory in kB of this process since it was last reset, see
+    reset_peak_rss, or None where there is no /proc/self/status."""
+    try:
+        with open("/proc/self/status") as status_file:
+            match = re.search(r"^VmHWM:\s+(\d+) kB", status_file.read(), re.M)
+    except OSError:
+        return None
+    return int(match.group(1)) if match else None
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of this process to its current resident
+    memory, by writing 5 to /proc/self/clear_refs (Linux only).
+
+    Returns:
+        True if the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def children_peak_rss_kb():
+    """The peak resident memory in kB of the largest finished child process.
+    ru_maxrss is in kilobytes on Linux."""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+@contextmanager
+def measure_stage():
+    """Measure the wall time, CPU time and peak memory of the code in a with block.
+
+    The peak memory is that of the process during the block, or of a child process
+    that finished during the block if that is larger, so in a long lived worker it
+    is not the peak of an earlier task. The peak of the process is reset when the
+    block starts, after it is recorded for any blocks the block is nested in. Where
+    it cannot be reset, ex: not on Linux, it is the peak of the whole process up to
+    the end of the block.
+
+    Yields:
+        stats: a dict filled in with "wall_seconds", "cpu_seconds" and "peak_rss_mb"
+            when the block ends. Row counts and the like can be added to it.
+    """
+    stats = {}
+    peak_kb = current_peak_rss_kb()
+    if peak_kb is not None:
+        for i, outer_peak_kb in enumerate(_open_stage_peaks):
+            _open_stage_peaks[i] = max(outer_peak_kb, peak_kb)
+    if not reset_peak_rss():
+        peak_kb = None
+    _open_stage_peaks.append(0)
+    start_children_kb = children_peak_rss_kb()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield stats
+    finally:
+        stage_peak_kb = _open_stage_peaks.pop()
+    stats["wall_seconds"] = time.perf_counter() - start_wall
+    stats["cpu_seconds"] = time.process_time() - start_cpu
+
+    if peak_kb is None:
+        stage_peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    else:
+        stage_peak_kb = max(stage_peak_kb, current_peak_rss_kb())
+    # ru_maxrss of the children only grows when a larger child finished
+    end_children_kb = children_peak_rss_kb()
+    if end_children_kb > start_children_kb:
+        stage_peak_kb = max(stage_peak_kb, end_children_kb)
+    stats["peak_rss_mb"] = stage_peak_kb / 1024
+
+
+def summarize_stage_metrics(stage_metrics):
+    """Reduce the stage_metrics of a Model to one number per metric.
+
+    The shards of a prediction run in parallel, so their wall times are added up
+    as the total work done, and the peak memory is the largest of any stage.
+
+    Args:
+        stage_metrics: the dict of "features", "train" and "predict" stats
+    Returns:
+        a dict of metric name to value. Metrics of stages that were not
+        measured are left out
+    """
+    summary = {}
+    features = stage_metrics.get("features")
+    train = stage_metrics.get("train")
+    shards = list((stage_metrics.get("predict") or {}).values())
+    stages = [stats for stats in [features, train] + shards if stats]
+
+    if features:
+        summary["features_seconds"] = features["wall_seconds"]
+    if train:
+        summary["train_seconds"] = train["wall_seconds"]
+        summary["train_cpu_seconds"] = train["cpu_seconds"]
+        summary["train_rows"] = train["rows"]
+        summary["n_features"] = train["features"]
+    if shards:
+        summary["predict_seconds"] = sum(stats["wall_seconds"] for stats in shards)
+        summary["predict_cpu_seconds"] = sum(stats["cpu_seconds"] for stats in shards)
+        summary["predict_rows"] = sum(stats["rows"] for stats in shards)
+    if stages:
+        summary["peak_rss_mb"] = max(stats["peak_rss_mb"] for stats in stages)
+    return summary
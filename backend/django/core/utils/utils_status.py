@@ -0,0 +1,103 @@
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+
+from core.models import AssignedData, Data, DataLabel, DataQueue, Queue, RecycleBin
+
+
+def generate_sql_for_data_status():
+    """The sql CASE expression giving the status of the datum aliased as d.
+
+    The first matching status wins: a recycled datum stays recycled whatever else
+    it is in, and an IRR datum only counts as labeled once the IRR labels are
+    resolved and irr_ind is cleared.
+    """
+    return """
+    CASE
+        WHEN EXISTS (
+            SELECT 1 FROM {recyclebin_table} r WHERE r.{recyclebin_data_id_col} = d.id
+        ) THEN 'recycled'
+        WHEN NOT d.{irr_ind_col} AND EXISTS (
+            SELECT 1 FROM {datalabel_table} l WHERE l.{datalabel_data_id_col} = d.id
+        ) THEN 'labeled'
+        WHEN EXISTS (
+            SELECT 1
+            FROM {dataqueue_table} dq
+            INNER JOIN {queue_table} q ON q.id = dq.{dataqueue_queue_id_col}
+            WHERE dq.{dataqueue_data_id_col} = d.id AND q.{queue_type_col} = 'admin'
+        ) THEN 'adjudication'
+        WHEN EXISTS (
+            SELECT 1 FROM {assigneddata_table} a WHERE a.{assigneddata_data_id_col} = d.id
+        ) THEN 'assigned'
+        WHEN d.{irr_ind_col} THEN 'irr'
+        WHEN EXISTS (
+            SELECT 1 FROM {dataqueue_table} dq WHERE dq.{dataqueue_data_id_col} = d.id
+        ) THEN 'queued'
+        ELSE 'unlabeled'
+    END
+    """.format(
+        recyclebin_table=RecycleBin._meta.db_table,
+        recyclebin_data_id_col=RecycleBin._meta.get_field("data").column,
+        irr_ind_col=Data._meta.get_field("irr_ind").column,
+        datalabel_table=DataLabel._meta.db_table,
+        datalabel_data_id_col=DataLabel._meta.get_field("data").column,
+        dataqueue_table=DataQueue._meta.db_table,
+        dataqueue_data_id_col=DataQueue._meta.get_field("data").column,
+        dataqueue_queue_id_col=DataQueue._meta.get_field("queue").column,
+        queue_table=Queue._meta.db_table,
+        queue_type_col=Queue._meta.get_field("type").column,
+        assigneddata_table=AssignedData._meta.db_table,
+        assigneddata_data_id_col=AssignedData._meta.get_field("data").column,
+    )
+
+
+def update_data_status(data):
+    """Recompute the status of the given data from the tables it is derived from.
+
+    Call this in the same transaction as any change to the labels, queues,
+    assignments, recycle bin or irr_ind of the data, so the status is never out
+    of date for another connection.
+
+    Args:
+        data: a queryset of Data
+    Returns:
+        the number of data whose status changed
+    """
+    try:
+        subquery_sql, params = data.values("pk").query.sql_with_params()
+    except EmptyResultSet:
+        # ex: filtering on an empty list of pks
+        return 0
+    sql = """
+    UPDATE {data_table}
+    SET {status_col} = new_status.status
+    FROM (
+        SELECT d.id, {status_case} AS status
+        FROM {data_table} d
+        WHERE d.id IN ({subquery_sql})
+    ) new_status
+    WHERE {data_table}.id = new_status.id
+        AND {data_table}.{status_col} <> new_status.status
+    """.format(
+        data_table=Data._meta.db_table,
+        status_col=Data._meta.get_field("status").column,
+        status_case=generate_sql_for_data_status(),
+        subquery_sql=subquery_sql,
+    )
+    with connection.cursor() as c:
+        c.execute(sql, params)
+        return c.rowcount
+
+
+def rebuild_data_status(project=None):
+    """Recompute the status of every datum, or of every datum of a project.
+
+    The status is kept up to date as the data are labeled, so this only repairs
+    data changed outside of the annotation code, ex: by hand in the database.
+
+    Returns:
+        the number of data whose status was wrong
+    """
+    data = Data.objects.all()
+    if project is not None:
+        data = data.filter(project=project)
+    return update_data_status(data)
@@ -4,17 +4,22 @@ import os
 import tempfile
 import zipfile
 
+import numpy as np
+import pandas as pd
 from django.conf import settings
 from django.http import HttpResponse
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
+from scipy import sparse
 
-from core.models import Project, IRRLog
+from core.models import Data, IRRLog, Model, Project, TrainingSet
 from core.permissions import IsAdminOrCreator
 from core.templatetags import project_extras
 from core.utils.util import get_labeled_data
 from core.utils.utils_external_db import export_table, load_ingest_table
+from core.utils.utils_features import load_feature_matrix
+from core.utils.utils_model import get_model_artifacts
 
 
 @api_view(["GET"])
@@ -60,12 +65,6 @@ def download_model(request, project_pk, unverified):
     # https://stackoverflow.com/questions/12881294/django-create-a-zip-of-multiple-files-and-make-it-downloadable
     zip_subdir = "model_project" + str(project_pk)
 
-    tfidf_path = os.path.join(
-        settings.TF_IDF_PATH, "project_" + str(project_pk) + "_tfidf_matrix.pkl"
-    )
-    tfidf_vectorizer_path = os.path.join(
-        settings.TF_IDF_PATH, "project_" + str(project_pk) + "_vectorizer.pkl"
-    )
     readme_path = os.path.join(settings.BASE_DIR, "core", "data", "README.pdf")
     dockerfile_path = os.path.join(settings.BASE_DIR, "core", "data", "Dockerfile")
     requirements_path = os.path.join(
@@ -77,14 +76,22 @@ def download_model(request, project_pk, unverified):
     usage_examples_path = os.path.join(
         settings.BASE_DIR, "core", "data", "UsageExamples.ipynb"
     )
+    # the latest model was trained on the training set before the current one, its
+    # manifest gives the feature matrix, vectorizer and model that belong together
     current_training_set = project.get_current_training_set()
-    model_path = os.path.join(
-        settings.MODEL_PICKLE_PATH,
-        "project_"
-        + str(project_pk)
-        + "_training_"
-        + str(current_training_set.set_number - 1)
-        + ".pkl",
+    trained_set = TrainingSet.objects.filter(
+        project=project, set_number=current_training_set.set_number - 1
+    ).first()
+    if (
+        trained_set is None
+        or not Model.objects.filter(training_set=trained_set).exists()
+    ):
+        return Response(
+            {"error": "No model has been trained for this project yet."},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+    feature_path, vectorizer_path, model_path = get_model_artifacts(
+        project, trained_set
     )
 
     data, label_data = get_labeled_data(project, bool(int(unverified)))
@@ -97,6 +104,36 @@ def download_model(request, project_pk, unverified):
     temp_labeleddata_file.flush()
     temp_labeleddata_file.close()
 
+    # The stored features are memory-mapped, so they are streamed into a standard
+    # scipy .npz file (or a .npy file for embeddings) along with the ID of the
+    # datum in each row
+    tfidf_matrix = load_feature_matrix(feature_path)
+    dense = tfidf_matrix.meta.get("format") == "dense"
+    if dense:
+        features_name = "_embeddings.npy"
+    else:
+        features_name = "_tfidf_matrix.npz"
+    feature_paths = [vectorizer_path] if vectorizer_path else []
+    temp_tfidf_file = tempfile.NamedTemporaryFile(
+        suffix=features_name[-4:], delete=False, dir=settings.DATA_DIR
+    )
+    temp_tfidf_file.close()
+    if dense:
+        np.save(temp_tfidf_file.name, tfidf_matrix.values)
+    else:
+        sparse.save_npz(temp_tfidf_file.name, tfidf_matrix.to_csr())
+
+    upload_ids = dict(
+        Data.objects.filter(project=project).values_list("upload_id_hash", "upload_id")
+    )
+    temp_row_id_file = tempfile.NamedTemporaryFile(
+        mode="w", suffix=".csv", delete=False, dir=settings.DATA_DIR
+    )
+    pd.DataFrame({"ID": [upload_ids[key] for key in tfidf_matrix.row_keys()]}).to_csv(
+        temp_row_id_file.name, index=False
+    )
+    temp_row_id_file.close()
+
     temp_label_file = tempfile.NamedTemporaryFile(
         mode="w", suffix=".csv", delete=False, dir=settings.DATA_DIR
     )
@@ -109,8 +146,9 @@ def download_model(request, project_pk, unverified):
     # open the zip folder
     zip_file = zipfile.ZipFile(s, "w")
     for path in [
-        tfidf_path,
-        tfidf_vectorizer_path,
+        temp_tfidf_file.name,
+        temp_row_id_file.name,
+        *feature_paths,
         readme_path,
         model_path,
         temp_labeleddata_file.name,
@@ -125,10 +163,26 @@ def download_model(request, project_pk, unverified):
             fname = "project_" + str(project_pk) + "_labels.csv"
         elif path == temp_labeleddata_file.name:
             fname = "project_" + str(project_pk) + "_labeled_data.csv"
+        elif path == temp_tfidf_file.name:
+            fname = "project_" + str(project_pk) + features_name
+        elif path == temp_row_id_file.name:
+            fname = "project_" + str(project_pk) + "_tfidf_row_ids.csv"
+        elif path == vectorizer_path:
+            fname = "project_" + str(project_pk) + "_vectorizer.pkl"
+        elif path == model_path:
+            fname = (
+                "project_"
+                + str(project_pk)
+                + "_training_"
+                + str(trained_set.set_number)
+                + ".pkl"
+            )
         # write the file to the zip folder
         zip_path = os.path.join(zip_subdir, fname)
         zip_file.write(path, zip_path)
     zip_file.close()
+    os.remove(temp_tfidf_file.name)
+    os.remove(temp_row_id_file.name)
 
     response = HttpResponse(s.getvalue(), content_type="application/x-zip-compressed")
     response["Content-Disposition"] = "attachment;"
@@ -1,3 +1,5 @@
+import uuid
+
 from django.contrib.postgres.fields import ArrayField
 from django.db import connection
 from django.db.models import FloatField
@@ -7,6 +9,7 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from core.serializers import IRRLogModelSerializer
 
+from core import tasks
 from core.models import (
     AssignedData,
     Data,
@@ -18,12 +21,14 @@ from core.models import (
     Profile,
     Project,
     ProjectPermissions,
-    TrainingSet,
 )
 from core.permissions import IsAdminOrCreator, IsCoder
 from core.utils.util import irr_heatmap_data, perc_agreement_table_data, project_status
 from core.utils.utils_annotate import leave_coding_page, unassign_datum
+from core.utils.utils_cache import get_artifact_cache_stats
 from core.utils.utils_model import cohens_kappa, fleiss_kappa
+from core.utils.utils_redis import acquire_task_lock, get_task_locks
+from core.utils.utils_resources import summarize_stage_metrics
 
 
 @api_view(["GET"])
@@ -108,6 +113,20 @@ def label_timing(request, project_pk):
     return Response({"data": dataset, "yDomain": yDomain})
 
 
+# The resource use metrics of models, see summarize_stage_metrics
+STAGE_METRICS = {
+    "features_seconds": "Feature build seconds",
+    "train_seconds": "Training seconds",
+    "train_cpu_seconds": "Training CPU seconds",
+    "train_rows": "Training rows",
+    "n_features": "Features",
+    "predict_seconds": "Prediction seconds",
+    "predict_cpu_seconds": "Prediction CPU seconds",
+    "predict_rows": "Predicted rows",
+    "peak_rss_mb": "Peak memory (MB)",
+}
+
+
 @api_view(["GET"])
 @permission_classes((IsAdminOrCreator,))
 def model_metrics(request, project_pk):
@@ -126,6 +145,19 @@ def model_metrics(request, project_pk):
     project = Project.objects.get(pk=project_pk)
     models = Model.objects.filter(project=project).order_by("training_set__set_number")
 
+    if metric in STAGE_METRICS:
+        values = []
+        for model in models.filter(stage_metrics__isnull=False):
+            summary = summarize_stage_metrics(model.stage_metrics)
+            if metric in summary:
+                values.append(
+                    {"x": model.training_set.set_number, "y": summary[metric]}
+                )
+
+        return Response([{"key": STAGE_METRICS[metric], "values": values}])
+
+    # models whose cross validation has not finished yet have no metrics
+    models = models.filter(cv_accuracy__isnull=False)
     if metric == "accuracy":
         values = []
         for model in models:
@@ -187,25 +219,30 @@ def data_predicted_table(request, project_pk):
     """
     project = Project.objects.get(pk=project_pk)
     previous_run = project.get_current_training_set().set_number - 1
+    model = Model.objects.filter(
+        project=project, training_set__set_number=previous_run
+    ).first()
+    if model is None:
+        return Response({"data": []})
 
+    # only the predictions of the model of the previous run are read, using the
+    # index on the model column
     sql = """
     SELECT d.{data_text_col}, l.{label_name_col}, dp.{pred_prob_col}
     FROM (
         SELECT {pred_data_id_col}, MAX({pred_prob_col}) AS max_prob
         FROM {pred_table}
+        WHERE {pred_model_id_col} = {model_pk}
         GROUP BY {pred_data_id_col}
         ) as tmp
     LEFT JOIN {pred_table} as dp
     ON dp.{pred_data_id_col} = tmp.{pred_data_id_col} AND dp.{pred_prob_col} = tmp.max_prob
+    AND dp.{pred_model_id_col} = {model_pk}
     LEFT JOIN {label_table} as l
     ON l.{label_pk_col} = dp.{pred_label_id_col}
     LEFT JOIN {data_table} as d
     ON d.{data_pk_col} = dp.{pred_data_id_col}
-    LEFT JOIN {model_table} as m
-    ON m.{model_pk_col} = dp.{pred_model_id_col}
-    LEFT JOIN {trainingset_table} as ts
-    ON ts.{trainingset_pk_col} = m.{model_trainingset_id_col}
-    WHERE ts.{trainingset_setnumber_col} = {previous_run} AND d.{data_project_id_col} = {project_pk}
+    WHERE d.{data_project_id_col} = {project_pk}
     """.format(
         data_text_col=Data._meta.get_field("text").column,
         label_name_col=Label._meta.get_field("name").column,
@@ -217,14 +254,8 @@ def data_predicted_table(request, project_pk):
         pred_label_id_col=DataPrediction._meta.get_field("label").column,
         data_table=Data._meta.db_table,
         data_pk_col=Data._meta.pk.name,
-        model_table=Model._meta.db_table,
-        model_pk_col=Model._meta.pk.name,
         pred_model_id_col=DataPrediction._meta.get_field("model").column,
-        trainingset_table=TrainingSet._meta.db_table,
-        trainingset_pk_col=TrainingSet._meta.pk.name,
-        model_trainingset_id_col=Model._meta.get_field("training_set").column,
-        trainingset_setnumber_col=TrainingSet._meta.get_field("set_number").column,
-        previous_run=previous_run,
+        model_pk=model.pk,
         data_project_id_col=Data._meta.get_field("project").column,
         project_pk=project.pk,
     )
@@ -366,3 +397,88 @@ def unassign_coders(request, project_pk, profile_id):
         unassign_datum(d, profile)
 
     return Response(project_status(project))
+
+
+@api_view(["POST"])
+@permission_classes((IsAdminOrCreator,))
+def refit_tfidf(request, project_pk):
+    """Fit a new tf-idf vectorizer on all of the project data, instead of waiting for
+    the growth or vocabulary drift of new data to trigger one.
+
+    Args:
+        request: The POST request
+        project_pk: Primary key of the project
+    Returns:
+        {}
+    """
+    project = Project.objects.get(pk=project_pk)
+    response = {}
+    if project.classifier is None:
+        response["error"] = "This project does not use a model."
+    elif project.feature_backend == "embeddings":
+        response["error"] = "This project uses document embeddings, not tf-idf."
+    elif any(lock["task"] == "features" for lock in get_task_locks(project.pk)):
+        response["error"] = "The features of this project are being updated."
+    else:
+        tasks.send_tfidf_creation_task.delay(project.pk, force_refit=True)
+
+    return Response(response)
+
+
+@api_view(["POST"])
+@permission_classes((IsAdminOrCreator,))
+def retrain_model(request, project_pk):
+    """Train the model of a project with an incremental classifier on all labels,
+    instead of waiting for INCREMENTAL_FULL_RETRAIN_ROUNDS rounds.
+
+    Args:
+        request: The POST request
+        project_pk: Primary key of the project
+    Returns:
+        {}
+    """
+    project = Project.objects.get(pk=project_pk)
+    response = {}
+    if project.classifier is None:
+        response["error"] = "This project does not use a model."
+    elif not DataLabel.objects.filter(data__project=project).exists():
+        response["error"] = "This project has no labeled data to train on."
+    else:
+        lock_owner = uuid.uuid4().hex
+        if acquire_task_lock(project.pk, "model", lock_owner):
+            tasks.send_model_task.delay(
+                project.pk, full_retrain=True, lock_owner=lock_owner
+            )
+        else:
+            response["error"] = "A model is already training for this project."
+
+    return Response(response)
+
+
+@api_view(["GET"])
+@permission_classes((IsAdminOrCreator,))
+def task_locks(request, project_pk):
+    """The background tasks of a project that are running or waiting to run again.
+
+    Args:
+        request: The GET request
+        project_pk: Primary key of the project
+    Returns:
+        {"locks": a list of task lock information, see get_task_locks}
+    """
+    return Response({"locks": get_task_locks(project_pk)})
+
+
+@api_view(["GET"])
+@permission_classes((IsAdminOrCreator,))
+def artifact_cache_stats(request, project_pk):
+    """The hits, misses and evictions of the artifact caches of the processes that
+    train and predict, which are shared by every project.
+
+    Args:
+        request: The GET request
+        project_pk: Primary key of the project
+    Returns:
+        {"caches": a list of the stats of each cache, see get_artifact_cache_stats}
+    """
+    return Response({"caches": get_artifact_cache_stats()})
@@ -51,11 +51,17 @@ from core.utils.utils_annotate import (
     leave_coding_page,
     move_skipped_to_admin_queue,
     process_irr_label,
+    unassign_datum,
     update_last_action,
 )
 from core.utils.utils_model import check_and_trigger_model
-from core.utils.utils_queue import fill_queue
-from core.utils.utils_redis import redis_serialize_data, redis_serialize_set
+from core.utils.utils_queue import check_queue_watermark, fill_project_queues
+from core.utils.utils_redis import (
+    redis_serialize_data,
+    redis_serialize_set,
+    remove_irr_data,
+)
+from core.utils.utils_status import update_data_status
 from smart.settings import ADMIN_TIMEOUT_MINUTES
 
 # Using a prebuilt model
@@ -122,19 +128,13 @@ def get_card_deck(request, project_pk):
     # Calculate queue parameters
     data = get_assignments(profile, project, project.batch_size)
     if len(data) == 0:
-        if project.queue_set.filter(type="irr").exists():
-            irr_queue = project.queue_set.get(type="irr")
-        else:
-            irr_queue = None
-        fill_queue(
-            queue=project.queue_set.get(type="normal"),
-            orderby=project.learning_method,
-            irr_queue=irr_queue,
-            batch_size=project.batch_size,
-            irr_percent=project.percentage_irr,
-        )
+        # only a new project or a refill that fell behind leaves nothing to pop
+        fill_project_queues(project, project.learning_method)
         data = get_assignments(profile, project, project.batch_size)
 
+    # refill the queues in the background before they run out
+    check_queue_watermark(project)
+
     # shuffle so the irr is not all at the front
     random.shuffle(data)
 
@@ -185,7 +185,8 @@ def label_distribution_inverted(request, project_pk):
 @permission_classes((IsCoder,))
 def unassign_data(request, data_pk):
     """Take a datum that is in the assigneddata queue for that user and remove it from
-    the assignedData queue.
+    the assignedData queue, giving it back to its queue in redis, see
+    unassign_datum.
 
     Args:
         request: The POST request
@@ -197,8 +198,7 @@ def unassign_data(request, data_pk):
     profile = request.user.profile
     response = {}
     if AssignedData.objects.filter(data=data, profile=profile).exists():
-        assignment = AssignedData.objects.get(data=data, profile=profile)
-        assignment.delete()
+        unassign_datum(data, profile)
 
     return Response(response)
 
@@ -276,18 +276,21 @@ def skip_data(request, data_pk):
         assignment = AssignedData.objects.get(data=data, profile=profile)
         assignment.delete()
     elif data.irr_ind or num_history > 0:
-        # unassign the skipped item
-        assignment = AssignedData.objects.get(data=data, profile=profile)
-        assignment.delete()
-
-        # log the data and check IRR but don't put in admin queue yet
-        IRRLog.objects.create(
-            data=data, profile=profile, label=None, timestamp=timezone.now()
-        )
-        # if the IRR history has more than the needed number of labels , it is
-        # already processed so don't do anything else
-        if num_history <= project.num_users_irr:
-            process_irr_label(data, None)
+        with transaction.atomic():
+            # unassign the skipped item
+            assignment = AssignedData.objects.get(data=data, profile=profile)
+            assignment.delete()
+            remove_irr_data(assignment.queue, data, profile)
+
+            # log the data and check IRR but don't put in admin queue yet
+            IRRLog.objects.create(
+                data=data, profile=profile, label=None, timestamp=timezone.now()
+            )
+            # if the IRR history has more than the needed number of labels , it is
+            # already processed so don't do anything else
+            if num_history <= project.num_users_irr:
+                process_irr_label(data, None)
+            update_data_status(Data.objects.filter(pk=data.pk))
     else:
         # the data is not IRR so treat it as normal
         move_skipped_to_admin_queue(data, profile, project)
@@ -340,11 +343,13 @@ def annotate_data(request, data_pk):
     elif num_history >= project.num_users_irr:
         # if the IRR history has more than the needed number of labels , it is
         # already processed so just add this label to the history.
-        IRRLog.objects.create(
-            data=data, profile=profile, label=label, timestamp=timezone.now()
-        )
-        assignment = AssignedData.objects.get(data=data, profile=profile)
-        assignment.delete()
+        with transaction.atomic():
+            IRRLog.objects.create(
+                data=data, profile=profile, label=label, timestamp=timezone.now()
+            )
+            assignment = AssignedData.objects.get(data=data, profile=profile)
+            assignment.delete()
+            update_data_status(Data.objects.filter(pk=data.pk))
     else:
         try:
             label_data(label, data, profile, labeling_time)
@@ -397,21 +402,25 @@ def discard_data(request, data_pk):
     if project_extras.proj_permission_level(data.project, profile) > 1:
         # remove it from the admin queue
         queue = Queue.objects.get(project=project, type="admin")
-        DataQueue.objects.get(data=data, queue=queue).delete()
+        with transaction.atomic():
+            DataQueue.objects.get(data=data, queue=queue).delete()
 
-        # update redis
-        settings.REDIS.srem(redis_serialize_set(queue), redis_serialize_data(data))
+            IRRLog.objects.filter(data=data).delete()
+            Data.objects.filter(pk=data_pk).update(irr_ind=False)
+            RecycleBin.objects.create(data=data, timestamp=timezone.now())
 
-        IRRLog.objects.filter(data=data).delete()
-        Data.objects.filter(pk=data_pk).update(irr_ind=False)
-        RecycleBin.objects.create(data=data, timestamp=timezone.now())
+            # remove any IRR log data
+            irr_records = IRRLog.objects.filter(data=data)
+            irr_records.delete()
 
-        # remove any IRR log data
-        irr_records = IRRLog.objects.filter(data=data)
-        irr_records.delete()
+            # set any adjudication message to resolved
+            AdjudicateDescription.objects.filter(data_id=data_pk).update(
+                isResolved=True
+            )
+            update_data_status(Data.objects.filter(pk=data_pk))
 
-        # set any adjudication message to resolved
-        AdjudicateDescription.objects.filter(data_id=data_pk).update(isResolved=True)
+        # update redis
+        settings.REDIS.srem(redis_serialize_set(queue), redis_serialize_data(data))
 
     else:
         response["error"] = "Invalid credentials. Must be an admin."
@@ -448,12 +457,13 @@ def restore_data(request, data_pk):
     if project_extras.proj_permission_level(data.project, profile) > 1:
         # remove it from the recycle bin
         queue = Queue.objects.get(project=data.project, type="admin")
-        DataQueue.objects.create(data=data, queue=queue)
+        with transaction.atomic():
+            DataQueue.objects.create(data=data, queue=queue)
+            RecycleBin.objects.get(data=data).delete()
+            update_data_status(Data.objects.filter(pk=data.pk))
 
         # update redis
         settings.REDIS.sadd(redis_serialize_set(queue), redis_serialize_data(data))
-
-        RecycleBin.objects.get(data=data).delete()
     else:
         response["error"] = "Invalid credentials. Must be an admin."
 
@@ -499,6 +509,7 @@ def modify_label(request, data_pk):
             )
             if data_in_normal_queue:
                 DataQueue.objects.get(data=data, queue=normal_queue).delete()
+            update_data_status(Data.objects.filter(pk=data.pk))
 
         if data_in_normal_queue:
             settings.REDIS.srem(
@@ -580,6 +591,7 @@ def modify_label_to_skip(request, data_pk):
                 new_label="skip",
                 change_timestamp=timezone.now(),
             )
+        update_data_status(Data.objects.filter(pk=data.pk))
 
     return Response(response)
 
@@ -902,6 +914,7 @@ def label_skew_label(request, data_pk):
             VerifiedDataLabel.objects.create(
                 data_label=dl, verified_timestamp=timezone.now(), verified_by=profile
             )
+            update_data_status(Data.objects.filter(pk=datum.pk))
         if data_in_normal_queue:
             settings.REDIS.srem(
                 redis_serialize_set(normal_queue), redis_serialize_data(datum)
@@ -970,6 +983,7 @@ def label_admin_label(request, data_pk):
             Data.objects.filter(pk=datum.pk).update(irr_ind=False)
 
         AdjudicateDescription.objects.filter(data_id=data_pk).update(isResolved=True)
+        update_data_status(Data.objects.filter(pk=datum.pk))
 
     # NOTE: this checks if the model needs to be triggered, but not if the
     # queues need to be refilled. This is because for something to be in the
@@ -1001,9 +1015,9 @@ def get_label_history(request, project_pk):
     if project_extras.proj_permission_level(project, profile) < 2:
         permission_filter &= Q(profile=profile)
 
-    admin_queue_data = DataQueue.objects.filter(
-        queue__project=project, queue__type="admin"
-    ).values_list("data__pk", flat=True)
+    admin_queue_data = Data.objects.filter(
+        project=project, status="adjudication"
+    ).values_list("pk", flat=True)
 
     pending_irr_data = IRRLog.objects.filter(
         permission_filter & Q(data__in=admin_queue_data)
@@ -328,6 +328,7 @@ class ProjectCreateWizard(LoginRequiredMixin, SessionWizardView):
             proj_obj.percentage_irr = advanced_data["percentage_irr"]
             proj_obj.num_users_irr = advanced_data["num_users_irr"]
             proj_obj.classifier = advanced_data["classifier"]
+            proj_obj.feature_backend = advanced_data["feature_backend"]
             proj_obj.allow_coders_view_labels = advanced_data[
                 "allow_coders_view_labels"
             ]
@@ -9,4 +9,13 @@ while [ $n -ne 0 ]; do
     n=$?
 done
 
-celery -A smart worker -l info -n default@%h
+# heavy model and feature tasks run on the "ml" queue, one task per process at a
+# time so a long task does not hold back the ones prefetched behind it
+celery -A smart worker -l info -Q ml -n ml@%h \
+    -c "${CELERY_ML_CONCURRENCY:-2}" --prefetch-multiplier 1 -O fair &
+celery -A smart worker -l info -Q default -n default@%h \
+    -c "${CELERY_DEFAULT_CONCURRENCY:-4}" &
+
+# stop the container if either worker exits
+wait -n
+exit $?
@@ -178,6 +178,8 @@ class Dev(Configuration):
     PROJECT_FILE_PATH = os.path.join(DATA_DIR, "data_files")
     CODEBOOK_FILE_PATH = os.path.join(DATA_DIR, "code_books")
     ENV_FILE_PATH = os.path.join(DATA_DIR, "external_db")
+    # Content addressed copies of the feature matrices, vectorizers and models
+    ARTIFACT_STORE_PATH = os.path.join(DATA_DIR, "artifacts")
 
     AUTH_USER_MODEL = "auth.User"
 
@@ -197,6 +199,21 @@ class Dev(Configuration):
     # a new one every time we need to access redis
     REDIS = redis.StrictRedis.from_url(REDIS_URL)
 
+    # The redis queues are rebuilt from the database at startup, REDIS_INIT_WORKERS
+    # projects at a time and REDIS_CHUNK_SIZE data per pipeline. With
+    # REDIS_LAZY_INIT a project is only rebuilt the first time its queues are popped
+    REDIS_LAZY_INIT = os.environ.get("REDIS_LAZY_INIT", "false").lower() == "true"
+    REDIS_INIT_WORKERS = int(os.environ.get("REDIS_INIT_WORKERS", 1))
+    REDIS_CHUNK_SIZE = int(os.environ.get("REDIS_CHUNK_SIZE", 10000))
+
+    # Seconds a process may hold the lock to rebuild a cold project, and wait for
+    # another to do it before rebuilding the project itself
+    REDIS_WARM_LOCK_TIMEOUT = int(os.environ.get("REDIS_WARM_LOCK_TIMEOUT", 60))
+
+    # The queues of a project are refilled in a celery task once fewer than this
+    # fraction of the normal queue's length is left in it, assigned data included
+    QUEUE_LOW_WATERMARK = float(os.environ.get("QUEUE_LOW_WATERMARK", 0.5))
+
     # CELERY SETTINGS
     CELERY_BROKER_URL = REDIS_URL
     CELERY_RESULT_BACKEND = "django-db"
@@ -204,6 +221,27 @@ class Dev(Configuration):
     CELERY_TASK_SERIALIZER = "json"
     CELERY_RESULT_SERIALIZER = "json"
 
+    # Feature building, training, prediction and cross validation run on the "ml"
+    # queue, everything else on the "default" queue. runcelery.sh starts a worker
+    # for each, with CELERY_ML_CONCURRENCY and CELERY_DEFAULT_CONCURRENCY processes
+    CELERY_TASK_DEFAULT_QUEUE = "default"
+    CELERY_TASK_ROUTES = {
+        "core.tasks." + task: {"queue": "ml"}
+        for task in [
+            "send_model_task",
+            "send_predict_shard_task",
+            "send_cv_task",
+            "send_tfidf_creation_task",
+            "send_embeddings_creation_task",
+            "send_label_embeddings_task",
+            "send_prediction_compaction_task",
+        ]
+    }
+
+    # Seconds until the lock of a running task of a project expires, in case the
+    # task died without releasing it
+    TASK_LOCK_TIMEOUT = int(os.environ.get("TASK_LOCK_TIMEOUT", 6 * 60 * 60))
+
     STATICFILES_DIRS = [
         os.path.join(BASE_DIR, "frontend", "dist"),
         os.path.join(BASE_DIR, "core/data"),
@@ -227,6 +265,73 @@ class Dev(Configuration):
     DATA_UPLOAD_MAX_MEMORY_SIZE = None
 
     ADMIN_TIMEOUT_MINUTES = 15
+
+    # New data is added to the tf-idf matrix with the saved vectorizer. It is only
+    # refit on all project data when the project has grown by this share of the
+    # data it was fit on, or the out of vocabulary rate of the new data is this
+    # much above that of the fit data (measured on a sample of this size)
+    TFIDF_REFIT_GROWTH = float(os.environ.get("TFIDF_REFIT_GROWTH", 0.5))
+    TFIDF_REFIT_OOV_DRIFT = float(os.environ.get("TFIDF_REFIT_OOV_DRIFT", 0.1))
+    TFIDF_OOV_SAMPLE_SIZE = int(os.environ.get("TFIDF_OOV_SAMPLE_SIZE", 5000))
+
+    # Projects with at least TFIDF_PARALLEL_MIN_ROWS data count and weight the terms
+    # of the tf-idf matrix in this many processes
+    TFIDF_WORKERS = int(os.environ.get("TFIDF_WORKERS", min(4, os.cpu_count() or 1)))
+    TFIDF_PARALLEL_MIN_ROWS = int(os.environ.get("TFIDF_PARALLEL_MIN_ROWS", 50000))
+
+    # Number of columns of the hashing feature backends, and how many rows of text
+    # they read and hash at a time
+    HASHING_N_FEATURES = int(os.environ.get("HASHING_N_FEATURES", 2**18))
+    FEATURE_CHUNK_SIZE = int(os.environ.get("FEATURE_CHUNK_SIZE", 10000))
+
+    # Models are cross validated after they are published, with this many folds fit
+    # in CV_JOBS threads. Training sets with at least CV_HOLDOUT_MIN_ROWS labels
+    # are only scored on a holdout of CV_HOLDOUT_SIZE of the labels
+    CV_FOLDS = int(os.environ.get("CV_FOLDS", 5))
+    CV_JOBS = int(os.environ.get("CV_JOBS", min(CV_FOLDS, os.cpu_count() or 1)))
+    CV_HOLDOUT_MIN_ROWS = int(os.environ.get("CV_HOLDOUT_MIN_ROWS", 50000))
+    CV_HOLDOUT_SIZE = float(os.environ.get("CV_HOLDOUT_SIZE", 0.2))
+
+    # The incremental classifiers only learn the labels added since the previous
+    # model, and are trained on all labels every this many rounds
+    INCREMENTAL_FULL_RETRAIN_ROUNDS = int(
+        os.environ.get("INCREMENTAL_FULL_RETRAIN_ROUNDS", 10)
+    )
+
+    # Number of unlabeled data read, predicted and written at a time after training
+    PREDICT_CHUNK_SIZE = int(os.environ.get("PREDICT_CHUNK_SIZE", 10000))
+
+    # Projects with at least PREDICT_SHARD_MIN_ROWS unlabeled data are predicted in
+    # this many tasks, which can run on different workers
+    PREDICT_SHARDS = int(os.environ.get("PREDICT_SHARDS", 4))
+    PREDICT_SHARD_MIN_ROWS = int(os.environ.get("PREDICT_SHARD_MIN_ROWS", 50000))
+
+    # If set, each model only scores a random sample of this many unlabeled data
+    # for uncertainty sampling, plus the most uncertain data of the previous
+    # sample. 0 scores all unlabeled data. Should be well above the queue length
+    PREDICTION_POOL_SIZE = int(os.environ.get("PREDICTION_POOL_SIZE", 0))
+
+    # Only the latest model keeps the probability of every label. The predictions of
+    # the models before it are compacted to the top labels of each datum, and kept
+    # for this many models (0 turns the summaries off)
+    PREDICTION_SUMMARY_TOP_K = int(os.environ.get("PREDICTION_SUMMARY_TOP_K", 3))
+    PREDICTION_SUMMARY_RETENTION = int(
+        os.environ.get("PREDICTION_SUMMARY_RETENTION", 5)
+    )
+
+    # The artifacts of this many of the latest trained training sets of a project
+    # are kept. Unreferenced artifacts younger than the grace period are never
+    # deleted, as a running task may not have recorded them yet
+    ARTIFACT_RETENTION = int(os.environ.get("ARTIFACT_RETENTION", 5))
+    ARTIFACT_GC_GRACE_SECONDS = int(os.environ.get("ARTIFACT_GC_GRACE_SECONDS", 3600))
+
+    # Number of texts encoded at a time for the sentence embeddings feature backend
+    EMBEDDINGS_BATCH_SIZE = int(os.environ.get("EMBEDDINGS_BATCH_SIZE", 256))
+
+    # Memory budget in bytes of the per process cache of feature matrices and
+    # classifiers, 0 turns the cache off. The memory-mapped arrays of the feature
+    # matrices are not counted, only their row keys
+    ARTIFACT_CACHE_BYTES = int(os.environ.get("ARTIFACT_CACHE_BYTES", 2 * 1024**3))
     PROJECT_SUGGESTION_MAX = os.environ.get("PROJECT_SUGGESTION_MAX", 10000)
 
 
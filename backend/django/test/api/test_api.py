@@ -156,6 +156,24 @@ def test_download_model(
     assert response.get("Content-Type") == "application/x-zip-compressed"
 
 
+def test_download_model_untrained(
+    seeded_database,
+    admin_client,
+    test_project_labeled,
+):
+    """Downloading the model of a project that has none gives an error."""
+    project = test_project_labeled
+    admin_client.login(username=SEED_USERNAME2, password=SEED_PASSWORD2)
+    admin_profile = Profile.objects.get(user__username=SEED_USERNAME2)
+    ProjectPermissions.objects.create(
+        profile=admin_profile, project=project, permission="ADMIN"
+    )
+
+    response = admin_client.get("/api/download_model/" + str(project.pk) + "/1/")
+    assert response.status_code == 404
+    assert "error" in response.json()
+
+
 def test_download_labeled_data(
     seeded_database,
     client,
@@ -20,6 +20,7 @@ from core.models import (
     TrainingSet,
 )
 from core.utils.utils_annotate import get_assignments
+from core.utils.utils_cache import ArtifactCache
 from core.utils.utils_queue import fill_queue
 
 
@@ -616,3 +617,27 @@ def test_predicted_table(
     )
     for d in data_text:
         assert d not in data_list
+
+
+def test_artifact_cache_stats(
+    seeded_database, admin_client, test_project_data, test_redis, settings
+):
+    settings.ARTIFACT_CACHE_BYTES = 100
+    project = test_project_data
+    admin_client.login(username=SEED_USERNAME2, password=SEED_PASSWORD2)
+    admin_profile = Profile.objects.get(user__username=SEED_USERNAME2)
+    ProjectPermissions.objects.create(
+        profile=admin_profile, project=project, permission="ADMIN"
+    )
+
+    # the caches of earlier tests in this process are forgotten
+    test_redis.flushdb()
+    response = admin_client.get("/api/artifact_cache/" + str(project.pk) + "/")
+    assert response.json() == {"caches": []}
+
+    cache = ArtifactCache(publish_stats=True)
+    cache.get_or_load(project.pk, "features", "v1", lambda: "a", len)
+    response = admin_client.get("/api/artifact_cache/" + str(project.pk) + "/")
+    [stats] = response.json()["caches"]
+    assert stats["misses"] == 1
+    assert stats["budget"] == 100
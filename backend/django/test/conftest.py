@@ -41,6 +41,13 @@ def setup_celery():
     )
 
 
+@pytest.fixture(autouse=True)
+def artifact_store(settings, tmp_path_factory):
+    """Keep the artifacts stored during a test out of the real data directory."""
+    settings.ARTIFACT_STORE_PATH = str(tmp_path_factory.mktemp("artifacts"))
+    return settings.ARTIFACT_STORE_PATH
+
+
 @pytest.fixture(scope="function")
 def test_redis(request):
     r = settings.REDIS
@@ -200,23 +207,25 @@ def test_profile_queue2(db, test_profile2, test_project_data):
 
 @pytest.fixture
 def test_tfidf_matrix(test_project_data):
-    """A CSR-format tf-idf matrix created from the data of test_project_data."""
+    """A CSR-format tf-idf matrix created from the data of test_project_data, and the
+    upload_id_hash of each of its rows."""
     Data.objects.filter(project=test_project_data)
-    return create_tfidf_matrix(test_project_data.pk)[0]
+    return create_tfidf_matrix(test_project_data.pk)[:2]
 
 
 @pytest.fixture
 def test_tfidf_matrix_labeled(test_project_labeled):
-    """A CSR-format tf-idf matrix created from the data of test_project_data."""
+    """A CSR-format tf-idf matrix created from the data of test_project_data, and the
+    upload_id_hash of each of its rows."""
     Data.objects.filter(project=test_project_labeled)
-    return create_tfidf_matrix(test_project_labeled.pk)[0]
+    return create_tfidf_matrix(test_project_labeled.pk)[:2]
 
 
 @pytest.fixture
 def test_tfidf_vectorizer_labeled(test_project_labeled):
     """A CSR-format tf-idf matrix created from the data of test_project_data."""
     Data.objects.filter(project=test_project_labeled)
-    return create_tfidf_matrix(test_project_labeled.pk)[1]
+    return create_tfidf_matrix(test_project_labeled.pk)[2]
 
 
 @pytest.fixture
@@ -250,7 +259,7 @@ def test_project_labeled_and_tfidf(
 ):
     data_temp = tmpdir.mkdir("data").mkdir("tf_idf")
     settings.TF_IDF_PATH = str(data_temp)
-    save_tfidf_matrix(test_tfidf_matrix_labeled, test_project_labeled.pk)
+    save_tfidf_matrix(*test_tfidf_matrix_labeled, test_project_labeled.pk)
     save_tfidf_vectorizer(test_tfidf_vectorizer_labeled, test_project_labeled.pk)
     return test_project_labeled
 
@@ -262,7 +271,7 @@ def test_project_unlabeled_and_tfidf(
     data_temp = tmpdir.mkdir("data").mkdir("tf_idf")
     settings.TF_IDF_PATH = str(data_temp)
 
-    save_tfidf_matrix(test_tfidf_matrix, test_project_data.pk)
+    save_tfidf_matrix(*test_tfidf_matrix, test_project_data.pk)
 
     return test_project_data
 
@@ -302,12 +311,12 @@ def test_project_svm_data_tfidf(db, test_profile, tmpdir, settings):
     add_data(proj, test_data)
 
     Data.objects.filter(project=proj)
-    matrix = create_tfidf_matrix(proj.pk)[0]
+    matrix, row_keys, _ = create_tfidf_matrix(proj.pk)
 
     data_temp = tmpdir.mkdir("data").mkdir("tf_idf")
     settings.TF_IDF_PATH = str(data_temp)
 
-    save_tfidf_matrix(matrix, proj.pk)
+    save_tfidf_matrix(matrix, row_keys, proj.pk)
 
     return proj
 
@@ -373,12 +382,12 @@ def test_project_randomforest_data_tfidf(db, test_profile, tmpdir, settings):
     add_data(proj, test_data)
 
     Data.objects.filter(project=proj)
-    matrix = create_tfidf_matrix(proj.pk)[0]
+    matrix, row_keys, _ = create_tfidf_matrix(proj.pk)
 
     data_temp = tmpdir.mkdir("data").mkdir("tf_idf")
     settings.TF_IDF_PATH = str(data_temp)
 
-    save_tfidf_matrix(matrix, proj.pk)
+    save_tfidf_matrix(matrix, row_keys, proj.pk)
 
     return proj
 
@@ -485,12 +494,12 @@ def test_project_gnb_data_tfidf(db, test_profile, tmpdir, settings):
     add_data(proj, test_data)
 
     Data.objects.filter(project=proj)
-    matrix = create_tfidf_matrix(proj.pk)[0]
+    matrix, row_keys, _ = create_tfidf_matrix(proj.pk)
 
     data_temp = tmpdir.mkdir("data").mkdir("tf_idf")
     settings.TF_IDF_PATH = str(data_temp)
 
-    save_tfidf_matrix(matrix, proj.pk)
+    save_tfidf_matrix(matrix, row_keys, proj.pk)
     return proj
 
 
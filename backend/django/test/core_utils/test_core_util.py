@@ -23,6 +23,7 @@ from core.utils.util import (
     get_labeled_data,
     irr_heatmap_data,
     perc_agreement_table_data,
+    project_status,
     save_codebook_file,
     save_data_file,
 )
@@ -574,3 +575,25 @@ def test_get_labeled_data(
         set(project_labeled.values_list("data__upload_id", flat=True))
         & set(labeled_data["ID"].tolist())
     ) == len(labeled_data)
+
+
+def test_project_status_unlabeled_leaves_out_started_irr_data(
+    test_project_half_irr_data,
+    test_half_irr_all_queues,
+    test_profile,
+    test_labels_half_irr,
+    test_redis,
+):
+    project = test_project_half_irr_data
+    normal_queue, admin_queue, irr_queue = test_half_irr_all_queues
+    fill_queue(
+        normal_queue, "random", irr_queue, project.percentage_irr, project.batch_size
+    )
+    num_data = project.data_set.count()
+    assert project_status(project)["unlabeled"] == num_data
+
+    # the irr datum still needs a second label, but it is no longer unlabeled
+    datum = assign_datum(test_profile, project, "irr")
+    assert project_status(project)["unlabeled"] == num_data - 1
+    label_data(test_labels_half_irr[0], datum, test_profile, 3)
+    assert project_status(project)["unlabeled"] == num_data - 1
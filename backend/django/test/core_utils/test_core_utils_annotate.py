@@ -10,6 +10,7 @@ from core.utils.utils_annotate import (
     unassign_datum,
 )
 from core.utils.utils_queue import fill_queue
+from core.utils.utils_status import rebuild_data_status
 
 
 def test_assign_datum_project_queue_returns_datum(
@@ -47,7 +48,7 @@ def test_assign_datum_project_queue_pops_queues(
     datum = assign_datum(test_profile, test_queue.project)
 
     # Make sure the datum was removed from queues but not set
-    assert test_redis.llen("queue:" + str(test_queue.pk)) == test_queue.length - 1
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == test_queue.length - 1
     assert test_redis.scard("set:" + str(test_queue.pk)) == test_queue.length
 
     # but not from the db queue
@@ -91,7 +92,7 @@ def test_assign_datum_profile_queue_pops_queues(
 
     # Make sure the datum was removed from the correct queues but not sets
     assert (
-        test_redis.llen("queue:" + str(test_profile_queue.pk))
+        test_redis.zcard("queue:" + str(test_profile_queue.pk))
         == test_profile_queue.length - 1
     )
     assert (
@@ -103,7 +104,7 @@ def test_assign_datum_profile_queue_pops_queues(
     assert test_profile_queue.data.count() == test_profile_queue.length
     assert datum in test_profile_queue.data.all()
     assert (
-        test_redis.llen("queue:" + str(test_profile_queue2.pk))
+        test_redis.zcard("queue:" + str(test_profile_queue2.pk))
         == test_profile_queue2.length
     )
     assert (
@@ -233,20 +234,24 @@ def test_get_assignments_multiple_existing_assignments(
 def test_unassign(db, test_profile, test_project_data, test_queue, test_redis):
     fill_queue(test_queue, orderby="random")
 
-    assert test_redis.llen("queue:" + str(test_queue.pk)) == test_queue.length
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == test_queue.length
     assert test_redis.scard("set:" + str(test_queue.pk)) == test_queue.length
 
     datum = get_assignments(test_profile, test_project_data, 1)[0]
 
-    assert test_redis.llen("queue:" + str(test_queue.pk)) == (test_queue.length - 1)
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == (test_queue.length - 1)
     assert test_redis.scard("set:" + str(test_queue.pk)) == test_queue.length
     assert AssignedData.objects.filter(data=datum, profile=test_profile).exists()
 
     unassign_datum(datum, test_profile)
 
-    assert test_redis.llen("queue:" + str(test_queue.pk)) == test_queue.length
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == test_queue.length
     assert test_redis.scard("set:" + str(test_queue.pk)) == test_queue.length
     assert not AssignedData.objects.filter(data=datum, profile=test_profile).exists()
+    # the datum is the next one popped
+    assert test_redis.zrange("queue:" + str(test_queue.pk), 0, 0) == [
+        ("data:" + str(datum.pk)).encode()
+    ]
 
     # The unassigned datum should be the next to be assigned
     reassigned_datum = get_assignments(test_profile, test_project_data, 1)[0]
@@ -254,29 +259,44 @@ def test_unassign(db, test_profile, test_project_data, test_queue, test_redis):
     assert reassigned_datum == datum
 
 
+def test_get_assignments_pops_a_batch(db, test_queue, test_profile, test_redis):
+    fill_queue(test_queue, orderby="random")
+
+    data = get_assignments(test_profile, test_queue.project, 5)
+
+    assert len(set(data)) == 5
+    assignments = AssignedData.objects.filter(profile=test_profile)
+    assert {a.data for a in assignments} == set(data)
+    assert all(a.queue == test_queue for a in assignments)
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == test_queue.length - 5
+    assert (
+        Data.objects.filter(pk__in=[d.pk for d in data], status="assigned").count() == 5
+    )
+
+
 def test_unassign_after_fillqueue(
     db, test_profile, test_project_data, test_queue, test_labels, test_redis
 ):
     fill_queue(test_queue, "random")
 
-    assert test_redis.llen("queue:" + str(test_queue.pk)) == test_queue.length
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == test_queue.length
     assert test_redis.scard("set:" + str(test_queue.pk)) == test_queue.length
 
     data = get_assignments(test_profile, test_project_data, 10)
 
-    assert test_redis.llen("queue:" + str(test_queue.pk)) == (test_queue.length - 10)
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == (test_queue.length - 10)
     assert test_redis.scard("set:" + str(test_queue.pk)) == test_queue.length
 
     test_label = test_labels[0]
     for i in range(5):
         label_data(test_label, data[i], test_profile, 3)
 
-    assert test_redis.llen("queue:" + str(test_queue.pk)) == (test_queue.length - 10)
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == (test_queue.length - 10)
     assert test_redis.scard("set:" + str(test_queue.pk)) == (test_queue.length - 5)
 
     fill_queue(test_queue, "random")
 
-    assert test_redis.llen("queue:" + str(test_queue.pk)) == test_queue.length - 5
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == test_queue.length - 5
     assert test_redis.scard("set:" + str(test_queue.pk)) == test_queue.length
 
 
@@ -294,3 +314,32 @@ def test_skip_data(db, test_profile, test_queue, test_admin_queue, test_redis):
     assert DataQueue.objects.filter(data=datum, queue=test_admin_queue).exists()
     # make sure not in normal queue
     assert not DataQueue.objects.filter(data=datum, queue=test_queue).exists()
+
+
+def test_data_status_follows_annotation(
+    db, test_profile, test_queue, test_admin_queue, test_redis
+):
+    project = test_queue.project
+    label = Label.objects.create(name="status test", project=project)
+    fill_queue(test_queue, orderby="random")
+    assert Data.objects.filter(project=project, status="queued").count() == (
+        test_queue.length
+    )
+
+    labeled_datum = assign_datum(test_profile, project)
+    skipped_datum = assign_datum(test_profile, project)
+    unassigned_datum = assign_datum(test_profile, project)
+    assert Data.objects.get(pk=labeled_datum.pk).status == "assigned"
+
+    label_data(label, labeled_datum, test_profile, 3)
+    move_skipped_to_admin_queue(skipped_datum, test_profile, project)
+    unassign_datum(unassigned_datum, test_profile)
+    assert Data.objects.get(pk=labeled_datum.pk).status == "labeled"
+    assert Data.objects.get(pk=skipped_datum.pk).status == "adjudication"
+    assert Data.objects.get(pk=unassigned_datum.pk).status == "queued"
+
+    # the rebuild repairs a status changed behind the annotation code
+    Data.objects.filter(pk=labeled_datum.pk).update(status="unlabeled")
+    assert rebuild_data_status(project) == 1
+    assert Data.objects.get(pk=labeled_datum.pk).status == "labeled"
+    assert rebuild_data_status() == 0
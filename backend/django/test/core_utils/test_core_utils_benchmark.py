@@ -0,0 +1,63 @@
+import numpy as np
+
+from core.models import DataPrediction, DataQueue
+from core.utils.utils_benchmark import (
+    compare_benchmarks,
+    create_benchmark_project,
+    run_pipeline_benchmark,
+    synthetic_dataframe,
+)
+from core.utils.utils_resources import measure_stage
+
+
+def test_synthetic_dataframe():
+    df = synthetic_dataframe(500, 4, 20, 50)
+
+    assert len(df) == 500
+    assert df["Label"].notnull().sum() == 50
+    assert set(df["Label"].dropna()) <= {"label " + str(i) for i in range(4)}
+    assert all(len(text.split()) == 20 for text in df["Text"])
+    assert df["id_hash"].is_unique
+
+    # the same seed gives the same data
+    assert df.equals(synthetic_dataframe(500, 4, 20, 50))
+
+
+def test_run_pipeline_benchmark(db, setup_celery, test_redis, tmpdir, settings):
+    settings.TF_IDF_PATH = str(tmpdir.mkdir("tf_idf"))
+    settings.MODEL_PICKLE_PATH = str(tmpdir.mkdir("model_pickles"))
+
+    df = synthetic_dataframe(300, 3, 20, 60)
+    project = create_benchmark_project(df, 3, "gnb")
+    assert project.data_set.count() == 300
+    # memory an earlier benchmark run needed is not counted in the stages
+    with measure_stage() as earlier_run:
+        earlier_memory = np.ones(300 * 1024 * 1024, dtype=np.uint8)
+        del earlier_memory
+
+    stages = run_pipeline_benchmark(project)
+
+    assert list(stages) == ["features", "train", "predict", "fill_queue"]
+    for stats in stages.values():
+        assert stats["wall_seconds"] >= 0
+        assert 0 < stats["peak_rss_mb"] < earlier_run["peak_rss_mb"] - 100
+    assert stages["predict"]["predictions"] == 240 * 3
+    assert DataPrediction.objects.filter(data__project=project).count() == 240 * 3
+    assert DataQueue.objects.filter(queue__project=project).exists()
+
+
+def test_compare_benchmarks():
+    def results(train_seconds, peak_rss_mb):
+        stats = {"wall_seconds": train_seconds, "peak_rss_mb": peak_rss_mb}
+        return {
+            "runs": [{"rows": 100, "classifier": "gnb", "stages": {"train": stats}}]
+        }
+
+    baseline = results(1.0, 100)
+    assert compare_benchmarks(results(1.1, 110), baseline, 0.2) == []
+    assert len(compare_benchmarks(results(2.0, 110), baseline, 0.2)) == 1
+    assert len(compare_benchmarks(results(2.0, 200), baseline, 0.2)) == 2
+
+    # runs that are not in the baseline are not compared
+    other = {"runs": [{"rows": 200, "classifier": "gnb", "stages": {}}]}
+    assert compare_benchmarks(results(2.0, 200), other, 0.2) == []
@@ -0,0 +1,78 @@
+from core.utils.utils_cache import ArtifactCache, get_artifact_cache_stats
+
+
+def test_artifact_cache_hits_and_misses(settings):
+    settings.ARTIFACT_CACHE_BYTES = 100
+    cache = ArtifactCache()
+    loads = []
+
+    def load():
+        loads.append(1)
+        return "artifact"
+
+    assert cache.get_or_load(1, "features", "v1", load, len) == "artifact"
+    assert cache.get_or_load(1, "features", "v1", load, len) == "artifact"
+    assert len(loads) == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+    # a new version is cached next to the old one, which may still be in use
+    cache.get_or_load(1, "features", "v2", load, len)
+    cache.get_or_load(1, "features", "v1", load, len)
+    assert len(loads) == 2
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["size"] == 2 * len("artifact")
+
+
+def test_artifact_cache_evicts_least_recently_used(settings):
+    settings.ARTIFACT_CACHE_BYTES = 25
+    cache = ArtifactCache()
+
+    cache.get_or_load(1, "features", "v1", lambda: "a" * 10, len)
+    cache.get_or_load(2, "features", "v1", lambda: "b" * 10, len)
+    # use project 1 so project 2 is the least recently used
+    cache.get_or_load(1, "features", "v1", lambda: "a" * 10, len)
+    cache.get_or_load(3, "features", "v1", lambda: "c" * 10, len)
+
+    assert [key[0] for key in cache.entries] == [1, 3]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size"] == 20
+
+    # artifacts over the budget are returned but never cached
+    assert cache.get_or_load(4, "features", "v1", lambda: "d" * 30, len) == "d" * 30
+    assert (4, "features", "v1") not in cache.entries
+
+
+def test_artifact_cache_invalidate(settings):
+    settings.ARTIFACT_CACHE_BYTES = 100
+    cache = ArtifactCache()
+
+    cache.get_or_load(1, "features", "v1", lambda: "a", len)
+    cache.get_or_load(1, "classifier", "v1", lambda: "b", len)
+    cache.get_or_load(2, "features", "v1", lambda: "c", len)
+
+    cache.invalidate(1, "classifier")
+    assert (1, "classifier", "v1") not in cache.entries
+    assert (1, "features", "v1") in cache.entries
+
+    cache.invalidate(1)
+    assert list(cache.entries) == [(2, "features", "v1")]
+    assert cache.stats()["size"] == 1
+
+
+def test_artifact_cache_publishes_stats(settings, test_redis):
+    settings.ARTIFACT_CACHE_BYTES = 100
+    cache = ArtifactCache(publish_stats=True)
+    test_redis.flushdb()
+
+    cache.get_or_load(1, "features", "v1", lambda: "a", len)
+    [stats] = get_artifact_cache_stats()
+    assert stats["misses"] == 1
+    assert stats["entries"] == 1
+
+    # hits alone are written every STATS_PUBLISH_SECONDS
+    cache.get_or_load(1, "features", "v1", lambda: "a", len)
+    assert get_artifact_cache_stats()[0]["hits"] == 0
+    cache.invalidate(1)
+    assert get_artifact_cache_stats()[0]["hits"] == 1
+    assert get_artifact_cache_stats()[0]["entries"] == 0
@@ -1,66 +1,324 @@
+import filecmp
+import math
 import os
 from test.conftest import TEST_QUEUE_LEN
-from test.util import assert_obj_exists, assert_redis_matches_db
+from test.util import assert_obj_exists, assert_redis_matches_db, read_test_data_backend
 
+import joblib
 import numpy as np
+import pandas as pd
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from scipy import sparse
+from sklearn.naive_bayes import MultinomialNB
 
 from core.models import (
     Data,
     DataLabel,
     DataPrediction,
+    DataPredictionSummary,
     DataQueue,
     DataUncertainty,
     Model,
     ProjectPermissions,
+    TrainingSet,
 )
+from core.utils.util import add_data
 from core.utils.utils_annotate import assign_datum, label_data
+from core.utils.utils_artifacts import object_path
 from core.utils.utils_model import (
     check_and_trigger_model,
     cohens_kappa,
+    collect_artifact_garbage,
+    compact_predictions,
+    create_tfidf_matrix,
     entropy,
+    evaluate_model,
     fleiss_kappa,
     least_confident,
+    load_project_features,
     load_tfidf_matrix,
+    load_tfidf_vectorizer,
     margin_sampling,
     predict_data,
+    prediction_shards,
     save_tfidf_matrix,
     train_and_save_model,
+    uncertainty_scores,
+    update_embeddings_matrix,
+    update_project_features,
+    update_tfidf_matrix,
 )
 from core.utils.utils_queue import fill_queue, find_queue_length
 from core.utils.utils_redis import get_ordered_data
 
 
 def test_create_tfidf_matrix(test_tfidf_matrix):
-    # UPDATE: is now saved as a dictionary of lists
-    assert isinstance(test_tfidf_matrix, dict)
-    assert len(test_tfidf_matrix) == 982
-    for key in test_tfidf_matrix:
-        assert len(test_tfidf_matrix[key]) == 162
-        assert np.all([type(val) == float for val in test_tfidf_matrix[key]])
+    # UPDATE: is now kept as a CSR matrix with the upload_id_hash of each row
+    matrix, row_keys = test_tfidf_matrix
+    assert sparse.isspmatrix_csr(matrix)
+    assert matrix.shape == (982, 162)
+    assert len(row_keys) == 982
+    assert len(set(row_keys)) == 982
+
+
+def test_create_tfidf_matrix_sharded(test_project_data, settings):
+    settings.TFIDF_WORKERS = 1
+    serial, serial_keys, serial_vectorizer = create_tfidf_matrix(test_project_data.pk)
+
+    settings.TFIDF_WORKERS = 3
+    settings.TFIDF_PARALLEL_MIN_ROWS = 0
+    sharded, sharded_keys, sharded_vectorizer = create_tfidf_matrix(
+        test_project_data.pk
+    )
+
+    assert sharded_keys == serial_keys
+    assert sharded_vectorizer.vocabulary_ == serial_vectorizer.vocabulary_
+    assert sharded.shape == serial.shape
+    # the same values in the same order, so the row norms are summed the same way
+    assert np.array_equal(sharded.indptr, serial.indptr)
+    assert np.array_equal(sharded.indices, serial.indices)
+    assert np.array_equal(sharded.data, serial.data)
+    assert np.array_equal(sharded_vectorizer.idf_, serial_vectorizer.idf_)
+
+    new_text = ["r/aww has a new Discord server", "completely unseen words"]
+    assert np.allclose(
+        sharded_vectorizer.transform(new_text).toarray(),
+        serial_vectorizer.transform(new_text).toarray(),
+    )
 
 
 def test_save_tfidf_matrix(test_project_data, test_tfidf_matrix, tmpdir, settings):
     data_temp = tmpdir.mkdir("data").mkdir("tf_idf")
     settings.TF_IDF_PATH = str(data_temp)
 
-    file = save_tfidf_matrix(test_tfidf_matrix, test_project_data.pk)
+    file = save_tfidf_matrix(*test_tfidf_matrix, test_project_data.pk)
 
-    assert os.path.isfile(file)
+    assert os.path.isdir(file)
     assert file == os.path.join(
         settings.TF_IDF_PATH,
-        "project_" + str(test_project_data.pk) + "_tfidf_matrix.pkl",
+        "project_" + str(test_project_data.pk) + "_tfidf_matrix",
     )
+    for name in ["data", "indices", "indptr", "row_keys"]:
+        assert os.path.isfile(os.path.join(file, name + ".npy"))
+    assert os.path.isfile(os.path.join(file, "meta.json"))
 
 
 def test_load_tfidf_matrix(
     test_project_labeled_and_tfidf, test_tfidf_matrix_labeled, tmpdir, settings
 ):
     matrix = load_tfidf_matrix(test_project_labeled_and_tfidf.pk)
+    expected, row_keys = test_tfidf_matrix_labeled
+
+    assert matrix.shape == expected.shape
+    assert matrix.row_keys() == row_keys
+    assert np.allclose(matrix.rows(row_keys).toarray(), expected.toarray())
+
+
+def test_load_tfidf_matrix_slice_rows(
+    test_project_labeled_and_tfidf, test_tfidf_matrix_labeled, tmpdir, settings
+):
+    matrix = load_tfidf_matrix(test_project_labeled_and_tfidf.pk)
+    expected, row_keys = test_tfidf_matrix_labeled
 
-    for key in matrix:
-        assert key in test_tfidf_matrix_labeled
-        assert np.allclose(matrix[key], test_tfidf_matrix_labeled[key])
+    # rows come back in the order they were asked for
+    wanted = [row_keys[10], row_keys[3], row_keys[500]]
+    rows = matrix.rows(wanted)
+    assert rows.shape == (3, expected.shape[1])
+    assert np.allclose(rows.toarray(), expected[[10, 3, 500]].toarray())
+
+    with pytest.raises(ValueError) as excinfo:
+        matrix.rows(["not_a_hash"])
+    assert "missing rows for 1 data" in str(excinfo.value)
+
+
+def test_load_tfidf_matrix_missing(test_project_data, tmpdir, settings):
+    settings.TF_IDF_PATH = str(tmpdir.mkdir("data").mkdir("tf_idf"))
+
+    with pytest.raises(ValueError) as excinfo:
+        load_tfidf_matrix(test_project_data.pk)
+    assert "There was no tfidf matrix found" in str(excinfo.value)
+
+
+def test_update_tfidf_matrix_appends_new_data(test_project, tmpdir, settings):
+    settings.TF_IDF_PATH = str(tmpdir.mkdir("data").mkdir("tf_idf"))
+    settings.TFIDF_REFIT_GROWTH = 1.0
+    settings.TFIDF_REFIT_OOV_DRIFT = 1.0
+
+    test_data = read_test_data_backend(file="./core/data/test_files/test_no_labels.csv")
+    add_data(test_project, test_data[:600].reset_index(drop=True))
+    update_tfidf_matrix(test_project.pk)
+    first = load_tfidf_matrix(test_project.pk)
+    vocabulary = load_tfidf_vectorizer(test_project.pk).vocabulary_
+
+    add_data(test_project, test_data[600:].reset_index(drop=True))
+    update_tfidf_matrix(test_project.pk)
+    second = load_tfidf_matrix(test_project.pk)
+
+    num_data = Data.objects.filter(project=test_project).count()
+    assert second.shape == (num_data, first.shape[1])
+    assert second.meta["fit_rows"] == len(first)
+    assert load_tfidf_vectorizer(test_project.pk).vocabulary_ == vocabulary
+
+    # the existing rows are kept as they were and new rows are added after them
+    assert second.row_keys()[: len(first)] == first.row_keys()
+    old_keys = first.row_keys()
+    assert np.allclose(second.rows(old_keys).toarray(), first.rows(old_keys).toarray())
+    assert set(second.row_keys()) == set(
+        Data.objects.filter(project=test_project).values_list(
+            "upload_id_hash", flat=True
+        )
+    )
+
+
+def test_update_tfidf_matrix_refits(test_project, tmpdir, settings):
+    settings.TF_IDF_PATH = str(tmpdir.mkdir("data").mkdir("tf_idf"))
+    settings.TFIDF_REFIT_GROWTH = 0.5
+    settings.TFIDF_REFIT_OOV_DRIFT = 1.0
+
+    test_data = read_test_data_backend(file="./core/data/test_files/test_no_labels.csv")
+    add_data(test_project, test_data[:300].reset_index(drop=True))
+    update_tfidf_matrix(test_project.pk)
+
+    # growing the project by more than half refits on all of the data
+    add_data(test_project, test_data[300:].reset_index(drop=True))
+    update_tfidf_matrix(test_project.pk)
+    matrix = load_tfidf_matrix(test_project.pk)
+    num_data = Data.objects.filter(project=test_project).count()
+    assert matrix.meta["fit_rows"] == num_data
+    version = matrix.version
+
+    # nothing new, nothing to do
+    update_tfidf_matrix(test_project.pk)
+    assert load_tfidf_matrix(test_project.pk).version == version
+
+    # unless a refit is forced
+    update_tfidf_matrix(test_project.pk, force_refit=True)
+    assert load_tfidf_matrix(test_project.pk).version != version
+
+
+def test_update_tfidf_matrix_hashing_idf(test_project_labeled, tmpdir, settings):
+    tf_idf_temp = tmpdir.mkdir("data").mkdir("tf_idf")
+    settings.TF_IDF_PATH = str(tf_idf_temp)
+    settings.HASHING_N_FEATURES = 2**12
+    settings.FEATURE_CHUNK_SIZE = 100
+    project = test_project_labeled
+    project.feature_backend = "hashing idf"
+    project.save()
+
+    update_tfidf_matrix(project.pk)
+    matrix = load_tfidf_matrix(project.pk)
+    vectorizer = load_tfidf_vectorizer(project.pk)
+
+    data = Data.objects.filter(project=project).order_by("upload_id_hash")
+    assert matrix.shape == (data.count(), 2**12)
+    assert matrix.meta["feature_backend"] == "hashing idf"
+
+    # the chunked rows match transforming all of the text at once
+    row_keys = list(data.values_list("upload_id_hash", flat=True))
+    expected = vectorizer.transform(data.values_list("text", flat=True))
+    assert np.allclose(matrix.rows(row_keys).toarray(), expected.toarray())
+
+    # and can be used to train a model
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+    assert isinstance(train_and_save_model(project), Model)
+
+
+def test_update_embeddings_matrix(test_project_labeled, tmpdir, settings):
+    settings.TF_IDF_PATH = str(tmpdir.mkdir("data").mkdir("tf_idf"))
+    settings.EMBEDDINGS_BATCH_SIZE = 200
+    project = test_project_labeled
+    project.feature_backend = "embeddings"
+    project.save()
+
+    all_data = Data.objects.filter(project=project)
+    held_back = list(all_data.order_by("-upload_id_hash")[:50])
+    held_back_text = {d.upload_id_hash: d.text for d in held_back}
+    Data.objects.filter(pk__in=[d.pk for d in held_back]).delete()
+
+    update_embeddings_matrix(project.pk)
+    first = load_project_features(project)
+    assert first.shape == (all_data.count(), 384)
+    assert first.values.dtype == np.float16
+
+    for datum in held_back:
+        datum.pk = None
+        datum.save()
+    update_embeddings_matrix(project.pk)
+    second = load_project_features(project)
+
+    # only the new data is embedded, after the rows that were there
+    assert second.shape == (all_data.count(), 384)
+    assert second.row_keys()[: len(first)] == first.row_keys()
+    assert np.array_equal(second.values[: len(first)], first.values)
+    new_keys = second.row_keys()[len(first) :]
+    assert set(new_keys) == set(held_back_text)
+
+    # the embeddings are used as X for the model
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+    assert isinstance(train_and_save_model(project), Model)
+
+
+def test_train_and_save_model_incremental(
+    test_project_labeled_and_tfidf, tmpdir, settings
+):
+    project = test_project_labeled_and_tfidf
+    project.classifier = "multinomial nb"
+    project.save()
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+    settings.INCREMENTAL_FULL_RETRAIN_ROUNDS = 3
+
+    labels = list(project.labels.all())
+
+    def label_more_data(num):
+        training_set = TrainingSet.objects.create(
+            project=project,
+            set_number=project.get_current_training_set().set_number + 1,
+        )
+        unlabeled = project.data_set.filter(datalabel__isnull=True)[:num]
+        for i, datum in enumerate(unlabeled):
+            DataLabel.objects.create(
+                data=datum,
+                label=labels[i % len(labels)],
+                profile=project.creator,
+                training_set=training_set,
+            )
+
+    train_and_save_model(project)
+    assert project.get_current_training_set().manifest["incremental_rounds"] == 0
+
+    # the next two rounds only learn the new labels
+    for rounds in [1, 2]:
+        label_more_data(3)
+        model = train_and_save_model(project)
+        assert project.get_current_training_set().manifest["incremental_rounds"] == (
+            rounds
+        )
+        # the metrics are cross validated on all labels, see evaluate_model
+        assert model.cv_accuracy is None
+    # naive bayes counts add up, so learning the new labels gives the full model
+    unique_ids, labeled_values = zip(
+        *DataLabel.objects.filter(data__project=project).values_list(
+            "data__upload_id_hash", "label"
+        )
+    )
+    full_clf = MultinomialNB().fit(
+        load_tfidf_matrix(project.pk).rows(list(unique_ids)), labeled_values
+    )
+    np.testing.assert_allclose(
+        joblib.load(model.pickle_path).feature_count_, full_clf.feature_count_
+    )
+
+    # then it is trained on all labels again
+    label_more_data(3)
+    train_and_save_model(project)
+    assert project.get_current_training_set().manifest["incremental_rounds"] == 0
+
+    # or when a full retrain is asked for
+    label_more_data(3)
+    train_and_save_model(project, full_retrain=True)
+    assert project.get_current_training_set().manifest["incremental_rounds"] == 0
 
 
 def test_least_confident_notarray():
@@ -177,6 +435,25 @@ def test_entropy_with_zero():
     np.testing.assert_almost_equal(e, 0.26529499557412151)
 
 
+def test_uncertainty_scores_match_row_scores():
+    probs = np.array([[0.1, 0.3, 0.6], [0.2, 0.8, 0], [0.5, 0.25, 0.25]])
+
+    lc, ms, e = uncertainty_scores(probs)
+
+    for i, row in enumerate(probs):
+        assert lc[i] == least_confident(row.copy())
+        assert ms[i] == margin_sampling(row.copy())
+        assert e[i] == entropy(row.copy())
+    np.testing.assert_almost_equal(e[0], 0.3899728733539152)
+
+
+def test_uncertainty_scores_notarray():
+    with pytest.raises(ValueError) as excinfo:
+        uncertainty_scores([[0.5, 0.5]])
+
+    assert "Probs should be a numpy array" in str(excinfo.value)
+
+
 def test_train_and_save_model(test_project_labeled_and_tfidf, tmpdir, settings):
     project = test_project_labeled_and_tfidf
 
@@ -197,29 +474,292 @@ def test_train_and_save_model(test_project_labeled_and_tfidf, tmpdir, settings):
         + ".pkl",
     )
 
+    # the manifest names the stored copies of everything the model depends on
+    manifest = project.get_current_training_set().manifest
+    for kind in ["features", "vectorizer", "classifier"]:
+        assert os.path.exists(object_path(project.pk, manifest[kind]))
+    assert filecmp.cmp(
+        object_path(project.pk, manifest["classifier"]), model.pickle_path
+    )
+
+
+@pytest.mark.parametrize("holdout_min_rows", [1000000, 1])
+def test_evaluate_model(
+    test_project_labeled_and_tfidf, tmpdir, settings, holdout_min_rows
+):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+    settings.CV_FOLDS = 3
+    settings.CV_JOBS = 1
+    settings.CV_HOLDOUT_MIN_ROWS = holdout_min_rows
+
+    # the model is published before it is cross validated
+    model = train_and_save_model(project)
+    assert model.cv_accuracy is None
+    assert model.cv_metrics is None
+
+    evaluate_model(model)
+
+    model.refresh_from_db()
+    assert 0 <= model.cv_accuracy <= 1
+    labels = {str(label.pk) for label in project.labels.all()}
+    for metric in ["precision", "recall", "f1"]:
+        assert set(model.cv_metrics[metric]) == labels
+
+
+def test_train_and_save_model_unchanged_inputs(
+    test_project_labeled_and_tfidf, tmpdir, settings
+):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+
+    first_model = train_and_save_model(project)
+    first_set = project.get_current_training_set()
+    TrainingSet.objects.create(project=project, set_number=first_set.set_number + 1)
+
+    # nothing changed, so the classifier is reused instead of trained again
+    second_model = train_and_save_model(project)
+    second_set = project.get_current_training_set()
+    first_set.refresh_from_db()
+    assert second_set.manifest == first_set.manifest
+    assert second_model.cv_accuracy == first_model.cv_accuracy
+    assert second_model.pickle_path != first_model.pickle_path
+    assert filecmp.cmp(first_model.pickle_path, second_model.pickle_path)
+
+
+def test_collect_artifact_garbage(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+    settings.ARTIFACT_RETENTION = 1
+    settings.ARTIFACT_GC_GRACE_SECONDS = 0
+
+    old_model = train_and_save_model(project)
+    old_set = project.get_current_training_set()
+    TrainingSet.objects.create(project=project, set_number=old_set.set_number + 1)
+    # a new label gives new training inputs and so a new classifier
+    DataLabel.objects.create(
+        data=project.data_set.filter(datalabel__isnull=True).first(),
+        label=project.labels.first(),
+        profile=project.creator,
+        training_set=project.get_current_training_set(),
+    )
+    train_and_save_model(project)
+    new_manifest = project.get_current_training_set().manifest
+    old_classifier = old_set.manifest["classifier"]
+    assert old_classifier != new_manifest["classifier"]
+
+    removed = collect_artifact_garbage(project)
 
-def test_predict_data(test_project_with_trained_model, tmpdir):
+    assert removed == [old_classifier]
+    assert not os.path.exists(old_model.pickle_path)
+    old_model.refresh_from_db()
+    assert old_model.pickle_path == ""
+    old_set.refresh_from_db()
+    assert old_set.manifest is None
+    for kind in ["features", "vectorizer", "classifier"]:
+        assert os.path.exists(object_path(project.pk, new_manifest[kind]))
+
+
+def test_predict_data(test_project_with_trained_model, tmpdir, settings):
     project = test_project_with_trained_model
+    model = project.model_set.get()
+    # predict in several chunks, the last one smaller than the others
+    settings.PREDICT_CHUNK_SIZE = 7
 
-    predictions = predict_data(project, project.model_set.get())
+    with CaptureQueriesContext(connection) as queries:
+        num_predictions = predict_data(project, model)
+    # the labels are looked up once, not per label or chunk
+    assert (
+        len([q for q in queries.captured_queries if 'FROM "core_label"' in q["sql"]])
+        == 1
+    )
 
     # Number of unlabeled data * number of labels.  Each data gets a prediction for each label.
     expected_predction_count = (
         project.data_set.filter(datalabel__isnull=True).count() * project.labels.count()
     )
-    assert len(predictions) == expected_predction_count
-
-    for prediction in predictions:
-        assert isinstance(prediction, DataPrediction)
-        assert_obj_exists(
-            DataPrediction,
-            {
-                "data": prediction.data,
-                "model": prediction.model,
-                "label": prediction.label,
-                "predicted_probability": prediction.predicted_probability,
-            },
+    assert num_predictions == expected_predction_count
+    predictions = DataPrediction.objects.filter(model=model)
+    assert predictions.count() == expected_predction_count
+
+    for datum in project.data_set.filter(datalabel__isnull=True):
+        probs = predictions.filter(data=datum).values_list(
+            "predicted_probability", flat=True
         )
+        assert len(probs) == project.labels.count()
+        np.testing.assert_almost_equal(sum(probs), 1)
+
+    # every datum also gets the uncertainty scores of its predictions
+    uncertainties = DataUncertainty.objects.filter(model=model)
+    assert (
+        uncertainties.count() == project.data_set.filter(datalabel__isnull=True).count()
+    )
+    for uncertainty in uncertainties:
+        probs = np.array(
+            DataPrediction.objects.filter(
+                data=uncertainty.data, model=model
+            ).values_list("predicted_probability", flat=True)
+        )
+        np.testing.assert_almost_equal(
+            uncertainty.least_confident, least_confident(probs)
+        )
+        np.testing.assert_almost_equal(
+            uncertainty.margin_sampling, margin_sampling(probs)
+        )
+        np.testing.assert_almost_equal(uncertainty.entropy, entropy(probs))
+
+
+def test_predict_data_shards(test_project_with_trained_model, tmpdir, settings):
+    project = test_project_with_trained_model
+    model = project.model_set.get()
+    settings.PREDICT_SHARDS = 3
+    settings.PREDICT_SHARD_MIN_ROWS = 1
+
+    shards = prediction_shards(project)
+    assert len(shards) == 3
+    assert shards[0][0] is None and shards[-1][1] is None
+    # each shard starts at the next third of the hashes
+    hashes = list(
+        project.data_set.filter(datalabel__isnull=True)
+        .order_by("upload_id_hash")
+        .values_list("upload_id_hash", flat=True)
+    )
+    shard_size = math.ceil(len(hashes) / 3)
+    assert [first_hash for first_hash, _ in shards[1:]] == hashes[
+        shard_size::shard_size
+    ]
+
+    # the shards together predict every unlabeled datum once
+    num_predictions = sum(
+        predict_data(project, model, first_hash, last_hash)
+        for first_hash, last_hash in shards
+    )
+    unlabeled_data = project.data_set.filter(datalabel__isnull=True)
+    assert num_predictions == unlabeled_data.count() * project.labels.count()
+    assert DataUncertainty.objects.filter(model=model).count() == (
+        unlabeled_data.count()
+    )
+
+
+def test_stage_metrics(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+    settings.PREDICT_SHARDS = 2
+    settings.PREDICT_SHARD_MIN_ROWS = 1
+
+    update_project_features(project.pk, update_tfidf_matrix)
+    model = train_and_save_model(project)
+    shards = prediction_shards(project)
+    for first_hash, last_hash in shards:
+        predict_data(project, model, first_hash, last_hash)
+    model.refresh_from_db()
+
+    tf_idf = load_tfidf_matrix(project.pk)
+    features = model.stage_metrics["features"]
+    assert (features["rows"], features["features"]) == tf_idf.shape
+    train = model.stage_metrics["train"]
+    assert train["mode"] == "full"
+    assert train["rows"] == DataLabel.objects.filter(data__project=project).count()
+    assert train["features"] == tf_idf.shape[1]
+
+    # every shard adds its own entry
+    predict = model.stage_metrics["predict"]
+    assert len(predict) == len(shards)
+    assert sum(stats["rows"] for stats in predict.values()) == (
+        project.data_set.filter(datalabel__isnull=True).count()
+    )
+    for stats in [features, train] + list(predict.values()):
+        assert stats["wall_seconds"] >= 0
+        assert stats["cpu_seconds"] >= 0
+        assert stats["peak_rss_mb"] > 0
+
+
+def test_predict_data_skips_data_not_in_features(
+    test_project_with_trained_model, tmpdir, settings
+):
+    project = test_project_with_trained_model
+    model = project.model_set.get()
+    num_unlabeled = project.data_set.filter(datalabel__isnull=True).count()
+    # uploaded while the features were being built
+    add_data(project, pd.DataFrame({"Text": ["a new datum"], "Label": [None]}))
+
+    num_predictions = predict_data(project, model)
+
+    assert num_predictions == num_unlabeled * project.labels.count()
+    assert not DataPrediction.objects.filter(
+        data__text="a new datum", model=model
+    ).exists()
+
+
+def test_predict_data_candidate_pool(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+    settings.PREDICTION_POOL_SIZE = 5
+
+    # the first model scores a random sample of the unlabeled data
+    first_model = train_and_save_model(project)
+    num_predictions = predict_data(project, first_model)
+    first_pool = set(
+        DataUncertainty.objects.filter(model=first_model).values_list("data", flat=True)
+    )
+    assert len(first_pool) == 5
+    assert num_predictions == 5 * project.labels.count()
+
+    # the next one a new sample plus the first pool
+    TrainingSet.objects.create(
+        project=project, set_number=project.get_current_training_set().set_number + 1
+    )
+    second_model = train_and_save_model(project)
+    predict_data(project, second_model)
+    second_pool = set(
+        DataUncertainty.objects.filter(model=second_model).values_list(
+            "data", flat=True
+        )
+    )
+    assert first_pool < second_pool
+    assert len(second_pool) == 10
+
+
+def test_compact_predictions(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+    settings.PREDICTION_SUMMARY_TOP_K = 2
+    settings.PREDICTION_SUMMARY_RETENTION = 1
+
+    models = []
+    for _ in range(3):
+        model = train_and_save_model(project)
+        predict_data(project, model)
+        models.append(model)
+        TrainingSet.objects.create(
+            project=project,
+            set_number=project.get_current_training_set().set_number + 1,
+        )
+    num_unlabeled = project.data_set.filter(datalabel__isnull=True).count()
+
+    compact_predictions(project)
+
+    # the latest model keeps all of its predictions
+    num_labels = project.labels.count()
+    assert DataPrediction.objects.filter(data__project=project).count() == (
+        num_unlabeled * num_labels
+    )
+    assert DataPrediction.objects.filter(model=models[-1]).count() == (
+        num_unlabeled * num_labels
+    )
+    # the model before it keeps the top labels, the oldest one nothing
+    assert not DataPredictionSummary.objects.filter(model=models[0]).exists()
+    summaries = DataPredictionSummary.objects.filter(model=models[1])
+    assert summaries.count() == num_unlabeled
+    for summary in summaries:
+        assert len(summary.labels) == len(summary.probabilities) == 2
+        assert summary.probabilities[0] >= summary.probabilities[1]
+
+    # compacting again changes nothing
+    compact_predictions(project)
+    assert DataPredictionSummary.objects.filter(model__project=project).count() == (
+        num_unlabeled
+    )
 
 
 def test_check_and_trigger_model_first_labeled(
@@ -1,16 +1,25 @@
 from test.util import assert_obj_exists, assert_redis_matches_db, read_test_data_backend
 
-from core.models import Data, DataQueue, DataUncertainty, Queue
+from core.models import AssignedData, Data, DataQueue, DataUncertainty, Queue
 from core.utils.util import add_data, create_project, md5_hash
 from core.utils.utils_queue import (
     add_queue,
+    check_queue_watermark,
     fill_queue,
     find_queue_length,
     get_nonempty_queue,
     pop_first_nonempty_queue,
     pop_queue,
+    refill_project_queues,
+    schedule_queue_refill,
 )
-from core.utils.utils_redis import get_ordered_data, init_redis
+from core.utils.utils_redis import (
+    get_ordered_data,
+    init_redis,
+    redis_serialize_queue,
+    redis_serialize_refill,
+)
+from core.utils.utils_status import update_data_status
 
 
 def test_find_queue_length():
@@ -50,12 +59,31 @@ def test_fill_nonempty_queue(db, test_queue):
         text="test data", project=test_queue.project, upload_id_hash=md5_hash(0)
     )
     DataQueue.objects.create(data=test_datum, queue=test_queue)
+    update_data_status(Data.objects.filter(pk=test_datum.pk))
     assert test_queue.data.count() == 1
 
     fill_queue(test_queue, orderby="random")
     assert test_queue.data.count() == test_queue.length
 
 
+def test_fill_queue_random_probes_random_keys(db, test_queue, test_redis):
+    project_data = Data.objects.filter(project=test_queue.project)
+    # data inserted with copy_from get their key from the database default
+    random_keys = list(project_data.values_list("random_key", flat=True))
+    assert len(set(random_keys)) == len(random_keys)
+
+    fill_queue(test_queue, orderby="random")
+
+    assert test_queue.data.count() == test_queue.length
+    assert_redis_matches_db(test_redis)
+
+    # each probe lands on a different datum, so the queue holds no duplicates
+    queued = list(
+        DataQueue.objects.filter(queue=test_queue).values_list("data_id", flat=True)
+    )
+    assert len(set(queued)) == len(queued)
+
+
 def test_fill_queue_all_remaining_data(db, test_queue):
     # Raise the queue length so it's bigger than the amount of data available
     all_data_count = Data.objects.filter(project=test_queue.project).count()
@@ -102,7 +130,7 @@ def test_pop_nonempty_queue(db, test_project_data, test_redis):
     datum = pop_queue(queue)
 
     assert isinstance(datum, Data)
-    assert test_redis.llen("queue:" + str(queue.pk)) == (queue_len - 1)
+    assert test_redis.zcard("queue:" + str(queue.pk)) == (queue_len - 1)
     assert test_redis.scard("set:" + str(queue.pk)) == (queue_len)
     assert queue.data.count() == queue_len
 
@@ -117,11 +145,11 @@ def test_pop_only_affects_one_queue(db, test_project_data, test_redis):
     datum = pop_queue(queue)
 
     assert isinstance(datum, Data)
-    assert test_redis.llen("queue:" + str(queue.pk)) == (queue_len - 1)
+    assert test_redis.zcard("queue:" + str(queue.pk)) == (queue_len - 1)
     assert test_redis.scard("set:" + str(queue.pk)) == (queue_len)
     assert queue.data.count() == queue_len
 
-    assert test_redis.llen("queue:" + str(queue2.pk)) == queue_len
+    assert test_redis.zcard("queue:" + str(queue2.pk)) == queue_len
     assert test_redis.scard("set:" + str(queue2.pk)) == (queue_len)
     assert queue2.data.count() == queue_len
 
@@ -324,3 +352,89 @@ def test_fill_queue_entropy_predicted_data(
         assert_obj_exists(DataUncertainty, {"data": datum})
         assert datum.datauncertainty_set.get().entropy <= previous_e
         previous_e = datum.datauncertainty_set.get().entropy
+
+
+def test_fill_queue_adds_new_data_to_redis(
+    test_project_predicted_data, test_queue, test_redis
+):
+    fill_queue(test_queue, "least confident")
+    first_fill = set(test_redis.zrange(redis_serialize_queue(test_queue), 0, -1))
+
+    test_queue.length += 10
+    test_queue.save()
+    fill_queue(test_queue, "least confident")
+
+    assert_redis_matches_db(test_redis)
+    data_scores = dict(
+        test_redis.zrange(redis_serialize_queue(test_queue), 0, -1, withscores=True)
+    )
+    new_data = set(data_scores) - first_fill
+    assert len(new_data) == 10
+    for data_key in new_data:
+        datum = Data.objects.get(pk=data_key.decode().split(":")[1])
+        least_confident = datum.datauncertainty_set.get().least_confident
+        assert abs(data_scores[data_key] + least_confident) < 1e-9
+
+
+def test_check_queue_watermark_schedules_refill(db, test_queue, test_redis, settings):
+    settings.QUEUE_LOW_WATERMARK = 0.5
+    project = test_queue.project
+
+    # a refill that is already waiting for a worker is not sent again
+    test_redis.set(redis_serialize_refill(project.pk), 1)
+    assert not check_queue_watermark(project)
+    assert test_queue.data.count() == 0
+
+    # celery runs the refill task eagerly in the tests
+    test_redis.delete(redis_serialize_refill(project.pk))
+    assert check_queue_watermark(project)
+    test_queue.refresh_from_db()
+    assert test_queue.data.count() == test_queue.length
+    assert_redis_matches_db(test_redis)
+    assert not test_redis.exists(redis_serialize_refill(project.pk))
+
+    # the full queue is above the watermark
+    assert not check_queue_watermark(project)
+
+
+def test_schedule_queue_refill_keeps_latest_orderby(db, test_queue, test_redis):
+    project = test_queue.project
+    refill_key = redis_serialize_refill(project.pk)
+
+    # a refill that is waiting for a worker takes the orderby of a later one
+    test_redis.set(refill_key, "")
+    assert not schedule_queue_refill(project, "random")
+    assert test_redis.get(refill_key) == b"random"
+    assert not schedule_queue_refill(project)
+    assert test_redis.get(refill_key) == b""
+
+    # the run that covers the refills clears the flag, so the next one is sent
+    refill_project_queues(project, "random")
+    test_queue.refresh_from_db()
+    assert test_queue.data.count() == test_queue.length
+    assert not test_redis.exists(refill_key)
+
+
+def test_check_queue_watermark_counts_assigned_data(
+    db, test_queue, test_profile, test_redis, settings
+):
+    settings.QUEUE_LOW_WATERMARK = 0.5
+    project = test_queue.project
+    fill_queue(test_queue, orderby="random")
+
+    # data assigned to a coder leave the redis queue but not the queue itself, so
+    # a refill would add nothing
+    queued_data = list(test_queue.data.all())
+    for datum in queued_data:
+        AssignedData.objects.create(profile=test_profile, data=datum, queue=test_queue)
+    test_redis.delete(redis_serialize_queue(test_queue))
+    assert not check_queue_watermark(project)
+
+    # once most of them are labeled the refill tops the queue up again
+    labeled_data = queued_data[: len(queued_data) // 2 + 1]
+    AssignedData.objects.filter(data__in=labeled_data).delete()
+    DataQueue.objects.filter(data__in=labeled_data).delete()
+    assert check_queue_watermark(project)
+    test_queue.refresh_from_db()
+    assert test_queue.data.count() == test_queue.length
+    assert test_redis.zcard(redis_serialize_queue(test_queue)) == len(labeled_data)
@@ -1,16 +1,25 @@
 from test.util import assert_obj_exists, assert_redis_matches_db, read_test_data_backend
 
-from core.models import AssignedData, Data, DataQueue, Queue
+from core.models import AssignedData, Data, DataQueue, DataUncertainty, Model, Queue
+from core.utils import utils_redis
 from core.utils.util import add_data, create_project
-from core.utils.utils_queue import add_queue, fill_queue
+from core.utils.utils_queue import add_queue, fill_queue, pop_first_nonempty_queue
 from core.utils.utils_redis import (
+    acquire_task_lock,
+    get_data_scores,
+    get_task_locks,
     init_redis,
+    rebuild_project_redis,
     redis_parse_data,
     redis_parse_list_dataids,
     redis_parse_queue,
     redis_serialize_data,
     redis_serialize_queue,
     redis_serialize_set,
+    redis_serialize_warm,
+    release_task_lock,
+    run_coalesced,
+    sync_redis_objects,
 )
 
 
@@ -47,7 +56,7 @@ def test_redis_parse_queue(test_queue, test_redis):
 def test_redis_parse_data(test_queue, test_redis):
     fill_queue(test_queue, orderby="random")
 
-    popped_data_key = test_redis.lpop(redis_serialize_queue(test_queue))
+    popped_data_key = test_redis.zpopmin(redis_serialize_queue(test_queue))[0][0]
     parsed_data = redis_parse_data(popped_data_key)
 
     assert_obj_exists(Data, {"pk": parsed_data.pk})
@@ -58,12 +67,81 @@ def test_redis_parse_list_dataids(test_queue, test_redis):
     fill_queue(test_queue, orderby="random")
 
     data_ids = [d.pk for d in test_queue.data.all()]
-    redis_ids = test_redis.lrange(redis_serialize_queue(test_queue), 0, -1)
+    redis_ids = test_redis.zrange(redis_serialize_queue(test_queue), 0, -1)
     parsed_ids = redis_parse_list_dataids(redis_ids)
 
     assert data_ids.sort() == parsed_ids.sort()
 
 
+def test_redis_queue_ordered_by_scores(
+    test_project_predicted_data, test_queue, test_redis
+):
+    fill_queue(test_queue, orderby="least confident")
+
+    # the sorted set pops the most uncertain datum first
+    data_ids = redis_parse_list_dataids(
+        test_redis.zrange(redis_serialize_queue(test_queue), 0, -1)
+    )
+    least_confident = [
+        DataUncertainty.objects.get(data__pk=data_id).least_confident
+        for data_id in data_ids
+    ]
+    assert len(data_ids) == test_queue.length
+    assert least_confident == sorted(least_confident, reverse=True)
+
+    # reordering the queue only changes the scores
+    sync_redis_objects(test_queue, "margin sampling")
+    data_scores = test_redis.zrange(
+        redis_serialize_queue(test_queue), 0, -1, withscores=True
+    )
+    assert len(data_scores) == test_queue.length
+    for data_key, score in data_scores:
+        data_id = redis_parse_data(data_key).pk
+        margin = DataUncertainty.objects.get(data__pk=data_id).margin_sampling
+        assert abs(score - margin) < 1e-9
+
+    assert get_data_scores(data_ids, "margin sampling") == dict(
+        (data_key.decode(), score) for data_key, score in data_scores
+    )
+
+
+def test_redis_queue_ordered_by_latest_model(
+    test_project_predicted_data, test_queue, test_redis
+):
+    project = test_project_predicted_data
+    fill_queue(test_queue, orderby="least confident")
+    old_order = redis_parse_list_dataids(
+        test_redis.zrange(redis_serialize_queue(test_queue), 0, -1)
+    )
+
+    # a second model is confident about the data the first one was least sure of
+    old_model = project.model_set.get()
+    new_model = Model.objects.create(
+        pickle_path="", project=project, training_set=old_model.training_set
+    )
+    DataUncertainty.objects.bulk_create(
+        DataUncertainty(
+            data=u.data,
+            model=new_model,
+            least_confident=1 - u.least_confident,
+            margin_sampling=1 - u.margin_sampling,
+            entropy=1 - u.entropy,
+        )
+        for u in DataUncertainty.objects.filter(model=old_model)
+    )
+
+    sync_redis_objects(test_queue, "least confident")
+    new_order = redis_parse_list_dataids(
+        test_redis.zrange(redis_serialize_queue(test_queue), 0, -1)
+    )
+    least_confident = [
+        DataUncertainty.objects.get(data__pk=data_id, model=new_model).least_confident
+        for data_id in new_order
+    ]
+    assert len(new_order) == len(old_order)
+    assert least_confident == sorted(least_confident, reverse=True)
+
+
 def test_init_redis_empty(db, test_redis):
     init_redis()
 
@@ -136,5 +214,136 @@ def test_init_redis_ignores_assigned_data(db, test_profile, test_queue, test_red
     init_redis()
 
     # Make sure the assigned datum didn't get into the redis queue
-    assert test_redis.llen("queue:" + str(test_queue.pk)) == test_queue.length - 1
+    assert test_redis.zcard("queue:" + str(test_queue.pk)) == test_queue.length - 1
     assert test_redis.scard("set:" + str(test_queue.pk)) == test_queue.length - 1
+
+
+def test_init_redis_in_chunks(db, test_project_data, test_redis, settings):
+    settings.REDIS_CHUNK_SIZE = 3
+    queue = add_queue(test_project_data, 10)
+    fill_queue(queue, orderby="least confident")
+
+    test_redis.flushdb()
+    init_redis()
+
+    assert_redis_matches_db(test_redis)
+    assert test_redis.exists(redis_serialize_warm(test_project_data.pk))
+
+
+def test_init_redis_lazy(db, test_queue, test_redis, settings):
+    settings.REDIS_LAZY_INIT = True
+    fill_queue(test_queue, orderby="random")
+
+    init_redis()
+
+    # the keys are only rebuilt when the project's queues are first popped
+    assert not test_redis.exists(redis_serialize_queue(test_queue))
+    queue, datum = pop_first_nonempty_queue(test_queue.project)
+    assert queue == test_queue
+    assert datum in test_queue.data.all()
+    assert test_redis.exists(redis_serialize_warm(test_queue.project.pk))
+    assert test_redis.zcard(redis_serialize_queue(test_queue)) == (
+        test_queue.length - 1
+    )
+
+
+def test_init_redis_lazy_lock_timeout(db, test_queue, test_redis, settings):
+    settings.REDIS_LAZY_INIT = True
+    settings.REDIS_WARM_LOCK_TIMEOUT = 1
+    fill_queue(test_queue, orderby="random")
+    init_redis()
+
+    # a process that took the lock and hung does not block the queues for longer
+    # than the lease, the waiting process rebuilds the project itself
+    assert acquire_task_lock(test_queue.project.pk, "redis", "hung")
+    queue, datum = pop_first_nonempty_queue(test_queue.project)
+    assert queue == test_queue
+    assert test_redis.exists(redis_serialize_warm(test_queue.project.pk))
+    assert get_task_locks(test_queue.project.pk)[0]["owner"] == "hung"
+
+
+def test_rebuild_project_redis_keeps_concurrent_writes(
+    db, test_queue, test_redis, monkeypatch
+):
+    fill_queue(test_queue, orderby="random")
+    test_redis.flushdb()
+    extra_datum = Data.objects.filter(project=test_queue.project).exclude(
+        pk__in=test_queue.data.all()
+    )[0]
+    add_queue_scores = utils_redis.add_queue_scores
+
+    def add_queue_scores_during_write(pipeline, queue_scores, prefix=""):
+        # a datum is added to the live keys while the rebuild reads the database
+        test_redis.sadd(redis_serialize_set(test_queue), "data:" + str(extra_datum.pk))
+        test_redis.zadd(
+            redis_serialize_queue(test_queue), {"data:" + str(extra_datum.pk): 0}
+        )
+        add_queue_scores(pipeline, queue_scores, prefix)
+
+    monkeypatch.setattr(utils_redis, "add_queue_scores", add_queue_scores_during_write)
+    rebuild_project_redis(test_queue.project)
+
+    assert test_redis.zcard(redis_serialize_queue(test_queue)) == test_queue.length + 1
+    assert test_redis.scard(redis_serialize_set(test_queue)) == test_queue.length + 1
+    assert test_redis.ttl(redis_serialize_queue(test_queue)) == -1
+    assert list(test_redis.scan_iter("rebuild:*")) == []
+
+
+def test_task_lock(test_redis):
+    assert acquire_task_lock(1, "model", "first")
+    # the lock is held, and only its owner can release it
+    assert not acquire_task_lock(1, "model", "second")
+    assert not release_task_lock(1, "model", "second")
+    # other projects and task types have their own locks
+    assert acquire_task_lock(2, "model", "second")
+    assert acquire_task_lock(1, "features", "second")
+
+    locks = get_task_locks(1)
+    assert [lock["task"] for lock in locks] == ["features", "model"]
+    assert locks[1]["owner"] == "first"
+    assert locks[1]["expires_in"] > 0
+
+    assert release_task_lock(1, "model", "first")
+    assert acquire_task_lock(1, "model", "second")
+
+
+def test_run_coalesced(test_redis):
+    calls = []
+
+    def run():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            # triggers that arrive while the task runs are coalesced into one rerun
+            assert run_coalesced(1, "features", run) is None
+            assert run_coalesced(1, "features", run) is None
+            assert get_task_locks(1)[0]["pending"]
+        return len(calls)
+
+    assert run_coalesced(1, "features", run) == 2
+    assert calls == [0, 1]
+    assert get_task_locks(1) == []
+
+
+def test_run_coalesced_follow_up(test_redis):
+    calls = []
+
+    def run():
+        calls.append("run")
+        if len(calls) == 1:
+            # the trigger is left to the running task, which follows it up after
+            # its rerun
+            assert (
+                run_coalesced(1, "features", run, follow_up, request_follow_up=True)
+                is None
+            )
+        return len(calls)
+
+    def follow_up():
+        calls.append("follow up")
+
+    assert run_coalesced(1, "features", run, follow_up) == 2
+    assert calls == ["run", "run", "follow up"]
+
+    # a trigger that runs itself follows itself up
+    assert run_coalesced(1, "features", run, follow_up, request_follow_up=True) == 4
+    assert calls == ["run", "run", "follow up", "run", "follow up"]
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from core.utils.utils_resources import current_peak_rss_kb, measure_stage
+
+
+def allocate(mb):
+    """Allocate and touch mb megabytes so they are resident."""
+    return np.ones(mb * 1024 * 1024, dtype=np.uint8)
+
+
+@pytest.mark.skipif(
+    current_peak_rss_kb() is None, reason="the peak memory is only reset on Linux"
+)
+def test_measure_stage_peak_rss():
+    big = allocate(200)
+    del big
+
+    with measure_stage() as outer:
+        with measure_stage() as first:
+            big = allocate(100)
+            del big
+        with measure_stage() as second:
+            pass
+
+    # the earlier peak of the process is not counted in any stage
+    assert first["peak_rss_mb"] >= 100
+    assert second["peak_rss_mb"] < first["peak_rss_mb"] - 50
+    # the peak of a nested stage still counts in the stage around it
+    assert outer["peak_rss_mb"] >= first["peak_rss_mb"]
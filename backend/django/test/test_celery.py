@@ -1,10 +1,20 @@
+import multiprocessing
 import os
 import random
-from test.util import assert_obj_exists, assert_redis_matches_db
+from test.util import (
+    assert_obj_exists,
+    assert_redis_matches_db,
+    read_test_data_backend,
+)
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
 
 from core import tasks
 from core.models import Data, DataPrediction, DataUncertainty, Model, ProjectPermissions
-from core.utils.util import create_profile
+from core.utils import utils_model
+from core.utils.util import add_data, create_profile
 from core.utils.utils_annotate import (
     assign_datum,
     batch_unassign,
@@ -12,7 +22,12 @@ from core.utils.utils_annotate import (
     label_data,
 )
 from core.utils.utils_queue import fill_queue
-from core.utils.utils_redis import get_ordered_data, redis_serialize_queue
+from core.utils.utils_redis import (
+    acquire_task_lock,
+    get_ordered_data,
+    get_task_locks,
+    redis_serialize_queue,
+)
 
 
 def test_celery():
@@ -93,6 +108,30 @@ def test_model_task(
     )
 
 
+def test_model_task_shard_failure_releases_lock(
+    test_project_labeled_and_tfidf, test_redis, tmpdir, settings, monkeypatch
+):
+    project = test_project_labeled_and_tfidf
+    initial_training_set = project.get_current_training_set()
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+
+    def predict_data(*args, **kwargs):
+        raise ValueError("shard failed")
+
+    monkeypatch.setattr(utils_model, "predict_data", predict_data)
+
+    assert acquire_task_lock(project.pk, "model", "owner")
+    with pytest.raises(ValueError):
+        tasks.send_model_task.delay(project.pk, lock_owner="owner").get()
+    assert get_task_locks(project.pk) == []
+    assert project.get_current_training_set() == initial_training_set
+
+    # on a worker the chord calls the error callback instead of finalize
+    assert acquire_task_lock(project.pk, "model", "owner")
+    tasks.send_model_failure_task.delay(project.pk, "owner").get()
+    assert get_task_locks(project.pk) == []
+
+
 def test_tfidf_creation_task(test_project_data, tmpdir, settings):
     data_temp = tmpdir.mkdir("data").mkdir("tf_idf")
     settings.TF_IDF_PATH = str(data_temp)
@@ -102,10 +141,107 @@ def test_tfidf_creation_task(test_project_data, tmpdir, settings):
 
     file = tasks.send_tfidf_creation_task.delay(project.pk).get()
 
-    assert os.path.isfile(file)
+    assert os.path.isdir(file)
     assert file == os.path.join(
-        str(data_temp), "project_" + str(test_project_data.pk) + "_tfidf_matrix.pkl"
+        str(data_temp), "project_" + str(test_project_data.pk) + "_tfidf_matrix"
+    )
+
+
+def test_tfidf_creation_task_sharded(test_project_data, tmpdir, settings, monkeypatch):
+    """The celery prefork pool runs tasks in daemonic processes, which multiprocessing
+    does not let start a process pool, so large projects are counted in a billiard
+    pool."""
+    settings.TF_IDF_PATH = str(tmpdir.mkdir("data").mkdir("tf_idf"))
+    project = test_project_data
+    settings.TFIDF_WORKERS = 1
+    serial, serial_keys, _ = utils_model.create_tfidf_matrix(project.pk)
+
+    settings.TFIDF_WORKERS = 3
+    settings.TFIDF_PARALLEL_MIN_ROWS = 0
+    monkeypatch.setitem(multiprocessing.current_process()._config, "daemon", True)
+    num_sharded = []
+    create_sharded_tfidf_matrix = utils_model.create_sharded_tfidf_matrix
+
+    def count_sharded(*args, **kwargs):
+        num_sharded.append(1)
+        return create_sharded_tfidf_matrix(*args, **kwargs)
+
+    monkeypatch.setattr(utils_model, "create_sharded_tfidf_matrix", count_sharded)
+
+    tasks.send_tfidf_creation_task.delay(project.pk).get()
+
+    assert len(num_sharded) == 1
+    sharded = utils_model.load_tfidf_matrix(project.pk)
+    assert sharded.row_keys() == serial_keys
+    assert np.allclose(sharded.to_csr().toarray(), serial.toarray(), rtol=0, atol=1e-15)
+
+
+def test_cv_task_parallel_in_daemon(
+    test_project_labeled_and_tfidf, tmpdir, settings, monkeypatch, recwarn
+):
+    """The folds are fit in threads, which joblib allows inside the daemonic processes
+    of the celery prefork pool."""
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir("model_pickles"))
+    settings.CV_FOLDS = 3
+    settings.CV_JOBS = 3
+    settings.CV_HOLDOUT_MIN_ROWS = 1000000
+    model = utils_model.train_and_save_model(project)
+    monkeypatch.setitem(multiprocessing.current_process()._config, "daemon", True)
+
+    cv_accuracy = tasks.send_cv_task.delay(model.pk).get()
+
+    assert 0 <= cv_accuracy <= 1
+    assert not any("n_jobs=1" in str(warning.message) for warning in recwarn)
+
+
+def test_tfidf_creation_task_upload_while_running(
+    test_project, test_redis, tmpdir, settings, monkeypatch
+):
+    """A second upload that arrives while the features of the first one are built is
+    coalesced into the running task, which triggers the model again once its rerun
+    added the new data."""
+    settings.TF_IDF_PATH = str(tmpdir.mkdir("data").mkdir("tf_idf"))
+    project = test_project
+    test_data = read_test_data_backend(file="./core/data/test_files/test_no_labels.csv")
+    add_data(project, test_data[:600].reset_index(drop=True))
+    num_first_upload = Data.objects.filter(project=project).count()
+
+    # the number of rows in the features each time the model is triggered
+    model_triggers = []
+    monkeypatch.setattr(
+        tasks,
+        "send_check_and_trigger_model_task",
+        SimpleNamespace(
+            delay=lambda project_pk: model_triggers.append(
+                len(utils_model.load_tfidf_matrix(project_pk))
+            )
+        ),
     )
+    update_tfidf_matrix = utils_model.update_tfidf_matrix
+    second_uploads = []
+
+    def update_with_second_upload(project_pk, **kwargs):
+        file = update_tfidf_matrix(project_pk, **kwargs)
+        if not second_uploads:
+            second_uploads.append(
+                add_data(project, test_data[600:].reset_index(drop=True))
+            )
+            second_task = tasks.send_tfidf_creation_task.delay(
+                project_pk, trigger_model=True
+            )
+            assert second_task.get() is None
+            assert model_triggers == []
+        return file
+
+    monkeypatch.setattr(utils_model, "update_tfidf_matrix", update_with_second_upload)
+
+    tasks.send_tfidf_creation_task.delay(project.pk, trigger_model=True).get()
+
+    assert model_triggers == [
+        num_first_upload,
+        Data.objects.filter(project=project).count(),
+    ]
 
 
 def test_model_task_redis_no_dupes_data_left_in_queue(
@@ -146,7 +282,7 @@ def test_model_task_redis_no_dupes_data_left_in_queue(
 
     tasks.send_model_task.delay(project.pk).get()
     assert project.get_current_training_set().set_number == initial_training_set + 1
-    redis_items = test_redis.lrange(redis_serialize_queue(queue), 0, -1)
+    redis_items = test_redis.zrange(redis_serialize_queue(queue), 0, -1)
     assert len(redis_items) == len(set(redis_items))
 
 
@@ -196,7 +332,7 @@ def test_model_task_redis_no_dupes_data_unassign_assigned_data(
 
     tasks.send_model_task.delay(project.pk).get()
     assert project.get_current_training_set().set_number == initial_training_set + 1
-    redis_items = test_redis.lrange(redis_serialize_queue(queue), 0, -1)
+    redis_items = test_redis.zrange(redis_serialize_queue(queue), 0, -1)
     assert len(redis_items) == len(set(redis_items))
 
     assignments = get_assignments(project.creator, project, 40)
@@ -205,9 +341,9 @@ def test_model_task_redis_no_dupes_data_unassign_assigned_data(
 
     tasks.send_model_task.delay(project.pk).get()
     assert project.get_current_training_set().set_number == initial_training_set + 2
-    redis_items = test_redis.lrange(redis_serialize_queue(queue), 0, -1)
+    redis_items = test_redis.zrange(redis_serialize_queue(queue), 0, -1)
     assert len(redis_items) == len(set(redis_items))
 
     batch_unassign(project.creator)
-    redis_items = test_redis.lrange(redis_serialize_queue(queue), 0, -1)
+    redis_items = test_redis.zrange(redis_serialize_queue(queue), 0, -1)
     assert len(redis_items) == len(set(redis_items))
@@ -1,9 +1,19 @@
 import math
 
 from core.models import Data, DataLabel, DataQueue, IRRLog
-from core.utils.utils_annotate import assign_datum, label_data, skip_data
+from core.utils.utils_annotate import (
+    assign_datum,
+    label_data,
+    skip_data,
+    unassign_datum,
+)
 from core.utils.utils_model import check_and_trigger_model
 from core.utils.utils_queue import fill_queue
+from core.utils.utils_redis import (
+    redis_serialize_data,
+    redis_serialize_irr_profiles,
+    redis_serialize_irr_set,
+)
 
 
 def test_fill_half_irr_queues(
@@ -169,6 +179,138 @@ def test_skip_irr(
     assert DataLabel.objects.filter(data=second_datum3).count() == 1
 
 
+def test_irr_pops_from_profile_set(
+    setup_celery,
+    test_project_half_irr_data,
+    test_half_irr_all_queues,
+    test_profile,
+    test_profile2,
+    test_labels_half_irr,
+    test_redis,
+    tmpdir,
+    settings,
+):
+    """Each profile pops the irr data from its own redis set, which is kept in step
+    with the irr queue as the data are assigned, unassigned and resolved."""
+    project = test_project_half_irr_data
+    normal_queue, admin_queue, irr_queue = test_half_irr_all_queues
+    fill_queue(
+        normal_queue, "random", irr_queue, project.percentage_irr, project.batch_size
+    )
+    num_irr = DataQueue.objects.filter(queue=irr_queue).count()
+    irr_set = redis_serialize_irr_set(irr_queue, test_profile.pk)
+    irr_set2 = redis_serialize_irr_set(irr_queue, test_profile2.pk)
+
+    # the set of a profile is built on its first pop, without the popped datum
+    datum = assign_datum(test_profile, project, "irr")
+    assert test_redis.zcard(irr_set) == num_irr - 1
+    assert test_redis.zscore(irr_set, redis_serialize_data(datum)) is None
+    assert not test_redis.exists(irr_set2)
+
+    # every profile is given the irr data in the same order
+    datum2 = assign_datum(test_profile2, project, "irr")
+    assert datum2.pk == datum.pk
+    assert test_redis.smembers(redis_serialize_irr_profiles(irr_queue)) == {
+        str(test_profile.pk).encode(),
+        str(test_profile2.pk).encode(),
+    }
+
+    # unassigning the datum gives it back to the profile
+    unassign_datum(datum, test_profile)
+    assert test_redis.zscore(irr_set, redis_serialize_data(datum)) is not None
+    assert assign_datum(test_profile, project, "irr").pk == datum.pk
+
+    # once the datum is resolved it is removed from every set
+    label_data(test_labels_half_irr[0], datum, test_profile, 3)
+    label_data(test_labels_half_irr[0], datum2, test_profile2, 3)
+    assert DataQueue.objects.filter(data=datum, queue=irr_queue).count() == 0
+    assert test_redis.zcard(irr_set) == num_irr - 1
+    assert test_redis.zcard(irr_set2) == num_irr - 1
+
+    # a datum added to the irr queue is added to the sets of the profiles
+    fill_queue(
+        normal_queue, "random", irr_queue, project.percentage_irr, project.batch_size
+    )
+    num_irr_new = DataQueue.objects.filter(queue=irr_queue).count()
+    assert test_redis.zcard(irr_set) == num_irr_new
+    assert test_redis.zcard(irr_set2) == num_irr_new
+
+
+def test_irr_pop_drops_stale_data(
+    setup_celery,
+    test_project_half_irr_data,
+    test_half_irr_all_queues,
+    test_profile,
+    test_labels_half_irr,
+    test_redis,
+    tmpdir,
+    settings,
+):
+    """Data that left the irr queue or were seen by the profile while its set was
+    built are not assigned, and the set is only built by the pop that registered
+    the profile."""
+    project = test_project_half_irr_data
+    normal_queue, admin_queue, irr_queue = test_half_irr_all_queues
+    fill_queue(
+        normal_queue, "random", irr_queue, project.percentage_irr, project.batch_size
+    )
+    irr_set = redis_serialize_irr_set(irr_queue, test_profile.pk)
+    datum = assign_datum(test_profile, project, "irr")
+    num_left = test_redis.zcard(irr_set)
+
+    # a datum outside the irr queue and the assigned datum, ahead of the others
+    outside_datum = Data.objects.filter(project=project).exclude(
+        dataqueue__queue=irr_queue
+    )[0]
+    test_redis.zadd(
+        irr_set,
+        {
+            redis_serialize_data(outside_datum): 0,
+            redis_serialize_data(datum): 0,
+        },
+    )
+
+    next_datum = assign_datum(test_profile, project, "irr")
+    assert next_datum.pk not in [datum.pk, outside_datum.pk]
+    assert DataQueue.objects.filter(data=next_datum, queue=irr_queue).exists()
+    assert test_redis.zcard(irr_set) == num_left - 1
+
+    # once the set is empty it is not built again from the database
+    label_data(test_labels_half_irr[0], datum, test_profile, 3)
+    label_data(test_labels_half_irr[0], next_datum, test_profile, 3)
+    test_redis.delete(irr_set)
+    assert assign_datum(test_profile, project, "irr") is None
+
+
+def test_unassign_data_api_returns_irr_data(
+    setup_celery,
+    client,
+    test_project_half_irr_data,
+    test_half_irr_all_queues,
+    test_profile,
+    test_redis,
+    tmpdir,
+    settings,
+):
+    """Skipping past a card unassigns it, which gives an irr datum back to the
+    profile's set so it can be assigned again."""
+    project = test_project_half_irr_data
+    normal_queue, admin_queue, irr_queue = test_half_irr_all_queues
+    fill_queue(
+        normal_queue, "random", irr_queue, project.percentage_irr, project.batch_size
+    )
+    irr_set = redis_serialize_irr_set(irr_queue, test_profile.pk)
+
+    datum = assign_datum(test_profile, project, "irr")
+    assert test_redis.zscore(irr_set, redis_serialize_data(datum)) is None
+
+    client.login(username="test_profile", password="password")
+    response = client.post("/api/unassign_data/" + str(datum.pk) + "/")
+    assert response.status_code == 200
+    assert test_redis.zscore(irr_set, redis_serialize_data(datum)) is not None
+    assert assign_datum(test_profile, project, "irr").pk == datum.pk
+
+
 def test_queue_refill(
     setup_celery,
     test_project_data,
@@ -46,11 +46,11 @@ def assert_redis_matches_db(test_redis):
 
         if data_count > 0:
             assert test_redis.exists("queue:" + str(q.pk))
-            assert test_redis.llen("queue:" + str(q.pk)) == data_count
+            assert test_redis.zcard("queue:" + str(q.pk)) == data_count
             assert test_redis.exists("set:" + str(q.pk))
             assert test_redis.scard("set:" + str(q.pk)) == data_count
         else:
-            # Empty lists don't exist in redis
+            # Empty sorted sets don't exist in redis
             assert not test_redis.exists("queue:" + str(q.pk))
             assert not test_redis.exists("set:" + str(q.pk))
 
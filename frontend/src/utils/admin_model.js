@@ -70,13 +70,19 @@ if (PROJECT_CLASSIFIER !== 'None') {
                     $("#model_metric_icon").attr("title", "Indicates how precise the"
                       + " active learning model is at correctly predicting the category"
                       + " in the test set. Formula:  True Positives/(True Positives + False Positives)");
-                } else {
+                } else if (choice === "recall") {
                     $("#model_metrics").text("Model Metrics: Recall ");
                     $("#model_metrics").append(children);
                     $("#model_metric_icon").attr("title", "Indicates how comprehensive"
                       + " the active learning model is at identifying documents of a "
                       + "particular category in the test set.  Formula:  "
                       + "True Positives/(True Positives + False Negatives)");
+                } else {
+                    $("#model_metrics").text("Model Resources: " + $(this).find("option:selected").text() + " ");
+                    $("#model_metrics").append(children);
+                    $("#model_metric_icon").attr("title", "The time and memory used to "
+                      + "build the features, train the model and predict the unlabeled "
+                      + "data. Prediction shards run in parallel, so their times are added up.");
                 }
                 $(function () {
                     $('[data-toggle="tooltip"]').tooltip();